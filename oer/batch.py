@@ -0,0 +1,152 @@
+""" Transforms many documents concurrently and hands back each one as soon as it is done:
+
+      for result in transform_batch([(name, html), ...], css, workers=4):
+        ...
+
+    The transforms run in a pool of threads or processes; the caller waits for the next result to finish
+    (transform_files also reads and writes the files in the workers). At most max_in_flight documents
+    are taken from the (possibly endless) input at a time, a document that fails is returned with its
+    error instead of stopping the batch, and closing the generator stops the workers. """
+import os
+import sys
+import threading
+import tempfile
+import cPickle as pickle
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from lxml import etree
+from epubcss import AddNumbering
+from custom.stylesheet import CompiledStylesheet
+
+__all__ = ['BatchResult', 'transform_batch', 'transform_files']
+
+# output is None when it was written to a file (or when the document failed: then error is the exception)
+BatchResult = collections.namedtuple('BatchResult', 'name output error')
+
+# How long to wait for a result at a time (a wait without a timeout can not be interrupted with Ctrl-C)
+_POLL = 1
+
+def transform_batch(documents, explicit_styles = [], args = None, executor = 'threads', workers = None, max_in_flight = None, pretty_print = True):
+  """ Transforms the (name, html) documents with the explicit_styles (see AddNumbering.transform).
+      executor is 'threads' (documents are only parsed in parallel as far as lxml releases the GIL) or
+      'processes', with workers of them (one per CPU by default).
+      Yields a BatchResult for every document, in the order they finish (waiting for the next one).
+      An error in a worker that is not the document's own (see BatchResult) is raised """
+  tasks = ((name, html, None, None, pretty_print) for (name, html) in documents)
+  return _run(tasks, explicit_styles, args, executor, workers, max_in_flight)
+
+def transform_files(paths, output_dir = None, explicit_styles = [], args = None, executor = 'threads', workers = None, max_in_flight = None, pretty_print = True):
+  """ Same as transform_batch for files, read and written (atomically, into output_dir with the same name) in the workers.
+      Without output_dir the BatchResults have the output instead """
+  def tasks():
+    for path in paths:
+      destination = None
+      if output_dir is not None:
+        destination = os.path.join(output_dir, os.path.basename(path))
+      yield (path, None, path, destination, pretty_print)
+  return _run(tasks(), explicit_styles, args, executor, workers, max_in_flight)
+
+def _run(tasks, explicit_styles, args, executor, workers, max_in_flight):
+  if isinstance(explicit_styles, (basestring, CompiledStylesheet)):
+    explicit_styles = [explicit_styles]
+  # Compiled once (and sent with every document, so batches running at the same time do not mix them up)
+  numbering = AddNumbering(args)
+  explicit_styles = [isinstance(css, CompiledStylesheet) and css or numbering.compile_stylesheet(css) for css in explicit_styles]
+  if executor not in ('threads', 'processes'):
+    raise ValueError("executor must be 'threads' or 'processes', not %r" % executor)
+  workers = workers or multiprocessing.cpu_count()
+  max_in_flight = max_in_flight or 2 * workers
+  Pool = executor == 'processes' and multiprocessing.Pool or ThreadPool
+  pool = Pool(workers)
+  pending = [] # the AsyncResults of the documents in flight
+  ready = threading.Event() # set when one of them is done
+  finished = lambda _: ready.set()
+  try:
+    for task in tasks:
+      pending.append(pool.apply_async(_transform_document, (args, explicit_styles, task), callback=finished))
+      while len(pending) >= max_in_flight:
+        yield _next(pending, ready)
+    while pending:
+      yield _next(pending, ready)
+    pool.close()
+    pool.join()
+  finally:
+    # Only does something when the batch was cancelled (the generator was closed) or failed
+    pool.terminate()
+
+def _next(pending, ready):
+  """ The result of the first of the pending AsyncResults that is done (raises its error if it failed:
+      the callback is only called on success so they are checked every _POLL seconds too) """
+  while True:
+    ready.clear()
+    for (i, result) in enumerate(pending):
+      if result.ready():
+        del pending[i]
+        return result.get()
+    ready.wait(_POLL)
+
+def _transform_document(args, explicit_styles, task):
+  (name, html, source, destination, pretty_print) = task
+  try:
+    if html is None:
+      f = open(source)
+      try:
+        html = f.read()
+      finally:
+        f.close()
+    output = etree.tostring(AddNumbering(args).transform(html, explicit_styles, pretty_print), encoding='ascii')
+    if destination is not None:
+      _write(destination, output)
+      output = None
+    return BatchResult(name, output, None)
+  except Exception, e:
+    return BatchResult(name, None, _picklable(e))
+
+def _write(path, output):
+  """ Atomically (so a cancelled batch never leaves half a file) """
+  (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+  try:
+    f = os.fdopen(fd, 'wb')
+    try:
+      f.write(output)
+    finally:
+      f.close()
+    os.rename(tmp, path)
+  except:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    raise
+
+def _picklable(error):
+  """ The error if it can be sent back from a worker process, otherwise an Exception with its message """
+  try:
+    pickle.dumps(error, pickle.HIGHEST_PROTOCOL)
+    return error
+  except Exception:
+    return Exception('%s: %s' % (error.__class__.__name__, error))
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description='Transform many HTML files concurrently')
+  parser.add_argument('-c', dest='css', help='CSS File', type=argparse.FileType('r'), action='append')
+  parser.add_argument('--output-dir', dest='output_dir', help='Directory to write the files to', required=True)
+  parser.add_argument('-j', '--jobs', dest='jobs', help='Number of workers (0 for one per CPU)', type=int, default=0)
+  parser.add_argument('--processes', dest='processes', help='Use processes instead of threads', action='store_true')
+  parser.add_argument('--max-in-flight', dest='max_in_flight', help='Files being transformed at a time (default: twice the workers)', type=int)
+  parser.add_argument('html', nargs='+')
+  args = parser.parse_args()
+  css = [style.read() for style in args.css or []]
+  if not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  failed = 0
+  for result in transform_files(args.html, args.output_dir, css, None, args.processes and 'processes' or 'threads',
+                                args.jobs or None, args.max_in_flight):
+    if result.error is not None:
+      failed += 1
+      print >> sys.stderr, 'ERROR: %s: %s' % (result.name, result.error)
+  return failed and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(main())
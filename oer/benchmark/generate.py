@@ -0,0 +1,67 @@
+""" Synthetic textbooks for the benchmarks: numbered chapters, sections and figures,
+    cross-references between them, pseudo elements, exercises moved to the end of
+    every chapter (move-to) and a stylesheet padded with rules that do not match """
+import random
+
+# The CSS every book uses (the numbering a textbook typically has)
+BASE_CSS = """
+body { counter-reset: chapter; }
+div.chapter { counter-increment: chapter; counter-reset: section figure exercise; }
+div.chapter > h1::before { content: "Chapter " counter(chapter) ": "; }
+div.section { counter-increment: section; }
+div.section > h2::before { content: counter(chapter) "." counter(section) " "; }
+figure { counter-increment: figure; }
+figure > figcaption::before { content: "Figure " counter(chapter) "." counter(figure) " "; }
+a.xref { content: "Figure " target-counter(attr(href), chapter) "." target-counter(attr(href), figure); }
+a.title-ref { content: target-text(attr(href), content()); }
+"""
+
+MOVE_CSS = """
+div.exercise { counter-increment: exercise; move-to: exercises; }
+div.exercise::before { content: counter(chapter) "." counter(exercise) ". "; }
+div.chapter::after { content: pending(exercises); }
+"""
+
+def generate_book(chapters=10, sections=5, figures=4, xrefs=4, pseudo_rules=10, move_to=True, stylesheet_rules=100, seed=0):
+  """ Returns (html, css) for a book with that many chapters, sections per chapter, figures and
+      cross-references (half target-counter, half target-text) per section.
+      pseudo_rules extra ::before/::after rules match the paragraphs, move_to adds an exercise per
+      section that is moved to the end of its chapter and stylesheet_rules rules never match anything """
+  rand = random.Random(seed)
+  targets = [(c, s, f) for c in range(chapters) for s in range(sections) for f in range(figures)]
+  html = ['<html><head><title>Synthetic book</title></head><body>']
+  for c in range(chapters):
+    html.append('<div class="chapter" id="c%d"><h1>Chapter title %d</h1>' % (c, c))
+    for s in range(sections):
+      html.append('<div class="section" id="c%d-s%d"><h2>Section %d</h2>' % (c, s, s))
+      for f in range(figures):
+        html.append('<p class="para p%d">Some text with <em>emphasis</em> and <strong>strong</strong> words.</p>' % (f % max(pseudo_rules, 1)))
+        html.append('<figure id="c%d-s%d-f%d"><img src="f.png"/><figcaption>Caption %d</figcaption></figure>' % (c, s, f, f))
+      for x in range(xrefs):
+        if targets:
+          target = 'c%d-s%d-f%d' % rand.choice(targets)
+          if x % 2:
+            html.append('<p>See <a class="title-ref" href="#%s">the figure</a>.</p>' % target)
+          else:
+            html.append('<p>See <a class="xref" href="#%s">the figure</a>.</p>' % target)
+      if move_to:
+        html.append('<div class="exercise"><p>Exercise for section %d.</p></div>' % s)
+      html.append('</div>')
+    html.append('</div>')
+  html.append('</body></html>')
+
+  css = [BASE_CSS]
+  if move_to:
+    css.append(MOVE_CSS)
+  for i in range(pseudo_rules):
+    css.append('p.p%d::%s { content: "[%d]"; }' % (i, i % 2 and 'after' or 'before', i))
+  for i in range(stylesheet_rules):
+    css.append('div.unused-%d > p.never-%d { color: red; content: "never"; }' % (i, i))
+  return (''.join(html), '\n'.join(css))
+
+# Named parameter sets for run.py
+SCENARIOS = {
+  'small':  dict(chapters=2,  sections=3,  figures=3, xrefs=2, pseudo_rules=4,  move_to=True, stylesheet_rules=20),
+  'medium': dict(chapters=10, sections=5,  figures=4, xrefs=4, pseudo_rules=10, move_to=True, stylesheet_rules=100),
+  'large':  dict(chapters=30, sections=10, figures=5, xrefs=6, pseudo_rules=20, move_to=True, stylesheet_rules=500),
+}
@@ -0,0 +1,118 @@
+""" Times the passes of AddNumbering.transform on synthetic books (see generate.py) and writes the
+    results as JSON so they can be compared across commits:
+
+      python benchmark/run.py -o before.json
+      python benchmark/run.py --baseline before.json --threshold 0.1
+
+    exits with 1 if any scenario got more than 10% slower than in before.json.
+    Every scenario runs in its own process so the peak RSS is the scenario's. """
+import os
+import sys
+import json
+import time
+import resource
+import platform
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lxml import etree
+from epubcss import AddNumbering
+from custom.util import Stats
+from benchmark.generate import generate_book, SCENARIOS
+
+# The passes of AddNumbering.transform (see custom.util.Stats), in order
+PASSES = ('premailer', 'find_targets', 'generate', 'resolve_targets', 'move', 'cleanup', 'serialize')
+
+def time_transform(html, sheet):
+  """ One AddNumbering.transform of html and its serialization. Returns {pass: seconds} (0 for a pass that did not run) """
+  numbering = AddNumbering(None)
+  stats = numbering.stats = Stats()
+  tree = numbering.transform(html, sheet, pretty_print=False)
+  stats.start()
+  etree.tostring(tree, encoding='ascii')
+  stats.lap('serialize')
+  return dict((name, stats.seconds.get(name, 0.0)) for name in PASSES)
+
+def run_scenario(params, repeat):
+  """ The best time of every pass over repeat runs, docs/sec, elements/sec and the peak RSS (in KB) """
+  (html, css) = generate_book(**params)
+  elements = len(etree.HTML(html).xpath('//*'))
+  start = time.time()
+  sheet = AddNumbering(None).compile_stylesheet(css)
+  compile_time = time.time() - start
+  best = None
+  for _ in range(repeat):
+    timings = time_transform(html, sheet)
+    if best is None or sum(timings.values()) < sum(best.values()):
+      best = timings
+  total = sum(best.values())
+  return {
+    'params': params,
+    'elements': elements,
+    'compile': compile_time,
+    'passes': best,
+    'total': total,
+    'docs_per_sec': 1 / total,
+    'elements_per_sec': elements / total,
+    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+  }
+
+def _run_in_child(queue, params, repeat):
+  queue.put(run_scenario(params, repeat))
+
+def run_isolated(params, repeat):
+  """ run_scenario in a new process """
+  queue = multiprocessing.Queue()
+  process = multiprocessing.Process(target=_run_in_child, args=(queue, params, repeat))
+  process.start()
+  result = queue.get()
+  process.join()
+  return result
+
+def compare(results, baseline, threshold):
+  """ The scenarios that are more than threshold (0.1 for 10%) slower than in baseline """
+  regressions = []
+  for (name, result) in sorted(results['scenarios'].items()):
+    before = baseline['scenarios'].get(name)
+    if before is not None and result['total'] > before['total'] * (1 + threshold):
+      regressions.append((name, before['total'], result['total']))
+  return regressions
+
+def _commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description='Benchmark AddNumbering.transform on synthetic books')
+  parser.add_argument('-s', dest='scenarios', help='Scenarios to run (%s)' % ', '.join(sorted(SCENARIOS)), nargs='*', default=['small', 'medium'])
+  parser.add_argument('-n', dest='repeat', help='Runs per scenario (the best one is kept)', type=int, default=3)
+  parser.add_argument('-o', dest='output', help='Write the results to this JSON file', type=argparse.FileType('w'))
+  parser.add_argument('--baseline', help='Results of an earlier run to compare to', type=argparse.FileType('r'))
+  parser.add_argument('--threshold', help='Fail if a scenario is this much slower than the baseline (0.1 is 10%%)', type=float, default=0.1)
+  args = parser.parse_args()
+
+  results = {'commit': _commit(), 'python': platform.python_version(), 'lxml': etree.__version__, 'scenarios': {}}
+  for name in args.scenarios:
+    result = run_isolated(SCENARIOS[name], args.repeat)
+    results['scenarios'][name] = result
+    print >> sys.stderr, '%-8s %8.3fs %8.1f docs/s %10.0f elements/s %8d KB  (%s)' % (name, result['total'],
+      result['docs_per_sec'], result['elements_per_sec'], result['peak_rss_kb'],
+      ', '.join(['%s %.3f' % (p, result['passes'][p]) for p in PASSES]))
+  if args.output:
+    json.dump(results, args.output, indent=2, sort_keys=True)
+
+  if args.baseline:
+    regressions = compare(results, json.load(args.baseline), args.threshold)
+    for (name, before, after) in regressions:
+      print >> sys.stderr, 'REGRESSION %s: %.3fs -> %.3fs' % (name, before, after)
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
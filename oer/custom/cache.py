@@ -0,0 +1,173 @@
+""" Small, thread-safe caches that are shared by every transform in the process
+    (and DiskCache, that is shared by processes) """
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+  """ A bounded least-recently-used cache.
+      Keeps hit/miss/eviction counters so the size can be tuned (see stats()) """
+
+  def __init__(self, maxsize=1024):
+    self.maxsize = maxsize
+    self._lock = threading.Lock()
+    self._items = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._items.pop(key)
+      except KeyError:
+        self.misses += 1
+        return default
+      self._items[key] = value # move to the most-recently-used end
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self._lock:
+      if key in self._items:
+        del self._items[key]
+      self._items[key] = value
+      while len(self._items) > self.maxsize:
+        self._items.popitem(last=False)
+        self.evictions += 1
+
+  def get_or_compute(self, key, compute):
+    """ Return the cached value for key, calling compute(key) on a miss.
+        compute runs outside the lock so a slow computation does not block readers;
+        two threads racing on the same key both compute and the last one wins """
+    missing = _MISSING
+    value = self.get(key, missing)
+    if value is missing:
+      value = compute(key)
+      self.put(key, value)
+    return value
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+      self.hits = self.misses = self.evictions = 0
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+              'size': len(self._items), 'maxsize': self.maxsize}
+
+  def __len__(self):
+    return len(self._items)
+
+  def __contains__(self, key):
+    return key in self._items
+
+_MISSING = object()
+
+
+class DiskCache(object):
+  """ Values (strings) in files named by their key in a directory, bounded to max_bytes by removing the
+      least-recently-used files (a hit touches the file). Writes are atomic (a temporary file renamed into
+      place) so many processes can share the directory. Keeps hit/miss/eviction counters like LRUCache """
+
+  def __init__(self, directory, max_bytes=256 * 1024 * 1024, suffix='.cache'):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.suffix = suffix
+    self._lock = threading.Lock()
+    self._size = None # bytes in the directory, counted on the first put
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.writes = 0
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + self.suffix)
+
+  def get(self, key, default=None):
+    path = self._path(key)
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      with self._lock:
+        self.misses += 1
+      return default
+    try:
+      value = f.read()
+    finally:
+      f.close()
+    try:
+      os.utime(path, None) # most recently used
+    except OSError:
+      pass # evicted by another process in between
+    with self._lock:
+      self.hits += 1
+    return value
+
+  def put(self, key, value):
+    if not os.path.isdir(self.directory):
+      try:
+        os.makedirs(self.directory)
+      except OSError:
+        if not os.path.isdir(self.directory):
+          raise
+    path = self._path(key)
+    (fd, tmp) = tempfile.mkstemp(dir=self.directory, prefix='.tmp-', suffix=self.suffix)
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+        f.write(value)
+      finally:
+        f.close()
+      try:
+        replaced = os.stat(path).st_size # the value that is written over
+      except OSError:
+        replaced = 0
+      os.rename(tmp, path)
+    except:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      raise
+    with self._lock:
+      self.writes += 1
+      if self._size is None:
+        self._size = sum([size for (_, size, _) in self._entries()])
+      else:
+        self._size += len(value) - replaced
+      if self._size > self.max_bytes:
+        self._evict()
+
+  def _entries(self):
+    """ [(mtime, size, path)] of the values in the directory """
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith(self.suffix) and not name.startswith('.tmp-'):
+        path = os.path.join(self.directory, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+  def _evict(self):
+    # Other processes write to the directory too so count again
+    entries = sorted(self._entries())
+    size = sum([size for (_, size, _) in entries])
+    for (_, file_size, path) in entries:
+      if size <= self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      size -= file_size
+      self.evictions += 1
+    self._size = size
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'writes': self.writes,
+              'size': self._size, 'max_bytes': self.max_bytes}
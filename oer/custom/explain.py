@@ -0,0 +1,127 @@
+""" Where the time of matching a stylesheet goes.
+
+    Set Premailer's explain (or AddNumbering.explain) to an Explain and every document it transforms
+    also measures each rule on its own: the XPath lxml translated the selector to, the time that XPath
+    takes, the time match_rules spends matching the rule natively (for the selectors it can), the time
+    merging the declarations into the matched elements takes and how many elements matched.
+    Over a corpus this finds the expensive selectors and the rules that never match anything. """
+import time
+
+from matching import inventory, matches
+from util import StyleStore
+
+__all__ = ['Explain', 'RuleCost', 'SORT_KEYS']
+
+class RuleCost(object):
+  """ The cost of one rule (a selector and pseudo element) summed over the documents it was measured on """
+  __slots__ = ('selector', 'class_', 'xpath', 'native', 'documents', 'matched',
+               'xpath_seconds', 'native_seconds', 'merge_seconds')
+
+  def __init__(self, rule):
+    self.selector = rule.selector
+    self.class_ = rule.class_
+    self.xpath = rule.xpath
+    self.native = rule.match_plan is not None
+    self.documents = 0
+    self.matched = 0
+    self.xpath_seconds = 0.0
+    self.native_seconds = 0.0
+    self.merge_seconds = 0.0
+
+  @property
+  def match_seconds(self):
+    """ What matching costs in match_rules: the native matching if the selector has a plan, the XPath otherwise """
+    if self.native:
+      return self.native_seconds
+    return self.xpath_seconds
+
+  @property
+  def seconds(self):
+    return self.match_seconds + self.merge_seconds
+
+  def as_dict(self):
+    return {
+      'selector': self.selector + self.class_,
+      'xpath': self.xpath,
+      'native': self.native,
+      'documents': self.documents,
+      'matched': self.matched,
+      'never_matched': not self.matched,
+      'seconds': self.seconds,
+      'match_seconds': self.match_seconds,
+      'xpath_seconds': self.xpath_seconds,
+      'native_seconds': self.native_seconds,
+      'merge_seconds': self.merge_seconds,
+    }
+
+# What report() can sort by (the biggest first, except for 'selector')
+SORT_KEYS = ('seconds', 'match_seconds', 'xpath_seconds', 'native_seconds', 'merge_seconds', 'matched', 'selector')
+
+class Explain(object):
+
+  def __init__(self):
+    self.costs = {} # (selector, class_, declarations) -> RuleCost
+    self.order = [] # the RuleCosts in the order their rules were first seen
+
+  def measure(self, page, rules, select):
+    """ Measures the rules (that apply) on the document page.
+        select(rule) returns the rule's XPath selector (see premailer.compile_selector) """
+    (elements, tags, classes, ids) = inventory(page)
+    store = StyleStore() # a scratch one so the merges do not touch the real styles
+    for rule in rules:
+      key = (rule.selector, rule.class_, rule.style)
+      cost = self.costs.get(key)
+      if cost is None:
+        cost = self.costs[key] = RuleCost(rule)
+        self.order.append(cost)
+      cost.documents += 1
+      (required_tags, required_classes, required_ids) = rule.requires
+      if not (tags.issuperset(required_tags) and classes.issuperset(required_classes) and ids.issuperset(required_ids)):
+        continue # match_rules drops it without matching anything
+
+      start = time.time()
+      nodes = select(rule)(page)
+      cost.xpath_seconds += time.time() - start
+
+      if rule.match_plan is not None:
+        candidates = _bucket(elements, rule.key)
+        start = time.time()
+        for element in candidates:
+          matches(rule.match_plan, element)
+        cost.native_seconds += time.time() - start
+
+      start = time.time()
+      for element in nodes:
+        store.merge(element, rule.declarations, rule.class_, rule.parsed)
+      cost.merge_seconds += time.time() - start
+      cost.matched += len(nodes)
+
+  def report(self, sort = 'seconds'):
+    """ The RuleCosts sorted by one of SORT_KEYS """
+    if sort == 'selector':
+      return sorted(self.order, key=lambda cost: cost.selector + cost.class_)
+    return sorted(self.order, key=lambda cost: getattr(cost, sort), reverse=True)
+
+  def never_matched(self):
+    """ The RuleCosts of the rules that did not match anything in any document """
+    return [cost for cost in self.order if not cost.matched]
+
+  def format(self, sort = 'seconds'):
+    """ A table of report(sort) """
+    lines = ['%9s %9s %9s %9s %6s %8s  %s' % ('seconds', 'xpath', 'native', 'merge', 'docs', 'matched', 'selector')]
+    for cost in self.report(sort):
+      native = cost.native and '%9.4f' % cost.native_seconds or '%9s' % '-'
+      lines.append('%9.4f %9.4f %s %9.4f %6d %8s  %s' % (cost.seconds, cost.xpath_seconds, native, cost.merge_seconds,
+        cost.documents, cost.matched or 'NEVER', cost.selector + cost.class_))
+    return '\n'.join(lines)
+
+def _bucket(elements, key):
+  """ The elements (from matching.inventory) in the RuleIndex bucket of a rule with that key """
+  if key is None:
+    return [element for (element, _, _, _) in elements]
+  (kind, value) = key
+  if kind == 'tag':
+    return [element for (element, tag, _, _) in elements if tag == value]
+  if kind == 'id':
+    return [element for (element, _, id, _) in elements if id == value]
+  return [element for (element, _, _, classes) in elements if value in classes]
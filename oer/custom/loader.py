@@ -0,0 +1,163 @@
+""" Loads the external stylesheets (local files and http(s) URLs) Premailer applies.
+
+    The @imports are inlined (relative to the sheet that imports them; the media they are for are ignored
+    like @media is). A local file is only read again when its mtime changes, a URL is only fetched once:
+    it is kept in memory and, with a cache_dir, on disk for the next process. URLs under a mirrored prefix
+    are read from a local directory instead so a run never waits on (or fails because of) the network:
+
+      loader = StylesheetLoader(mirrors={'http://example.com/css/': '/srv/mirror/css'}, cache_dir='/tmp/css')
+      [book_css, print_css] = loader.load_many(['http://example.com/css/book.css', 'print.css'])
+"""
+import os
+import re
+import socket
+import urllib2
+import hashlib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from cache import LRUCache, DiskCache
+
+__all__ = ['StylesheetLoader', 'LoaderError', 'DEFAULT_LOADER']
+
+_css_comments = re.compile(r'/\*.*?\*/', re.MULTILINE | re.DOTALL)
+# @import url("a.css") print; or @import 'a.css';
+_imports = re.compile(r'''@import\s+(?:url\(\s*(['"]?)(.*?)\1\s*\)|(['"])(.*?)\3)[^;]*;''')
+
+
+class LoaderError(ValueError):
+  """ A stylesheet could not be found or fetched """
+
+
+class StylesheetLoader(object):
+  """ Loads stylesheets by path or URL (see the module docstring).
+      - mirrors:   {URL prefix: local directory} to read those URLs from
+      - cache_dir: a directory to keep the fetched URLs in (see DiskCache)
+      - offline:   never use the network (a URL that is neither mirrored nor cached is an error)
+      - workers:   the threads load_many fetches with """
+
+  def __init__(self, mirrors=None, cache_dir=None, offline=False, timeout=30, workers=4, maxsize=256):
+    # The longest prefix wins
+    self.mirrors = sorted((mirrors or {}).items(), key=lambda (prefix, _): -len(prefix))
+    self.disk = None
+    if cache_dir:
+      self.disk = DiskCache(cache_dir, suffix='.css')
+    self.offline = offline
+    self.timeout = timeout
+    self.workers = workers
+    self._files = LRUCache(maxsize) # path -> (mtime, css) of one file (the @imports not inlined)
+    self._urls = LRUCache(maxsize) # url -> css
+    self.fetched = 0 # URLs read from the network
+
+  def load(self, location):
+    """ The CSS of a path or URL with the @imports inlined """
+    return self._load(location, ())
+
+  def load_many(self, locations):
+    """ load() for every location, concurrently. Returns the CSS in the same order """
+    locations = list(locations)
+    if len(locations) < 2 or self.workers < 2:
+      return [self.load(location) for location in locations]
+    pool = ThreadPool(min(self.workers, len(locations)))
+    try:
+      return pool.map(self.load, locations)
+    finally:
+      pool.close()
+      pool.join()
+
+  def inline_imports(self, css, base):
+    """ css (read from base, a path or URL) with its @imports inlined """
+    return self._inline(css, base, (base,))
+
+  def _load(self, location, seen):
+    if location in seen:
+      return '' # an @import cycle: the sheet is already being inlined
+    return self._inline(self._read(location), location, seen + (location,))
+
+  def _inline(self, css, base, seen):
+    if '@import' not in css:
+      return css
+    css = _css_comments.sub('', css)
+    def inline(match):
+      href = match.group(2) or match.group(4)
+      return self._load(_resolve(href, base), seen)
+    return _imports.sub(inline, css)
+
+  def _read(self, location):
+    """ The text of one stylesheet """
+    for (prefix, directory) in self.mirrors:
+      if location.startswith(prefix):
+        rest = urlparse.urlsplit(location[len(prefix):]).path # without the query
+        return self._read_file(_mirrored(directory, rest, location))
+    if _is_url(location):
+      return self._read_url(location)
+    return self._read_file(location)
+
+  def _read_file(self, path):
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      raise LoaderError(u"Could not find external style: %s" % path)
+    cached = self._files.get(path)
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+    f = open(path, 'rb')
+    try:
+      css = f.read()
+    finally:
+      f.close()
+    self._files.put(path, (mtime, css))
+    return css
+
+  def _read_url(self, url):
+    css = self._urls.get(url)
+    if css is not None:
+      return css
+    key = hashlib.sha1(url).hexdigest()
+    if self.disk is not None:
+      css = self.disk.get(key)
+    if css is None:
+      if self.offline:
+        raise LoaderError(u"Not fetching external style (offline): %s" % url)
+      try:
+        response = urllib2.urlopen(url, timeout=self.timeout)
+        try:
+          css = response.read()
+        finally:
+          response.close()
+      except (urllib2.URLError, socket.error), e:
+        raise LoaderError(u"Could not fetch external style: %s (%s)" % (url, e))
+      self.fetched += 1
+      if self.disk is not None:
+        self.disk.put(key, css)
+    self._urls.put(url, css)
+    return css
+
+  def clear(self):
+    """ Forgets the stylesheets kept in memory (not the ones on disk) """
+    self._files.clear()
+    self._urls.clear()
+
+
+def _is_url(location):
+  return location.startswith('http://') or location.startswith('https://')
+
+def _mirrored(directory, rest, location):
+  """ The path of rest (the part of location after a mirrored prefix) in directory.
+      It may not point out of the directory (with ../) """
+  directory = os.path.abspath(directory)
+  path = os.path.normpath(os.path.join(directory, *rest.split('/')))
+  if not path.startswith(os.path.join(directory, '')):
+    raise LoaderError(u"Not reading external style from outside of its mirror: %s" % location)
+  return path
+
+def _resolve(href, base):
+  """ The location of href (from an @import) in the stylesheet at base """
+  if _is_url(href):
+    return href
+  if _is_url(base):
+    return urlparse.urljoin(base, href)
+  return os.path.join(os.path.dirname(base), href)
+
+# Used by Premailer when it is not given a loader (so the stylesheets are shared by all the transforms in the process)
+DEFAULT_LOADER = StylesheetLoader()
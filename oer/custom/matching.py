@@ -0,0 +1,304 @@
+""" Matches all the rules of a stylesheet in one walk over the document.
+
+    Rules are bucketed by the id, class or tag of their rightmost compound selector
+    (or go in the "universal" bucket) so every element is only tested against the rules
+    that could possibly match it. Simple selectors (tags, #ids, .classes, [attributes] and
+    the ' ', '>', '+', '~' combinators) are matched natively, right-to-left, with exactly the
+    semantics of the XPath lxml.cssselect generates for them. Anything else (pseudo-classes,
+    :not(), namespaces) is matched with the rule's XPath once and looked up during the walk. """
+import re
+
+from lxml.cssselect import parse, Element, Class, Hash, Attrib, Pseudo, Function, CombinedSelector, \
+     SelectorSyntaxError, ExpressionError
+
+__all__ = ['analyze_selector', 'inventory', 'match_rules', 'RuleIndex']
+
+_split_xml_space = re.compile(r'[ \t\r\n]+').split
+# lxml.cssselect translates a selector that is only a tag (or tag#id, tag.class) without parsing it and keeps
+# the case of the tag (SPAN is descendant-or-self::SPAN); everywhere else the tags are lowercased
+_unparsed = re.compile(r'^(\w+|\w*[#.]\w+)\s*$', re.UNICODE)
+
+def _normalize_space(value):
+  return ' '.join([x for x in _split_xml_space(value) if x])
+
+
+def analyze_selector(selector):
+  """ Returns (plan, key, requires) for a selector:
+      - plan:     [(compound, combinator), ...] from the rightmost compound to the leftmost
+                  (None if it can not be matched natively)
+                  compound is (tag or None, ids, classes, [(attribute, operator, value)])
+      - key:      ('id', x), ('class', x), ('tag', x) or None for the rightmost compound
+      - requires: (tags, classes, ids) that must all occur in a document for it to match """
+  try:
+    tree = parse(selector)
+  except (SelectorSyntaxError, ExpressionError, AssertionError):
+    return (None, None, ((), (), ()))
+  case = _unparsed.search(selector) and unicode or unicode.lower
+  requires = (set(), set(), set())
+  _collect_requires(tree, requires, case)
+  requires = tuple(tuple(sorted(x)) for x in requires)
+
+  rightmost = tree
+  while isinstance(rightmost, CombinedSelector):
+    rightmost = rightmost.subselector
+  simple = (set(), set(), set())
+  _collect_requires(rightmost, simple, case)
+  (tags, classes, ids) = simple
+  key = None
+  if ids:
+    key = ('id', sorted(ids)[0])
+  elif classes:
+    key = ('class', sorted(classes)[0])
+  elif tags:
+    key = ('tag', sorted(tags)[0])
+
+  plan = []
+  try:
+    _build_plan(tree, plan, case)
+  except _NotNative:
+    plan = None
+  return (plan, key, requires)
+
+def _collect_requires(selector, requires, case):
+  (tags, classes, ids) = requires
+  if isinstance(selector, CombinedSelector):
+    _collect_requires(selector.selector, requires, case)
+    _collect_requires(selector.subselector, requires, case)
+  elif isinstance(selector, Element):
+    if selector.namespace == '*' and selector.element != '*':
+      tags.add(case(unicode(selector.element)))
+  elif isinstance(selector, Class):
+    classes.add(unicode(selector.class_name))
+    _collect_requires(selector.selector, requires, case)
+  elif isinstance(selector, Hash):
+    ids.add(unicode(selector.id))
+    _collect_requires(selector.selector, requires, case)
+  elif isinstance(selector, Attrib):
+    _collect_requires(selector.selector, requires, case)
+  elif isinstance(selector, Pseudo):
+    _collect_requires(selector.element, requires, case)
+  elif isinstance(selector, Function):
+    # Do not look inside the arguments (they may be negated with :not())
+    _collect_requires(selector.selector, requires, case)
+  # Anything else (Or, ...) does not require anything
+
+class _NotNative(Exception): pass
+
+def _build_plan(selector, plan, case):
+  # Each compound is stored with the combinator that joins it to the compound on its left
+  while isinstance(selector, CombinedSelector):
+    plan.append((_compound(selector.subselector, case), str(selector.combinator)))
+    selector = selector.selector
+  plan.append((_compound(selector, case), None))
+
+def _compound(selector, case):
+  ids = []
+  classes = []
+  attribs = []
+  while not isinstance(selector, Element):
+    if isinstance(selector, Class):
+      classes.append(unicode(selector.class_name))
+    elif isinstance(selector, Hash):
+      ids.append(unicode(selector.id))
+    elif isinstance(selector, Attrib) and selector.namespace == '*' and selector.operator in _ATTRIB_OPERATORS:
+      value = selector.value
+      if value is not None:
+        value = unicode(value)
+      attribs.append((unicode(selector.attrib), str(selector.operator), value))
+    else:
+      raise _NotNative()
+    selector = selector.selector
+  if selector.namespace != '*':
+    raise _NotNative()
+  tag = None
+  if selector.element != '*':
+    tag = case(unicode(selector.element))
+  # The conditions were collected right-to-left
+  ids.reverse(); classes.reverse(); attribs.reverse()
+  return (tag, tuple(ids), tuple(classes), tuple(attribs))
+
+
+def _attrib_exists(actual, value):
+  return actual is not None
+def _attrib_equals(actual, value):
+  return actual == value
+def _attrib_includes(actual, value):
+  # contains(concat(' ', normalize-space(@x), ' '), ' value ')
+  return (' %s ' % value) in (' %s ' % _normalize_space(actual or ''))
+def _attrib_dash_match(actual, value):
+  return actual is not None and (actual == value or actual.startswith(value + '-'))
+# A missing attribute is the empty string to starts-with(), substring() and contains()
+# so an empty value matches every element
+def _attrib_prefix(actual, value):
+  return (actual or '').startswith(value)
+def _attrib_suffix(actual, value):
+  return (actual or '').endswith(value)
+def _attrib_substring(actual, value):
+  return value in (actual or '')
+def _attrib_not_equal(actual, value):
+  if value:
+    return actual is None or actual != value
+  return actual is not None and actual != value
+
+_ATTRIB_OPERATORS = {
+  'exists': _attrib_exists,
+  '=':      _attrib_equals,
+  '~=':     _attrib_includes,
+  '|=':     _attrib_dash_match,
+  '^=':     _attrib_prefix,
+  '$=':     _attrib_suffix,
+  '*=':     _attrib_substring,
+  '!=':     _attrib_not_equal,
+}
+
+def _compound_matches(compound, element):
+  (tag, ids, classes, attribs) = compound
+  if tag is not None and element.tag != tag:
+    return False
+  for id in ids:
+    if element.get('id') != id:
+      return False
+  if classes:
+    class_ = ' %s ' % _normalize_space(element.get('class') or '')
+    for c in classes:
+      if (' %s ' % c) not in class_:
+        return False
+  for (name, operator, value) in attribs:
+    if not _ATTRIB_OPERATORS[operator](element.get(name), value):
+      return False
+  return True
+
+def _previous_element(element):
+  element = element.getprevious()
+  while element is not None and not isinstance(element.tag, basestring):
+    element = element.getprevious()
+  return element
+
+def matches(plan, element, i = 0):
+  """ Whether element matches the selector plan (see analyze_selector) """
+  (compound, combinator) = plan[i]
+  if not _compound_matches(compound, element):
+    return False
+  if combinator is None:
+    return True
+  if combinator == '>':
+    parent = element.getparent()
+    return parent is not None and matches(plan, parent, i + 1)
+  if combinator == ' ':
+    parent = element.getparent()
+    while parent is not None:
+      if matches(plan, parent, i + 1):
+        return True
+      parent = parent.getparent()
+    return False
+  if combinator == '+':
+    sibling = _previous_element(element)
+    return sibling is not None and matches(plan, sibling, i + 1)
+  if combinator == '~':
+    sibling = _previous_element(element)
+    while sibling is not None:
+      if matches(plan, sibling, i + 1):
+        return True
+      sibling = _previous_element(sibling)
+    return False
+  raise ExpressionError("Unknown combinator: %r" % combinator)
+
+
+def inventory(root):
+  """ One walk over the document.
+      Returns ([(element, tag, id, classes)] in document order, tags, classes, ids) """
+  elements = []
+  tags = set()
+  all_classes = set()
+  ids = set()
+  for element in root.iter():
+    tag = element.tag
+    if not isinstance(tag, basestring):
+      continue # Comments and processing instructions
+    id = element.get('id')
+    classes = element.get('class')
+    if classes:
+      classes = set(_split_xml_space(classes))
+      classes.discard('')
+      all_classes.update(classes)
+    else:
+      classes = ()
+    tags.add(tag)
+    if id is not None:
+      ids.add(id)
+    elements.append((element, tag, id, classes))
+  return (elements, tags, all_classes, ids)
+
+class RuleIndex(object):
+  """ Rules bucketed by the id, class or tag of their rightmost compound selector.
+      Positions (any sortable value) give the cascade order of the rules """
+  def __init__(self):
+    self.by_id = {}
+    self.by_class = {}
+    self.by_tag = {}
+    self.universal = []
+
+  def add(self, position, rule):
+    if rule.key is None:
+      self.universal.append((position, rule))
+    else:
+      (kind, value) = rule.key
+      bucket = {'id': self.by_id, 'class': self.by_class, 'tag': self.by_tag}[kind]
+      bucket.setdefault(value, []).append((position, rule))
+
+  def candidates(self, tag, id, classes):
+    """ [(position, rule)] in cascade order for the rules that could match an element """
+    candidates = list(self.universal)
+    if tag in self.by_tag:
+      candidates.extend(self.by_tag[tag])
+    if id is not None and id in self.by_id:
+      candidates.extend(self.by_id[id])
+    for c in classes:
+      if c in self.by_class:
+        candidates.extend(self.by_class[c])
+    candidates.sort()
+    return candidates
+
+  def match(self, element):
+    """ The rules (that can all be matched natively) that match element, in cascade order """
+    classes = element.get('class')
+    if classes:
+      classes = set(_split_xml_space(classes))
+    else:
+      classes = ()
+    return [rule for (_, rule) in self.candidates(element.tag, element.get('id'), classes)
+            if matches(rule.match_plan, element)]
+
+def match_rules(root, rules, select):
+  """ Yields (element, [rules that match it, in cascade order]) for every element in document order
+      that matches at least one rule.
+      Rules are stylesheet.Rule objects (with match_plan, key and requires).
+      select(rule) returns the XPath selector for rules that can not be matched natively. """
+  (elements, tags, classes, ids) = inventory(root)
+  index = RuleIndex()
+  matched_by_xpath = {}
+  for (position, rule) in enumerate(rules):
+    (required_tags, required_classes, required_ids) = rule.requires
+    # Drop the rules that can not match anything in this document
+    if not (tags.issuperset(required_tags) and classes.issuperset(required_classes) and ids.issuperset(required_ids)):
+      continue
+    if rule.match_plan is None:
+      found = set(select(rule)(root))
+      if not found:
+        continue
+      matched_by_xpath[position] = found
+    index.add(position, rule)
+
+  for (element, tag, id, element_classes) in elements:
+    candidates = index.candidates(tag, id, element_classes)
+    if not candidates:
+      continue
+    found = []
+    for (position, rule) in candidates:
+      if rule.match_plan is None:
+        if element in matched_by_xpath[position]:
+          found.append(rule)
+      elif matches(rule.match_plan, element):
+        found.append(rule)
+    if found:
+      yield (element, found)
@@ -1,5 +1,9 @@
-"""Various Number-to-string conversions"""
-import string
+# -*- coding: utf-8 -*-
+"""Various Number-to-string conversions
+
+A small CSS Counter Styles Level 3 engine (http://www.w3.org/TR/css-counter-styles-3/):
+every predefined style is a CounterStyle built once from a table of symbols, and
+toString(n, style_name) formats a counter value with it."""
 
 class OutOfRangeError(Exception): pass
 class NotIntegerError(Exception): pass
@@ -7,48 +11,205 @@ class InvalidFormatError(Exception): pass
 
 #Define digit mapping
 romanNumeralMap = (('M',  1000),
-				   ('CM', 900),
-				   ('D',  500),
-				   ('CD', 400),
-				   ('C',  100),
-				   ('XC', 90),
-				   ('L',  50),
-				   ('XL', 40),
-				   ('X',  10),
-				   ('IX', 9),
-				   ('V',  5),
-				   ('IV', 4),
-				   ('I',  1))
+                   ('CM', 900),
+                   ('D',  500),
+                   ('CD', 400),
+                   ('C',  100),
+                   ('XC', 90),
+                   ('L',  50),
+                   ('XL', 40),
+                   ('X',  10),
+                   ('IX', 9),
+                   ('V',  5),
+                   ('IV', 4),
+                   ('I',  1))
 
 def toRoman(n):
-	"""convert integer to Roman numeral. From http://www.diveintopython.net/unit_testing/romantest.html """
-	if not (0 < n < 5000):
-		raise OutOfRangeError, "number out of range (must be 1..4999)"
+  """convert integer to Roman numeral. From http://www.diveintopython.net/unit_testing/romantest.html """
+  if not (0 < n < 5000):
+    raise OutOfRangeError, "number out of range (must be 1..4999)"
+  return _additive(n, [(integer, numeral) for (numeral, integer) in romanNumeralMap])
+
+def _additive(n, symbols):
+  # symbols are (weight, symbol) from the biggest weight to the smallest
+  result = []
+  for (weight, symbol) in symbols:
+    if weight == 0:
+      continue
+    if n >= weight:
+      (count, n) = divmod(n, weight)
+      result.append(symbol * count)
+  if n:
+    return None # not representable
+  return ''.join(result)
+
+# Values below this are formatted once per style and then looked up
+MEMO_SIZE = 1024
+
+INFINITE = None
+
+class CounterStyle(object):
+  """ One counter style: a system ('cyclic', 'fixed', 'symbolic', 'alphabetic', 'numeric' or 'additive')
+      and its symbols (for 'additive', (weight, symbol) pairs from the biggest weight to the smallest).
+      Values outside of range (a (low, high) pair where either can be INFINITE) or that the system
+      can not represent use the fallback style. """
+  __slots__ = ('name', 'system', 'symbols', 'negative', 'pad', 'range', 'fallback', 'first', '_memo')
+
+  def __init__(self, name, system, symbols, negative='-', pad=None, range=None, fallback='decimal', first=1):
+    self.name = name
+    self.system = system
+    self.symbols = tuple(symbols)
+    self.negative = negative
+    self.pad = pad # (minimum length, symbol)
+    if range is None:
+      range = _DEFAULT_RANGES[system]
+    self.range = range
+    self.fallback = fallback
+    self.first = first # the value of the first symbol (fixed only)
+    self._memo = {}
+
+  def format(self, n):
+    if 0 <= n < MEMO_SIZE:
+      text = self._memo.get(n)
+      if text is None:
+        text = self._memo[n] = self._format(n)
+      return text
+    return self._format(n)
+
+  def _format(self, n):
+    (low, high) = self.range
+    text = None
+    if (low is INFINITE or n >= low) and (high is INFINITE or n <= high):
+      negative = n < 0 and self.system in _NEGATIVE_SYSTEMS
+      text = _SYSTEMS[self.system](self, abs(n) if negative else n)
+      if text is not None:
+        # The negative sign counts towards the pad width
+        width = len(text)
+        if negative:
+          width += len(self.negative)
+        if self.pad is not None and width < self.pad[0]:
+          text = self.pad[1] * (self.pad[0] - width) + text
+        if negative:
+          text = self.negative + text
+    if text is None:
+      if self.name == self.fallback:
+        return str(n)
+      return get_style(self.fallback).format(n)
+    return text
+
+def _cyclic(style, n):
+  symbols = style.symbols
+  return symbols[(n - 1) % len(symbols)]
+
+def _fixed(style, n):
+  i = n - style.first
+  if 0 <= i < len(style.symbols):
+    return style.symbols[i]
+
+def _symbolic(style, n):
+  if n < 1:
+    return None
+  symbols = style.symbols
+  (repeat, i) = divmod(n - 1, len(symbols))
+  return symbols[i] * (repeat + 1)
+
+def _alphabetic(style, n):
+  # Bijective base N: a, b, ..., z, aa, ab, ...
+  if n < 1:
+    return None
+  symbols = style.symbols
+  base = len(symbols)
+  digits = []
+  while n:
+    (n, i) = divmod(n - 1, base)
+    digits.append(symbols[i])
+  digits.reverse()
+  return ''.join(digits)
+
+def _numeric(style, n):
+  symbols = style.symbols
+  base = len(symbols)
+  if n == 0:
+    return symbols[0]
+  digits = []
+  while n:
+    (n, i) = divmod(n, base)
+    digits.append(symbols[i])
+  digits.reverse()
+  return ''.join(digits)
+
+def _additive_system(style, n):
+  if n == 0:
+    for (weight, symbol) in style.symbols:
+      if weight == 0:
+        return symbol
+    return None
+  return _additive(n, style.symbols)
+
+_SYSTEMS = {
+  'cyclic': _cyclic,
+  'fixed': _fixed,
+  'symbolic': _symbolic,
+  'alphabetic': _alphabetic,
+  'numeric': _numeric,
+  'additive': _additive_system,
+}
+_NEGATIVE_SYSTEMS = ('symbolic', 'alphabetic', 'numeric', 'additive')
+_DEFAULT_RANGES = {
+  'cyclic': (INFINITE, INFINITE),
+  'fixed': (INFINITE, INFINITE),
+  'symbolic': (1, INFINITE),
+  'alphabetic': (1, INFINITE),
+  'numeric': (INFINITE, INFINITE),
+  'additive': (0, INFINITE),
+}
+
+_STYLES = {}
+
+def register(style, *aliases):
+  """ Makes the CounterStyle available to toString (under its name and the aliases) """
+  for name in (style.name,) + aliases:
+    _STYLES[name] = style
+  return style
+
+def get_style(name):
+  """ The CounterStyle called name ('decimal' if there is none, like CSS does) """
+  style = _STYLES.get(name)
+  if style is None:
+    style = _STYLES['decimal']
+  return style
 
-	result = ""
-	for numeral, integer in romanNumeralMap:
-		while n >= integer:
-			result += numeral
-			n -= integer
-	return result
+_LOWER_ROMAN = [(weight, numeral.lower()) for (numeral, weight) in romanNumeralMap]
 
+register(CounterStyle('decimal', 'numeric', '0123456789'))
+register(CounterStyle('decimal-leading-zero', 'numeric', '0123456789', pad=(2, '0')))
+register(CounterStyle('cjk-decimal', 'numeric', u'〇一二三四五六七八九'))
+register(CounterStyle('arabic-indic', 'numeric', u'٠١٢٣٤٥٦٧٨٩'))
+register(CounterStyle('devanagari', 'numeric', u'०१२३४५६७८९'))
+register(CounterStyle('upper-roman', 'additive', [(weight, numeral) for (numeral, weight) in romanNumeralMap], range=(1, 3999)))
+register(CounterStyle('lower-roman', 'additive', _LOWER_ROMAN, range=(1, 3999)))
+register(CounterStyle('lower-alpha', 'alphabetic', 'abcdefghijklmnopqrstuvwxyz'), 'lower-latin')
+register(CounterStyle('upper-alpha', 'alphabetic', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'), 'upper-latin')
+register(CounterStyle('lower-greek', 'alphabetic', u'αβγδεζηθικλμνξοπρστυφχψω'))
+register(CounterStyle('cjk-earthly-branch', 'alphabetic', u'子丑寅卯辰巳午未申酉戌亥'))
+register(CounterStyle('cjk-heavenly-stem', 'alphabetic', u'甲乙丙丁戊己庚辛壬癸'))
+register(CounterStyle('disc', 'cyclic', [u'•']))
+register(CounterStyle('circle', 'cyclic', [u'◦']))
+register(CounterStyle('square', 'cyclic', [u'▪']))
+register(CounterStyle('disclosure-open', 'cyclic', [u'▾']))
+register(CounterStyle('disclosure-closed', 'cyclic', [u'▸']))
+register(CounterStyle('upper-armenian', 'additive', zip(
+  [9000, 8000, 7000, 6000, 5000, 4000, 3000, 2000, 1000, 900, 800, 700, 600, 500, 400, 300, 200, 100,
+   90, 80, 70, 60, 50, 40, 30, 20, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1],
+  u'ՔՓՒՑՐՏՎՍՌՋՊՉՈՇՆՅՄՃ'
+  u'ՂՁՀԿԾԽԼԻԺԹԸԷԶԵԴԳԲԱ'), range=(1, 9999)))
+register(CounterStyle('lower-armenian', 'additive', [(weight, symbol.lower()) for (weight, symbol) in get_style('upper-armenian').symbols], range=(1, 9999)))
 
 def toString(n, format):
   if int(n) <> n:
     raise NotIntegerError, "non-integers can not be converted"
   if format == 'decimal' or not format:
     return str(n)
-  if format == 'upper-roman':
-    return toRoman(n)
-  elif format == 'lower-roman':
-    return toRoman(n).lower()
-  elif format in ('lower-latin', 'lower-alpha'):
-    if n > 25:
-      raise OutOfRhangeError, "only numbers up to 25 can be represented"
-    return string.ascii_lowercase[n - 1]
-  elif format in ('upper-latin', 'upper-alpha'):
-    if n > 25:
-      raise OutOfRhangeError, "only numbers up to 25 can be represented"
-    return string.ascii_uppercase[n - 1]
-  else:
-    raise InvalidFormatError, "this numbering format is not yes supported: %s" % str(format)
\ No newline at end of file
+  if format == 'none':
+    return ''
+  return get_style(format).format(n)
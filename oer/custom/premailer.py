@@ -6,20 +6,25 @@
 # - Search for HACK
 # -----------------------------------
 
-import codecs
+import copy
 from lxml import etree
 from lxml.cssselect import CSSSelector
 from lxml.cssselect import ExpressionError
 import sys
-import os
 import re
-import urllib
 import urlparse
 
-from util import ContentPropertyParser, parse_style
+from util import ContentPropertyParser, parse_style, split_declarations
+from cache import LRUCache
+from stylesheet import CompiledStylesheet, compile_stylesheet, \
+     parse_style_rules, should_apply_style, FILTER_PSEUDOSELECTORS, \
+     BASIC_HTML_PROPERTIES, _importants
+from matching import match_rules
+from loader import DEFAULT_LOADER
 
 __version__ = '1.11'
-__all__ = ['PremailerError', 'Premailer', 'transform']
+__all__ = ['PremailerError', 'Premailer', 'transform', 'compile_selector',
+           'SELECTOR_CACHE']
 
 
 class PremailerError(Exception):
@@ -97,14 +102,54 @@ def _merge_styles(old, new, class_=''):
         return ' '.join([x for x in all if x != '{}'])
 
 
-_css_comments = re.compile(r'/\*.*?\*/', re.MULTILINE | re.DOTALL)
-_regex = re.compile('((.*?){(.*?)})', re.DOTALL | re.M)
-_semicolon_regex = re.compile(';(\s+)')
-_colon_regex = re.compile(':(\s+)')
-_importants = re.compile('\s*!important')
-# These selectors don't apply to all elements. Rather, they specify
-# which elements to apply to.
-FILTER_PSEUDOSELECTORS = [':last-child', ':first-child', 'nth-child']
+# HACK: Compiled selectors are shared by every Premailer in the process so
+# one book stylesheet applied to many chapters only translates each selector
+# to XPath once. Selectors lxml can't compile are cached as None.
+SELECTOR_CACHE = LRUCache(maxsize=4096)
+
+
+def _compile_selector(key):
+    (selector, xpath) = key
+    try:
+        if xpath is None:
+            return CSSSelector(selector)
+        return etree.XPath(xpath)
+    except (ExpressionError, etree.XPathSyntaxError):
+        return None
+
+
+def compile_selector(selector, xpath=None):
+    """Return the (cached) CSSSelector for @selector or None when lxml
+    can not translate it.
+
+    If the selector was already translated (see stylesheet.Rule.xpath) pass
+    the XPath in so it is only compiled.
+    """
+    return SELECTOR_CACHE.get_or_compute((selector, xpath), _compile_selector)
+
+
+# Declarations that _basic_html_attributes turns into HTML attributes
+_basic_html_selector = re.compile(r'\[\s*(align|bgcolor|width|height)\b')
+
+
+def changes_matched_attributes(rules):
+    """Whether applying a rule can add an HTML attribute (align, bgcolor,
+    width, height) that another rule's selector tests for.
+
+    Then the rules have to be matched one after the other (like they always
+    were) instead of in one walk over the document.
+    """
+    selects = False
+    sets = False
+    for rule in rules:
+        if not rule.applies:
+            continue
+        if _basic_html_selector.search(rule.selector):
+            selects = True
+        if not rule.class_ and [k for (k, v) in rule.declarations
+                                if k.strip() in BASIC_HTML_PROPERTIES]:
+            sets = True
+    return selects and sets
 
 
 class Premailer(object):
@@ -119,7 +164,9 @@ class Premailer(object):
                  external_styles=None,
                  supported_properties=[],
                  supported_content=[],
-                 custom_style_attrib='style', explicit_styles=[], verbose=False): # HACK
+                 custom_style_attrib='style', explicit_styles=[], verbose=False, # HACK
+                 style_store=None, explain=None, stylesheet_loader=None,
+                 skip_inert=False):
         self.supported_properties = supported_properties
         self.supported_content = supported_content
         self.html = html
@@ -134,48 +181,46 @@ class Premailer(object):
         if isinstance(external_styles, basestring):
             external_styles = [external_styles]
         self.external_styles = external_styles
+        # A loader.StylesheetLoader to read the external_styles with
+        # (loader.DEFAULT_LOADER, shared by the process, if None)
+        self.stylesheet_loader = stylesheet_loader
         self.strip_important = strip_important
         # HACK: Added this customization
         self.custom_style_attrib = custom_style_attrib
         self.explicit_styles = explicit_styles
         self.verbose = verbose
+        # HACK: When a util.StyleStore is given the matched declarations are
+        # merged into it instead of being serialized into custom_style_attrib
+        self.style_store = style_store
+        # An explain.Explain to measure the cost of every rule in (or None)
+        self.explain = explain
+        # HACK: Do not match the rules without any stylesheet.FEATURE_*
+        # (their declarations are only merged into styles nothing reads)
+        self.skip_inert = skip_inert
+        self.page = None
+        # Filled in by transform: the rules that were (not) applied and
+        # the number of (element, rule) matches
+        self.applied_rules = 0
+        self.skipped_rules = 0
+        self.matches = 0
+        # The stylesheet.FEATURE_* flags of the rules that were applied
+        self.feature_mask = 0
 
     def _should_apply_style(self, style):
-        for key in self.supported_properties:
-          if self.supported_properties[key] == False:
-            return False
-        if 'content:' in style:
-          #TODO Should be if only these are in the content: 
-          for key in self.supported_content:
-            if not self.supported_content[key] and key in style:
-              return False
-        return True
+        return should_apply_style(style, self.supported_properties,
+                                  self.supported_content)
+
     def _parse_style_rules(self, css_body):
-        leftover = []
-        rules = []
-        css_body = _css_comments.sub('', css_body)
-        for each in _regex.findall(css_body.strip()):
-            __, selectors, bulk = each
-
-            bulk = _semicolon_regex.sub(';', bulk.strip())
-            bulk = _colon_regex.sub(':', bulk.strip())
-            if bulk.endswith(';'):
-                bulk = bulk[:-1]
-            for selector in [x.strip() for
-                             x in selectors.split(',') if x.strip() and
-                             not x.strip().startswith('@')]:
-                if (':' in selector and self.exclude_pseudoclasses and
-                    ':' + selector.split(':', 1)[1]
-                        not in FILTER_PSEUDOSELECTORS):
-                    # a pseudoclass
-                    leftover.append((selector, bulk))
-                    continue
-                elif selector == '*' and not self.include_star_selectors:
-                    continue
-
-                rules.append((selector, bulk))
-
-        return rules, leftover
+        return parse_style_rules(css_body, self.exclude_pseudoclasses,
+                                 self.include_star_selectors)
+
+    def _compile(self, css_body):
+        return compile_stylesheet(
+            css_body, supported_properties=self.supported_properties,
+            supported_content=self.supported_content,
+            exclude_pseudoclasses=self.exclude_pseudoclasses,
+            include_star_selectors=self.include_star_selectors,
+            strip_important=self.strip_important, verbose=self.verbose)
 
     def transform(self, pretty_print=True):
         """change the self.html and return it with CSS turned into style
@@ -184,6 +229,31 @@ class Premailer(object):
         if etree is None:
             return self.html
 
+        page = self._transform()
+        out = etree.tostring(page, pretty_print=pretty_print).replace(
+            '<head/>', '<head></head>')
+        if self.strip_important:
+            out = _importants.sub('', out)
+        return out
+
+    def transform_tree(self, pretty_print=True):
+        """Same as transform() but return the lxml tree instead of
+        serializing it, so it does not have to be parsed again.
+
+        The tree is the one parsing the transform() output would give: it
+        has no DOCTYPE and, with pretty_print, the same indentation.
+        !important is removed from the declarations (and the style
+        attributes) when they are parsed instead of from the whole output.
+        """
+        page = self._transform(as_tree=True)
+        attributes = ()
+        if self.strip_important:
+            attributes = ('style', self.custom_style_attrib)
+        finish_tree(page, pretty_print, attributes)
+        return page.getroottree()
+
+    def _transform(self, as_tree=False):
+        """Parse self.html, apply the CSS and return the root element"""
         parser = etree.HTMLParser() # etree.XMLParser()
         tree = etree.fromstring(self.html.strip(), parser).getroottree()
         page = tree.getroot()
@@ -192,6 +262,10 @@ class Premailer(object):
             print repr(self.html)
             raise PremailerError("Could not parse the html")
         assert page is not None
+        if as_tree:
+            # A copy is not attached to the HTML parser's DOCTYPE
+            page = copy.deepcopy(page)
+        self.page = page
 
         ##
         ## style selectors
@@ -199,93 +273,98 @@ class Premailer(object):
 
         rules = []
 
-        for style in CSSSelector('style')(page):
-            css_body = etree.tostring(style)
-            css_body = css_body.split('>')[1].split('</')[0]
-            these_rules, these_leftover = self._parse_style_rules(css_body)
-            rules.extend(these_rules)
-
-            parent_of_style = style.getparent()
-            if these_leftover:
-                style.text = '\n'.join(['%s {%s}' % (k, v) for
-                                        (k, v) in these_leftover])
-            elif not self.keep_style_tags:
-                parent_of_style.remove(style)
+        for style in compile_selector('style')(page):
+            sheet = self.style_element_sheet(style, as_tree)
+            rules.extend(sheet.rules)
+            if not sheet.leftover and not self.keep_style_tags:
+                style.getparent().remove(style)
 
         if self.external_styles:
-            for stylefile in self.external_styles:
-                # print stylefile # HACK
-                if stylefile.startswith('http://'):
-                    css_body = urllib.urlopen(stylefile).read()
-                elif os.path.exists(stylefile):
-                    try:
-                        f = codecs.open(stylefile)
-                        css_body = f.read()
-                    finally:
-                        f.close()
-                else:
-                    raise ValueError(u"Could not find external style: %s" %
-                                     stylefile)
-                these_rules, these_leftover = self._parse_style_rules(css_body)
-                rules.extend(these_rules)
+            stylesheet_loader = self.stylesheet_loader or DEFAULT_LOADER
+            for css_body in stylesheet_loader.load_many(self.external_styles):
+                sheet = self._compile(css_body)
+                rules.extend(sheet.rules)
 
-        if self.explicit_styles: # HACK for testing
-          for style in self.explicit_styles:
-            these_rules, _ = self._parse_style_rules(style)
-            rules.extend(these_rules)
+        rules.extend(self.explicit_rules())
+        select = lambda rule: compile_selector(rule.selector, rule.xpath)
+        if self.explain is not None:
+            self.explain.measure(page, list(self.applying(rules)), select)
 
         first_time = []
         first_time_styles = []
-        for selector, style in rules:
-            new_selector = selector
-            class_ = ''
-            # The ':not()' selector causes things to break
-            # becaue it can occur in the middle of a rule
-            # So, force "::" for before/after
-            if '::before' in selector or '::after' in selector:
-                new_selector, class_ = re.split('::', selector, 1)
-                class_ = ':%s' % class_
-
-            # Keep filter-type selectors untouched.
-            if class_ in FILTER_PSEUDOSELECTORS:
-                class_ = ''
-            else:
-                selector = new_selector
-
-            # HACK: Apply a style if:
-            # - it contains content: (pseudo elements, replacing content of existing elements)
-            # - manipulating counters
-            # AND: TODO (this will be fixed by _merge_styles using util.parse_style)
-            # - the property values don't contain unknown functions or the PDF-specific "page" counter
-            if self._should_apply_style(style):
-              if self.verbose: print >> sys.stderr, "Applying CSS Selector: [%s%s]" % (selector, class_),
-              try:
-                sel = CSSSelector(selector)
-              except ExpressionError:
-                if self.verbose: print >> sys.stderr, "Ignoring rule"
+        class_ = ''
+        if self.style_store is not None and \
+               not changes_matched_attributes(rules):
+            # Match every rule in one walk over the document (see matching.py)
+            counts = {}
+            applying = list(self.applying(rules))
+            for item, matched in match_rules(page, applying, select):
+                self.merge_matched(item, matched, first_time_styles)
+                for rule in matched:
+                    counts[rule] = counts.get(rule, 0) + 1
+            if self.verbose:
+                for rule in applying:
+                    print >> sys.stderr, "Applying CSS Selector: [%s%s] %d times" % (
+                        rule.selector, rule.class_, counts.get(rule, 0))
+            self.applied_rules += len(applying)
+            self.skipped_rules += len(rules) - len(applying)
+            self.matches += sum(counts.values())
+            rules = []
+
+        # HACK: Apply a style if:
+        # - it contains content: (pseudo elements, replacing content of existing elements)
+        # - manipulating counters
+        # AND: TODO (this will be fixed by _merge_styles using util.parse_style)
+        # - the property values don't contain unknown functions or the PDF-specific "page" counter
+        # (see stylesheet.should_apply_style and applying)
+        applying = list(self.applying(rules))
+        self.skipped_rules += len(rules) - len(applying)
+        for rule in applying:
+            selector, class_, style = rule.selector, rule.class_, rule.style
+            if self.verbose: print >> sys.stderr, "Applying CSS Selector: [%s%s]" % (selector, class_),
+            sel = compile_selector(selector, rule.xpath)
+            if sel is None:
+              if self.verbose: print >> sys.stderr, "Ignoring rule"
+              self.skipped_rules += 1
+              continue
+            nodes = sel(page)
+            if self.verbose: print >> sys.stderr, "%d times" % len(nodes)
+            self.applied_rules += 1
+            self.matches += len(nodes)
+
+            if self.style_store is not None:
+                for item in nodes:
+                    if item not in self.style_store:
+                        inline_style = item.attrib.get(
+                            self.custom_style_attrib, '')
+                        if inline_style:
+                            first_time_styles.append((item, inline_style))
+                    merged = self.style_store.merge(item, rule.declarations,
+                                                    class_, rule.parsed)
+                    if not class_:
+                        self._basic_html_attributes(item, merged.items(),
+                                                    force=True)
                 continue
-              nodes = sel(page)
-              if self.verbose: print >> sys.stderr, "%d times" % len(nodes)
-  
-              for item in nodes:
-                  old_style = item.attrib.get(self.custom_style_attrib, '') # HACK
-                  if not item in first_time:
-                      if old_style:
-                          new_style = _merge_styles(style, old_style, class_)
-                      else:
-                          new_style = _merge_styles(old_style, style, class_)
-                      first_time.append(item)
-                      first_time_styles.append((item, old_style))
-                  else:
-                      new_style = _merge_styles(old_style, style, class_)
-                  item.attrib[self.custom_style_attrib] = new_style # HACK
-                  self._style_to_basic_html_attributes(item, new_style,
-                                                       force=True)
-            else:
-              # if self.verbose: print >> sys.stderr, "SKIPPING rule: [%s]" % selector
-              pass
+
+            for item in nodes:
+                old_style = item.attrib.get(self.custom_style_attrib, '') # HACK
+                if not item in first_time:
+                    if old_style:
+                        new_style = _merge_styles(style, old_style, class_)
+                    else:
+                        new_style = _merge_styles(old_style, style, class_)
+                    first_time.append(item)
+                    first_time_styles.append((item, old_style))
+                else:
+                    new_style = _merge_styles(old_style, style, class_)
+                item.attrib[self.custom_style_attrib] = new_style # HACK
+                self._style_to_basic_html_attributes(item, new_style,
+                                                     force=True)
 
         # Re-apply initial inline styles.
+        if self.style_store is not None:
+            self.merge_inline_styles(first_time_styles)
+            first_time_styles = []
         for item, inline_style in first_time_styles:
             old_style = item.attrib.get(self.custom_style_attrib, '') # HACK
             if not inline_style:
@@ -313,11 +392,62 @@ class Premailer(object):
                     parent.attrib[attr] = urlparse.urljoin(self.base_url,
                                                            parent.attrib[attr])
 
-        out = etree.tostring(page, pretty_print=pretty_print).replace(
-            '<head/>', '<head></head>')
-        if self.strip_important:
-            out = _importants.sub('', out)
-        return out
+        return page
+
+    def style_element_sheet(self, style, as_tree=False):
+        """Compile the CSS of a <style> element. If some rules are left over
+        (see exclude_pseudoclasses) they become the text of the element,
+        otherwise the caller removes the element (unless keep_style_tags).
+        """
+        css_body = etree.tostring(style)
+        css_body = css_body.split('>')[1].split('</')[0]
+        sheet = self._compile(css_body)
+        these_leftover = sheet.leftover
+        if these_leftover:
+            style.text = '\n'.join(['%s {%s}' % (k, v) for
+                                    (k, v) in these_leftover])
+            if as_tree and self.strip_important:
+                style.text = _importants.sub('', style.text)
+        return sheet
+
+    def explicit_rules(self):
+        """The rules of explicit_styles (CSS strings or CompiledStylesheets)"""
+        rules = []
+        if self.explicit_styles: # HACK for testing
+          for style in self.explicit_styles:
+            if not isinstance(style, CompiledStylesheet):
+                style = self._compile(style)
+            elif not style.compiled_for(self.supported_properties,
+                                        self.supported_content):
+                raise PremailerError("The stylesheet was compiled for "
+                                     "different supported properties")
+            rules.extend(style.rules)
+        return rules
+
+    def merge_matched(self, item, matched, first_time_styles):
+        """Merge the rules that matched item (in cascade order) into the
+        style store. The item's inline style is added to first_time_styles
+        the first time it is seen (see merge_inline_styles).
+        """
+        if item not in self.style_store:
+            inline_style = item.attrib.get(self.custom_style_attrib, '')
+            if inline_style:
+                first_time_styles.append((item, inline_style))
+        for rule in matched:
+            merged = self.style_store.merge(item, rule.declarations,
+                                            rule.class_, rule.parsed)
+            if not rule.class_:
+                self._basic_html_attributes(item, merged.items(), force=True)
+
+    def merge_inline_styles(self, first_time_styles):
+        """Merge the inline styles back in so they win over the rules"""
+        for item, inline_style in first_time_styles:
+            declarations = split_declarations(inline_style)
+            if self.strip_important:
+                declarations = [(k, _importants.sub('', v))
+                                for (k, v) in declarations]
+            merged = self.style_store.merge(item, declarations)
+            self._basic_html_attributes(item, merged.items(), force=True)
 
     def _style_to_basic_html_attributes(self, element, style_content,
                                         force=False):
@@ -332,9 +462,31 @@ class Premailer(object):
           style_content.count('{') == style_content.count('{'):
             style_content = style_content.split('}')[0][1:]
 
+        self._basic_html_attributes(
+            element, [x.split(':') for x in style_content.split(';')
+                      if len(x.split(':')) == 2], force=force)
+
+    def applying(self, rules):
+        """The rules that apply (see stylesheet.should_apply_style) and
+        that lxml could translate to XPath.
+        """
+        for rule in rules:
+            if rule.applies and (rule.feature_mask or not self.skip_inert):
+                if rule.xpath is not None:
+                    self.feature_mask |= rule.feature_mask
+                    yield rule
+                elif self.verbose:
+                    print >> sys.stderr, "Ignoring rule: [%s%s]" % (
+                        rule.selector, rule.class_)
+
+    def _basic_html_attributes(self, element, declarations, force=False):
+        """Same as _style_to_basic_html_attributes but for (name, value)
+        pairs of an element (no pseudoclasses).
+        """
         attributes = {}
-        for key, value in [x.split(':') for x in style_content.split(';')
-                           if len(x.split(':')) == 2]:
+        for key, value in declarations:
+            if ':' in value:
+                continue
             key = key.strip()
 
             if key == 'text-align':
@@ -357,6 +509,59 @@ class Premailer(object):
             element.attrib[key] = value
 
 
+def finish_tree(page, pretty_print, strip_attributes=()):
+    """Make the tree Premailer built look like the one parsing
+    etree.tostring(page, pretty_print=pretty_print) as XML would give.
+
+    - namespace declarations (xmlns attributes) come before the other
+      attributes
+    - with pretty_print, elements that only contain elements (no text) are
+      indented the way libxml2 indents them (2 spaces per level, at most 30
+      levels) and everything inside mixed content is left alone
+    - !important is removed from the strip_attributes (style attributes)
+    """
+    stack = [(page, 0)]
+    while stack:
+        element, level = stack.pop()
+        keys = element.keys()
+        if keys:
+            _namespaces_first(element, keys)
+            for name in strip_attributes:
+                value = element.get(name)
+                if value and '!important' in value:
+                    element.set(name, _importants.sub('', value))
+        children = list(element)
+        if pretty_print and level >= 0 and children and \
+               element.text is None and \
+               not [child for child in children if child.tail is not None]:
+            indent = '\n' + '  ' * min(level + 1, 30)
+            element.text = indent
+            for child in children:
+                child.tail = indent
+            children[-1].tail = '\n' + '  ' * min(level, 30)
+            level += 1
+        else:
+            # libxml2 does not indent anything inside mixed content
+            level = -1
+        for child in reversed(children):
+            if isinstance(child.tag, basestring):
+                stack.append((child, level))
+    return page
+
+
+def _namespaces_first(element, keys):
+    namespaces = [k for k in keys if k == 'xmlns' or k.startswith('xmlns:')]
+    if namespaces and keys[:len(namespaces)] != namespaces:
+        items = element.items()
+        element.attrib.clear()
+        for k, v in items:
+            if k in namespaces:
+                element.set(k, v)
+        for k, v in items:
+            if k not in namespaces:
+                element.set(k, v)
+
+
 def transform(html, base_url=None):
     return Premailer(html, base_url=base_url).transform()
 
@@ -0,0 +1,334 @@
+""" Parses CSS once into a CompiledStylesheet that can be reused for many documents
+    (and saved to disk so a new process does not have to parse the CSS again) """
+import os
+import re
+import sys
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from lxml.cssselect import css_to_xpath, ExpressionError
+
+from util import PropertyParser, split_declarations
+from matching import analyze_selector
+from cache import LRUCache
+
+__all__ = ['Rule', 'CompiledStylesheet', 'compile_stylesheet', 'parse_style_rules', 'should_apply_style', 'rule_features']
+
+# Bump this whenever the pickled format (or what gets pre-parsed) changes
+ARTIFACT_VERSION = 5
+
+# What applying a rule makes AddNumbering do (see rule_features). A rule without any only sets properties nothing reads
+FEATURE_PSEUDO = 1          # ::before or ::after
+FEATURE_HIDE = 2            # display: none
+FEATURE_COUNTER = 4         # counter-reset, counter-increment
+FEATURE_CONTENT = 8         # content
+FEATURE_TARGET_COUNTER = 16 # target-counter()
+FEATURE_TARGET_TEXT = 32    # target-text()
+FEATURE_STRING = 64         # string-set
+FEATURE_MOVE = 128          # move-to (or a pending() destination)
+FEATURE_ATTRIBUTES = 256    # Premailer copies it into an HTML attribute (align, bgcolor, width, height)
+FEATURE_TARGETS = FEATURE_TARGET_COUNTER | FEATURE_TARGET_TEXT
+
+# The properties Premailer copies into HTML attributes
+BASIC_HTML_PROPERTIES = ('text-align', 'background-color', 'width', 'height')
+
+_css_comments = re.compile(r'/\*.*?\*/', re.MULTILINE | re.DOTALL)
+_css_whitespace = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|\s*([{};])\s*|\s+''', re.DOTALL)
+_regex = re.compile('((.*?){(.*?)})', re.DOTALL | re.M)
+_semicolon_regex = re.compile(';(\s+)')
+_colon_regex = re.compile(':(\s+)')
+_importants = re.compile('\s*!important')
+# These selectors don't apply to all elements. Rather, they specify
+# which elements to apply to.
+FILTER_PSEUDOSELECTORS = [':last-child', ':first-child', 'nth-child']
+
+
+def parse_style_rules(css_body, exclude_pseudoclasses=False, include_star_selectors=False):
+  """ Returns ([(selector, declarations-text)], leftover) for every rule in the CSS """
+  leftover = []
+  rules = []
+  css_body = _css_comments.sub('', css_body)
+  for each in _regex.findall(css_body.strip()):
+    __, selectors, bulk = each
+
+    bulk = _semicolon_regex.sub(';', bulk.strip())
+    bulk = _colon_regex.sub(':', bulk.strip())
+    if bulk.endswith(';'):
+      bulk = bulk[:-1]
+    for selector in [x.strip() for x in selectors.split(',') if x.strip() and not x.strip().startswith('@')]:
+      if (':' in selector and exclude_pseudoclasses and
+          ':' + selector.split(':', 1)[1] not in FILTER_PSEUDOSELECTORS):
+        # a pseudoclass
+        leftover.append((selector, bulk))
+        continue
+      elif selector == '*' and not include_star_selectors:
+        continue
+
+      rules.append((selector, bulk))
+
+  return rules, leftover
+
+def should_apply_style(style, supported_properties, supported_content):
+  """ HACK: Apply a style if:
+      - it contains content: (pseudo elements, replacing content of existing elements)
+      - manipulating counters
+      AND: TODO
+      - the property values don't contain unknown functions or the PDF-specific "page" counter """
+  for key in supported_properties:
+    if supported_properties[key] == False:
+      return False
+  if 'content:' in style:
+    #TODO Should be if only these are in the content:
+    for key in supported_content:
+      if not supported_content[key] and key in style:
+        return False
+  return True
+
+def rule_features(class_, declarations, parsed):
+  """ The FEATURE_* flags of a rule from its pseudo element, declarations and parsed declarations """
+  mask = 0
+  if class_:
+    mask |= FEATURE_PSEUDO
+  if parsed.get('display') == 'none':
+    mask |= FEATURE_HIDE
+  if 'counter-reset' in parsed or 'counter-increment' in parsed:
+    mask |= FEATURE_COUNTER
+  if parsed.get('move-to', 'here') != 'here':
+    mask |= FEATURE_MOVE
+  values = []
+  if 'content' in parsed:
+    mask |= FEATURE_CONTENT
+    values.append(parsed['content'])
+  if 'string-set' in parsed:
+    mask |= FEATURE_STRING
+    values.extend([value for (_, value) in parsed['string-set']])
+  for value in values:
+    for (function, _) in value:
+      if function == 'target-counter':
+        mask |= FEATURE_TARGET_COUNTER
+      elif function == 'target-text':
+        mask |= FEATURE_TARGET_TEXT
+      elif function == 'pending':
+        mask |= FEATURE_MOVE
+  if not class_ and [name for (name, _) in declarations if name.strip() in BASIC_HTML_PROPERTIES]:
+    mask |= FEATURE_ATTRIBUTES
+  return mask
+
+def _feature_mask(rules):
+  mask = 0
+  for rule in rules:
+    mask |= rule.feature_mask
+  return mask
+
+def split_pseudo(selector):
+  """ 'p::before' -> ('p', ':before').
+      The ':not()' selector causes things to break because it can occur in the middle of a rule
+      So, force "::" for before/after """
+  new_selector = selector
+  class_ = ''
+  if '::before' in selector or '::after' in selector:
+    new_selector, class_ = re.split('::', selector, 1)
+    class_ = ':%s' % class_
+
+  # Keep filter-type selectors untouched.
+  if class_ in FILTER_PSEUDOSELECTORS:
+    return selector, ''
+  return new_selector, class_
+
+
+class Rule(object):
+  """ One selector and its declarations.
+      - style:        the declarations text (what Premailer used to merge into the style attribute)
+      - declarations: [(name, value)] in order, with !important removed
+      - parsed:       name -> PropertyParser value for the properties we know how to parse
+      - applies:      whether the rule passes should_apply_style for the features it was compiled with
+      - xpath:        the selector translated to XPath (None if lxml can not translate it)
+      - match_plan, key, requires: see matching.analyze_selector
+      - feature_mask: the FEATURE_* flags of the rule (0 if it does not apply, see rule_features) """
+  __slots__ = ('index', 'selector', 'class_', 'style', 'declarations', 'parsed', 'applies', 'xpath',
+               'match_plan', 'key', 'requires', 'feature_mask')
+
+  def __init__(self, index, selector, class_, style, declarations, parsed, applies, xpath,
+               match_plan=None, key=None, requires=((), (), ())):
+    self.index = index
+    self.selector = selector
+    self.class_ = class_
+    self.style = style
+    self.declarations = declarations
+    self.parsed = parsed
+    self.applies = applies
+    self.xpath = xpath
+    self.match_plan = match_plan
+    self.key = key
+    self.requires = requires
+    self.feature_mask = 0
+    if applies:
+      self.feature_mask = rule_features(class_, declarations, parsed)
+
+  def __getstate__(self):
+    return tuple(getattr(self, name) for name in Rule.__slots__)
+
+  def __setstate__(self, state):
+    for (name, value) in zip(Rule.__slots__, state):
+      setattr(self, name, value)
+
+  def __repr__(self):
+    return 'Rule(%r)' % (self.selector + self.class_)
+
+
+class CompiledStylesheet(object):
+  """ CSS that has been parsed (and had its selectors translated to XPath) once.
+      Pass it to AddNumbering.transform (or Premailer's explicit_styles) instead of the CSS text.
+      feature_mask has the FEATURE_* flags of all its rules """
+
+  def __init__(self, css, supported_properties={}, supported_content={},
+               exclude_pseudoclasses=False, include_star_selectors=False, strip_important=True, verbose=False):
+    if isinstance(css, basestring):
+      css = [css]
+    self.key = stylesheet_key(css, supported_properties, supported_content,
+                              exclude_pseudoclasses, include_star_selectors, strip_important)
+    self.features = _features(supported_properties, supported_content)
+    self.rules = []
+    self.leftover = []
+    parser = PropertyParser()
+    for css_body in css:
+      rules, leftover = parse_style_rules(css_body, exclude_pseudoclasses, include_star_selectors)
+      self.leftover.extend(leftover)
+      for (selector, style) in rules:
+        selector, class_ = split_pseudo(selector)
+        applies = should_apply_style(style, supported_properties, supported_content)
+        declarations = split_declarations(style)
+        if strip_important:
+          declarations = [(k, _importants.sub('', v)) for (k, v) in declarations]
+        parsed = {}
+        xpath = None
+        analysis = ()
+        if applies:
+          for (name, value) in declarations:
+            parsed[name] = parser.parse_value(name, value)
+          parsed = dict((k, v) for (k, v) in parsed.iteritems() if v is not None)
+          try:
+            xpath = css_to_xpath(selector)
+          except ExpressionError:
+            if verbose: print >> sys.stderr, "Ignoring rule: [%s%s]" % (selector, class_)
+          if xpath is not None:
+            analysis = analyze_selector(selector)
+        self.rules.append(Rule(len(self.rules), selector, class_, style, declarations, parsed, applies, xpath, *analysis))
+    self.feature_mask = _feature_mask(self.rules)
+
+  def compiled_for(self, supported_properties, supported_content):
+    """ Whether this was compiled for the same supported properties and content functions """
+    return self.features == _features(supported_properties, supported_content)
+
+  def subset(self, keep):
+    """ A copy with only the rules keep(rule) is true for (in the same order) """
+    sheet = CompiledStylesheet.__new__(CompiledStylesheet)
+    sheet.key = None # not the compile of any CSS text so it is never cached
+    sheet.features = self.features
+    sheet.rules = [rule for rule in self.rules if keep(rule)]
+    sheet.feature_mask = _feature_mask(sheet.rules)
+    sheet.leftover = self.leftover
+    return sheet
+
+  def __len__(self):
+    return len(self.rules)
+
+  def __iter__(self):
+    return iter(self.rules)
+
+  def save(self, path):
+    """ Atomically write the compiled stylesheet to path """
+    dirname = os.path.dirname(os.path.abspath(path))
+    (fd, tmp) = tempfile.mkstemp(dir=dirname, prefix='.tmp-', suffix='.css.pickle')
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+        pickle.dump((ARTIFACT_VERSION, self.key, self.features, self.rules, self.leftover), f, pickle.HIGHEST_PROTOCOL)
+      finally:
+        f.close()
+      os.rename(tmp, path)
+    except:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      raise
+
+  @classmethod
+  def load(cls, path, key=None):
+    """ Load a stylesheet saved with save(). Returns None if the file is missing, stale or corrupt """
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return None
+    try:
+      try:
+        (version, stored_key, features, rules, leftover) = pickle.load(f)
+      except Exception:
+        return None
+    finally:
+      f.close()
+    if version != ARTIFACT_VERSION or (key is not None and key != stored_key):
+      return None
+    self = cls.__new__(cls)
+    self.key = stored_key
+    self.features = features
+    self.rules = rules
+    self.feature_mask = _feature_mask(rules)
+    self.leftover = leftover
+    return self
+
+  @classmethod
+  def cached(cls, css, cache_dir, **kwargs):
+    """ Load the compiled stylesheet from cache_dir (compiling and saving it on a miss).
+        Takes the same keyword arguments as the constructor. """
+    if isinstance(css, basestring):
+      css = [css]
+    key = stylesheet_key(css, **kwargs)
+    path = os.path.join(cache_dir, key + '.css.pickle')
+    sheet = cls.load(path, key)
+    if sheet is None:
+      sheet = cls(css, **kwargs)
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      sheet.save(path)
+    return sheet
+
+
+def stylesheet_key(css, supported_properties={}, supported_content={},
+                   exclude_pseudoclasses=False, include_star_selectors=False, strip_important=True, verbose=False):
+  """ A hash of the CSS (normalized, so comments and whitespace do not change it) and all the flags that change what gets compiled """
+  h = hashlib.sha1()
+  h.update(repr((ARTIFACT_VERSION, _features(supported_properties, supported_content),
+                 exclude_pseudoclasses, include_star_selectors, strip_important)))
+  for css_body in css:
+    if isinstance(css_body, unicode):
+      css_body = css_body.encode('utf-8')
+    css_body = normalize_css(css_body)
+    h.update('%d:' % len(css_body))
+    h.update(css_body)
+  return h.hexdigest()
+
+def normalize_css(css_body):
+  """ The CSS without comments (removed like parse_style_rules does) and with every run of whitespace
+      outside of strings made one space (none next to braces and semicolons): it compiles the same """
+  css_body = _css_comments.sub('', css_body)
+  def normalize(match):
+    if match.group(1):
+      return match.group(1) # a string
+    if match.group(2) is not None:
+      return match.group(2) # a brace or semicolon (and the whitespace around it)
+    return ' '
+  return _css_whitespace.sub(normalize, css_body).strip()
+
+# Compiled stylesheets for CSS text passed in as strings (so the same text is only parsed once per process)
+STYLESHEET_CACHE = LRUCache(maxsize=32)
+
+def compile_stylesheet(css, **kwargs):
+  """ Same as CompiledStylesheet(css, **kwargs) but reuses an earlier compile of the same CSS and flags """
+  if isinstance(css, basestring):
+    css = [css]
+  return STYLESHEET_CACHE.get_or_compute(stylesheet_key(css, **kwargs), lambda key: CompiledStylesheet(css, **kwargs))
+
+def _features(supported_properties, supported_content):
+  # The supported_* maps can also be (empty) lists
+  return (tuple(sorted(dict(supported_properties).items())), tuple(sorted(dict(supported_content).items())))
@@ -1,17 +1,206 @@
+import sys
+import time
+import itertools
+import posixpath
+
 import cssselect # The customized one
-from lxml.cssselect import TokenStream, String, Symbol, Token
+from lxml.cssselect import SelectorSyntaxError
 
 import numbers
+from cache import LRUCache
 
 class UnsupportedError(Exception): pass
 
+class PersistentMap(object):
+  """ A dict (of counters or strings) that can be copied in O(1).
+      The entries are a base dict plus a small dict of the changes made since. A copy shares both and
+      freezes them: the first write after it only copies the changes, never the base, and once the
+      changes outgrow _MERGE_AT they are merged into a new base. Keys are interned. """
+  __slots__ = ('_base', '_changes', '_frozen')
+  _MERGE_AT = 16
+
+  def __init__(self, other = None):
+    if other is None:
+      self._base = {}
+      self._changes = {}
+      self._frozen = False
+    else:
+      other._frozen = True
+      self._base = other._base
+      self._changes = other._changes
+      self._frozen = True
+
+  def copy(self):
+    return PersistentMap(self)
+
+  def __getitem__(self, key):
+    changes = self._changes
+    if key in changes:
+      return changes[key]
+    return self._base[key]
+
+  def get(self, key, default = None):
+    changes = self._changes
+    if key in changes:
+      return changes[key]
+    return self._base.get(key, default)
+
+  def __contains__(self, key):
+    return key in self._changes or key in self._base
+
+  def __setitem__(self, key, value):
+    if type(key) is str:
+      key = intern(key)
+    changes = self._changes
+    if self._frozen:
+      changes = self._changes = dict(changes)
+      self._frozen = False
+    changes[key] = value
+    if len(changes) > self._MERGE_AT:
+      base = dict(self._base)
+      base.update(changes)
+      self._base = base
+      self._changes = {}
+
+  def items(self):
+    if not self._changes:
+      return self._base.items()
+    merged = dict(self._base)
+    merged.update(self._changes)
+    return merged.items()
+
+  def keys(self):
+    return [key for (key, _) in self.items()]
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    base = self._base
+    return len(base) + len([key for key in self._changes if key not in base])
+
+  def __eq__(self, other):
+    if isinstance(other, PersistentMap):
+      other = dict(other.items())
+    return dict(self.items()) == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
+  def __getstate__(self):
+    return dict(self.items())
+
+  def __setstate__(self, state):
+    self._base = state
+    self._changes = {}
+    self._frozen = False
+
+class ChapterMap(PersistentMap):
+  """ A PersistentMap for one chapter of AddNumbering.transform_book_incremental: the base is what the chapter
+      starts with and everything the chapter sets stays in the changes (they are never merged) so written()
+      tells them apart. Records the keys read before the chapter set them (shared with the copies) """
+  __slots__ = ('read',)
+  _MERGE_AT = sys.maxint
+
+  def __init__(self, incoming = None):
+    PersistentMap.__init__(self)
+    if incoming is not None:
+      self._base = dict(incoming.items())
+    self.read = set()
+
+  def copy(self):
+    copy = ChapterMap.__new__(ChapterMap)
+    PersistentMap.__init__(copy, self)
+    copy.read = self.read
+    return copy
+
+  def __getitem__(self, key):
+    if key not in self._changes:
+      self.read.add(key)
+    return PersistentMap.__getitem__(self, key)
+
+  def get(self, key, default = None):
+    if key not in self._changes:
+      self.read.add(key)
+    return PersistentMap.get(self, key, default)
+
+  def __contains__(self, key):
+    if key not in self._changes:
+      self.read.add(key)
+    return PersistentMap.__contains__(self, key)
+
+  def written(self):
+    """ {key: value} set by the chapter (so far, for a copy) """
+    return dict(self._changes)
+
+  def reads(self):
+    """ {key: incoming value (None if there was none)} for the keys read before the chapter set them """
+    return dict((key, self._base.get(key)) for key in self.read)
+
 class State(object):
+  """ The counters and strings at one point of the document.
+      State(state) is a snapshot (O(1), see PersistentMap) that does not change when state does """
+  __slots__ = ('counters', 'strings')
+
   def __init__(self, state = None):
-    self.counters = {}
-    self.strings = {}
     if state:
       self.counters = state.counters.copy()
       self.strings = state.strings.copy()
+    else:
+      self.counters = PersistentMap()
+      self.strings = PersistentMap()
+
+  def __getstate__(self):
+    return (self.counters, self.strings)
+
+  def __setstate__(self, state):
+    (self.counters, self.strings) = state
+
+class Stats(object):
+  """ What a transform did: the wall time and the number of elements of every pass
+      (in the order they first ran, a pass that runs once per chapter adds up) and counts
+      like the rules applied or the pseudo elements created. Set AddNumbering.stats to one to collect them """
+
+  def __init__(self):
+    self.passes = [] # pass names in order
+    self.seconds = {}
+    self.elements = {}
+    self.counts = {}
+    self._last = None
+
+  def start(self):
+    """ The next lap() is timed from now """
+    self._last = time.time()
+
+  def lap(self, name, elements = 0):
+    """ Records that pass name ran since the last start() or lap() and went over elements elements """
+    now = time.time()
+    if name not in self.seconds:
+      self.passes.append(name)
+      self.seconds[name] = 0.0
+      self.elements[name] = 0
+    if self._last is not None:
+      self.seconds[name] += now - self._last
+    self.elements[name] += elements
+    self._last = now
+
+  def count(self, name, n = 1):
+    self.counts[name] = self.counts.get(name, 0) + n
+
+  def as_dict(self):
+    """ For json.dumps """
+    return {
+      'passes': [{'name': name, 'seconds': self.seconds[name], 'elements': self.elements[name]} for name in self.passes],
+      'seconds': sum(self.seconds.values()),
+      'counts': dict(self.counts),
+    }
+
+def split_declarations(style):
+  """ Splits 'color: red; content: "x"' into [('color', 'red'), ('content', '"x"')] (in order) """
+  return [(k.strip(), v.strip()) for k, v in [x.strip().split(':', 1) for x in style.split(';') if x.strip()]]
 
 def parse_style(style, class_ = ''):
   news = {}
@@ -22,32 +211,119 @@ def parse_style(style, class_ = ''):
     return news
   elif style[0] == '{':
     style = style[1:style.find('}')]
-  for k, v in [x.strip().split(':', 1) for x in style.split(';') if x.strip()]:
-    news[k.strip()] = v.strip()
+  for k, v in split_declarations(style):
+    news[k] = v
   # TODO: validate whether properties should be discarded (using ContentPropertyParser)
   return news
 
+class StyleStore(object):
+  """ The declarations that apply to each element, kept parsed so they never have to
+      round-trip through a style attribute.
+      Every element maps a pseudo-element ('' for the element itself, ':before', ':after')
+      to a dict of property name -> value (and a dict of property name -> PropertyParser value). """
+  def __init__(self):
+    self._styles = {}
+    self._parsed = {}
+
+  def get(self, element, class_ = ''):
+    """ The declarations for one pseudo-element of element (empty if nothing matched) """
+    return self._styles.get(element, _EMPTY).get(_pseudo_key(class_), _EMPTY)
+
+  def parsed(self, element, class_ = ''):
+    """ Same as get() but the values are parsed (see PropertyParser.parse_declarations) """
+    return self._parsed.get(element, _EMPTY).get(_pseudo_key(class_), _EMPTY)
+
+  def pseudos(self, element):
+    """ All the declarations of element: pseudo-element ('', ':before', ':after') -> declarations """
+    return self._styles.get(element, _EMPTY)
+
+  def has(self, element, class_ = ''):
+    return _pseudo_key(class_) in self._styles.get(element, _EMPTY)
+
+  def set(self, element, declarations, parsed = None, class_ = ''):
+    if parsed is None:
+      parsed = PropertyParser().parse_declarations(declarations)
+    class_ = _pseudo_key(class_)
+    self._styles.setdefault(element, {})[class_] = declarations
+    self._parsed.setdefault(element, {})[class_] = parsed
+
+  def merge(self, element, declarations, class_ = '', parsed = None):
+    """ Merge a list of (name, value) declarations into the element. The new ones replace the old ones.
+        parsed are the declarations already run through PropertyParser.parse_declarations (if available).
+        Returns the merged declarations. """
+    if parsed is None:
+      parsed = PropertyParser().parse_declarations(dict(declarations))
+    class_ = _pseudo_key(class_)
+    pseudos = self._styles.setdefault(element, {})
+    parsed_pseudos = self._parsed.setdefault(element, {})
+    merged = {}
+    for k, v in declarations:
+      merged[k] = v
+    merged_parsed = dict(parsed)
+    for k, v in parsed_pseudos.get(class_, _EMPTY).iteritems():
+      if k not in merged:
+        merged_parsed[k] = v
+    for k, v in pseudos.get(class_, _EMPTY).items():
+      if k not in merged:
+        merged[k] = v
+    pseudos[class_] = merged
+    parsed_pseudos[class_] = merged_parsed
+    return merged
+
+  def discard(self, element):
+    """ Forget the declarations of element (and its pseudo-elements) """
+    self._styles.pop(element, None)
+    self._parsed.pop(element, None)
+
+  def iterparsed(self):
+    """ Yields (element, pseudo-element, parsed declarations) for everything that has declarations (in no particular order) """
+    for (element, pseudos) in self._parsed.iteritems():
+      for (class_, parsed) in pseudos.iteritems():
+        yield (element, class_, parsed)
+
+  def __contains__(self, element):
+    return element in self._styles
+
+  def __len__(self):
+    return len(self._styles)
+
+_EMPTY = {}
+
+def _pseudo_key(class_):
+  # 'p:::before' is split into 'p' and '::before' so treat it the same as ':before'
+  if class_:
+    return ':' + class_.lstrip(':')
+  return ''
+
 class PropertyParser(object):
   """ Parses all the style properties we care about (display:none, counter-reset:, counter-increment:, and content:) """
   def parse(self, style, class_ = ''):
-    style = parse_style(style, class_)
+    return self.parse_declarations(parse_style(style, class_))
+  def parse_declarations(self, style):
+    """ Same as parse() but for a dict of declarations (see StyleStore) """
     ret = {}
     for (name, value) in style.iteritems():
-      method = '_parse_' + name.replace('-', '_')
-      if hasattr(self, method):
-        method = getattr(self, method)
-        val = method(value)
-        #if name in ret:
-          # Decide whether to overwrite it.
-          # 2 cases:
-          # - doesn't have an unknown
-          # - ends-with "!important"
-        if val is not None:
-          ret[name] = val
+      val = self.parse_value(name, value)
+      if val is not None:
+        ret[name] = val
     return ret
+  def parse_value(self, name, value):
+    """ Parses one declaration. Returns None if it is not a property we care about
+        or if it can not be parsed (so the property is gracefully ignored).
+        The result is immutable (tuples) and shared: the same declaration is only parsed once (see DECLARATION_CACHE) """
+    method = '_parse_' + name.replace('-', '_')
+    if hasattr(self, method):
+      return DECLARATION_CACHE.get_or_compute((name, value), self._parse_uncached)
+  def _parse_uncached(self, key):
+    (name, value) = key
+    method = getattr(self, '_parse_' + name.replace('-', '_'))
+    try:
+      return _freeze(method(value))
+    except (AssertionError, SelectorSyntaxError):
+      return None
   def _counter(self, value, default):
     acc = []
-    stream = TokenStream(cssselect.tokenize(value))
+    stream = cssselect.Cursor(cssselect.scan(value))
     while stream.peek() is not None:
       name = str(stream.next())
       by = default
@@ -68,35 +344,28 @@ class PropertyParser(object):
     # For example:
     # { string-set: string1 "value1", string2 "value2", string3 counter(item, decimal); }
     # Also, we can't just split on commas because for example target-text() has commas in it
-    # This first piece is just a glorified split(',')
-    stream = TokenStream(cssselect.tokenize(value))
+    # This first piece is just a glorified split(',') of the tokens
+    tokens = cssselect.scan(value)
     values = []
-    acc = ''
+    start = 0
     parentheses = 0
-    while stream.peek() is not None:
-      token = stream.next()
-      if str(token) == ',' and parentheses == 0:
-        values.append(acc)
-        acc = ''
-      else:
-        if str(token) == '(':
+    for (i, (kind, token, _)) in enumerate(tokens):
+      if kind == cssselect.TOKEN:
+        if token == ',' and parentheses == 0:
+          values.append(tokens[start:i])
+          start = i + 1
+        elif token == '(':
           parentheses += 1
-        elif str(token) == ')':
+        elif token == ')':
           parentheses -= 1
-        
-        if type(token) == String:
-          acc += '"%s" ' % str(token)
-        else:
-          acc += str(token) + ' '
-    if acc != '':
-      values.append(acc)
-        
+    if start < len(tokens):
+      values.append(tokens[start:])
+
     acc = []
-    for val in values:
-      stream = TokenStream(cssselect.tokenize(val))
-      string_name = str(stream.next())
-      string_value = val[len(string_name) + 1:]
-      acc.append((string_name, ContentPropertyParser().parse(string_value)))
+    for tokens in values:
+      assert tokens, "Empty string-set"
+      string_name = str(tokens[0][1])
+      acc.append((string_name, ContentPropertyParser().parse_tokens(tokens[1:])))
     return acc
   def _parse_display(self, value):
     if 'none' in value:
@@ -107,17 +376,32 @@ class PropertyParser(object):
     return move_dest
       
 
+# Parsed declarations: (property name, value text) -> PropertyParser.parse_value result.
+# Shared by every transform in the process (all the chapters of a book reuse the same parses)
+DECLARATION_CACHE = LRUCache(maxsize=4096)
+
+def _freeze(value):
+  """ Turns the lists a parse returns into tuples so the cached result can be shared """
+  if isinstance(value, (list, tuple)):
+    return tuple([_freeze(v) for v in value])
+  return value
+
 class ContentPropertyParser(object):
   
   def parse(self, value):
     """ Given a string like "'Exercise ' target-counter(attr(href, url), chapter, decimal) counters(section)"
         return a list of the form:
         (function-name or None, values) """
+    return self.parse_tokens(cssselect.scan(value))
+
+  def parse_tokens(self, tokens):
+    """ Same as parse() for the tokens of cssselect.scan() """
     vals = []
-    stream = TokenStream(cssselect.tokenize(value))
+    stream = cssselect.Cursor(tokens)
     while stream.peek() is not None:
+      kind = stream.kind()
       t = stream.next()
-      if isinstance(t, String):
+      if kind == cssselect.STRING:
         vals.append((None, str(t)))
       else:
         name = str(t)
@@ -138,12 +422,12 @@ class ContentPropertyParser(object):
   def _unknown(self, stream):
     # parse up to the matching close paren
     acc = []
-    assert str(stream.read()) == '('
+    assert str(stream.next()) == '('
     while stream.peek() is not None and str(stream.peek()) != ')':
       if str(stream.peek()) == '(':
         acc.concat(_unknown(stream))
       else:
-        acc.append(stream.read())
+        acc.append(stream.next())
     return acc
       
   def _optional(self, stream, default=None):
@@ -227,14 +511,14 @@ class ContentPropertyParser(object):
 
   def _parse_string(self, stream):
     assert str(stream.next()) == '('
-    string_name = stream.next()
+    string_name = str(stream.next())
     assert str(stream.next()) == ')'
     return string_name
 
   # http://www.w3.org/TR/css3-content/#moving
   def _parse_pending(self, stream):
     assert str(stream.next()) == '('
-    pending_name = stream.next()
+    pending_name = str(stream.next())
     assert str(stream.next()) == ')'
     return pending_name
 
@@ -242,10 +526,35 @@ class ContentEvaluator(object):
   def __init__(self, node_at = {}, state = None, verbose = False):
     self.verbose = verbose
     self.node_at = node_at
+    self.document = None # the name of the chapter being transformed (see AddNumbering.transform_book)
+    self.texts = {} # (target node, 'at' or 'first-letter') -> its text (see lookup_text and changed)
     self.state = State()
     if state:
       self.state = state
 
+  def target_id(self, href):
+    """ The node_at key a link points to. Within one document it is the id ('#fig12' -> 'fig12'),
+        in a book it is the normalized chapter name and the id ('chapter3.xhtml#fig12') so
+        links to other chapters resolve too """
+    if self.document is None:
+      if href[0] == '#':
+        return href[1:]
+      return href
+    (name, hash, id) = href.partition('#')
+    if not hash:
+      (name, id) = ('', href)
+    if name:
+      name = posixpath.normpath(posixpath.join(posixpath.dirname(self.document), name))
+    else:
+      name = self.document
+    return name + '#' + id
+
+  def element_id(self, id):
+    """ The node_at key of an element with this id attribute (see target_id) """
+    if self.document is None:
+      return id
+    return self.document + '#' + id
+
   def eval_content(self, node, content):
     vals = [] # Accumulator
     for (function, args) in content:
@@ -267,13 +576,13 @@ class ContentEvaluator(object):
   def lookup_state(self, node, attr):
     id = node.attrib.get(attr, None)
     if id:
-      if id[0] == '#':
-        id = id[1:]
+      id = self.target_id(id)
       if id in self.node_at:
         return self.node_at[id]
   
   def lookup_text(self, node, attr, which):
-    """ Used by target-text(attr(href), content(first-letter)) """
+    """ Used by target-text(attr(href), content(first-letter)).
+        The text of a target is only collected once (see changed) """
     target_node, state = self.lookup_state(node, attr)
     if state:
       if which == 'before':
@@ -283,25 +592,42 @@ class ContentEvaluator(object):
         if len(target_node) > 0 and self.is_pseudo(target_node[-1]):
           return target_node[-1].text # guaranteed it doesn;t have child elements
       else:
-        text = ''
-        if target_node.text: text += target_node.text
-        def rec_add(n):
-          text = ''
-          if n.text: text += n.text
-          for s in n: text += rec_add(s)
-          if n.tail: text += n.tail
-          return text
-        for child in target_node:
-          if not self.is_pseudo(child):
-            text += rec_add(child)
-          elif child.tail: text += child.tail
-        text = ''.join(text)
-        if which == 'first-letter':
-          text = text.strip()
-          if text: return text[0]
-          else: return ''
-        else: return text
-    
+        if which != 'first-letter':
+          which = 'at'
+        key = (target_node, which)
+        text = self.texts.get(key)
+        if text is None:
+          text = self._text(target_node)
+          if which == 'first-letter':
+            text = text.strip()[:1]
+          self.texts[key] = text
+        return text
+
+  def _text(self, target_node):
+    """ All the text in target_node except the one in its pseudo elements (without recursing) """
+    pieces = [target_node.text or '']
+    for child in target_node:
+      if self.is_pseudo(child):
+        pieces.append(child.tail or '')
+        continue
+      stack = [(child, False)]
+      while stack:
+        (n, done) = stack.pop()
+        if done:
+          if n.tail: pieces.append(n.tail)
+          continue
+        if n.text: pieces.append(n.text)
+        stack.append((n, True))
+        stack.extend([(s, False) for s in reversed(n)])
+    return ''.join(pieces)
+
+  def changed(self, node):
+    """ Forgets the texts of the targets node is in: its text or children changed (or it moved) """
+    if self.texts:
+      for n in itertools.chain((node,), node.iterancestors()):
+        self.texts.pop((n, 'at'), None)
+        self.texts.pop((n, 'first-letter'), None)
+
   def lookup_counter(self, node, attr, name):
     # Look up the node (strip of the leading "#" in the href)
     v = 0
@@ -330,17 +656,18 @@ class ContentEvaluator(object):
       n = node.getparent()
     v = self.lookup_counter(n, attr, name)
     if v and name != 'page':
-      # TODO: use numbering to customize how it's rendered (decimal, upper-roman, etc)
+      return numbers.toString(v, numbering)
+
+  def format_counter(self, counters, name, numbering):
+    """ The value of a counter as counter() (or target-counter() with the counters of the target) generates it """
+    v = counters.get(name, 0)
+    if v and name != 'page':
       return numbers.toString(v, numbering)
 
   def _eval_counter(self, node, args):
     # These look like: "counter(chapter)" or "counter(chapter, upper-roman)"
     (name, numbering) = args
-    v = 0
-    if name in self.state.counters:
-      v = self.state.counters[name]
-    if v and name != 'page':
-      return numbers.toString(v, numbering)
+    return self.format_counter(self.state.counters, name, numbering)
 
   def _eval_attr(self, node, args):
     (name, type_, value) = args
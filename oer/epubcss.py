@@ -1,19 +1,38 @@
 import os
 import sys
+import copy
+import glob
+import bisect
 import codecs
-from StringIO import StringIO
+import shutil
+import hashlib
+import cPickle as pickle
+import posixpath
+import tempfile
+import multiprocessing
 from lxml import etree
 
 from custom import premailer
 from custom import numbers
-from custom.util import PropertyParser, ContentPropertyParser, parse_style, ContentEvaluator, State, UnsupportedError
+from custom.explain import Explain, SORT_KEYS
+from custom.matching import RuleIndex
+from custom.cache import DiskCache
+from custom.loader import StylesheetLoader
+from custom.stylesheet import CompiledStylesheet, compile_stylesheet, stylesheet_key, \
+  FEATURE_PSEUDO, FEATURE_HIDE, FEATURE_COUNTER, FEATURE_CONTENT, FEATURE_TARGETS, FEATURE_TARGET_TEXT, FEATURE_STRING, FEATURE_MOVE
+from custom.util import ChapterMap, ContentEvaluator, State, Stats, StyleStore, UnsupportedError
 
-__all__ = ['AddNumbering', 'UnsupportedError']
+__all__ = ['AddNumbering', 'BookRender', 'CompiledStylesheet', 'Stats', 'UnsupportedError']
 
-# By default use a special attribute and remove it at the end of parsing
+# The matched styles are kept in a StyleStore (not in an attribute).
+# Set this to 'style' to also write the element styles out at the end of parsing
 # (do not apply alls the "simple' styles like color, font-face, etc
 STYLE_ATTRIBUTE = '_custom_style' # 'style'
 
+# Bump this whenever the output for the same input changes (it is part of the transform_cached keys,
+# with the lxml version and a hash of the code so an upgrade of either never returns a stale result)
+RESULT_VERSION = 1
+
 # Maps different features with which properties they support and which content they support
 FEATURES = {
   'counter': (['counter-reset', 'counter-increment'], ['counter', 'counters']),
@@ -22,139 +41,876 @@ FEATURES = {
   'move'   : (['move-to'], ['pending'])
 }
 
+def supported_features(args):
+  """ Returns the (supported_properties, supported_content) maps for the --no-* command line flags """
+  supported_properties = {}
+  supported_content = {}
+
+  for (props, contents) in FEATURES.values():
+    for x in props:
+      supported_properties[x] = True
+    for x in contents:
+      supported_content[x] = True
+
+  def del_features(feature):
+    (props, contents) = FEATURES[feature]
+    for x in props:
+      supported_properties[x] = False
+    for x in contents:
+      supported_content[x] = False
+
+  if args is not None:
+    if args.no_counter: del_features('counter')
+    if args.no_target:  del_features('target')
+    if args.no_string:  del_features('string')
+    if args.no_move:    del_features('move')
+  return supported_properties, supported_content
+
+# The features the passes after Premailer are for (a document whose rules need none of them is done)
+_GENERATE_FEATURES = FEATURE_PSEUDO | FEATURE_HIDE | FEATURE_COUNTER | FEATURE_CONTENT | FEATURE_TARGETS | FEATURE_STRING | FEATURE_MOVE
+
 class AddNumbering(object):
 
   def __init__(self, args, pseudo_element_name='{http://www.w3.org/1999/xhtml}span'):
     self.node_at = {}
+    self.styles = StyleStore() # element -> parsed declarations (filled in by Premailer)
     self.evaluator = ContentEvaluator(self.node_at)
-    self.reprocess = [] # nodes with content: target-counter(....) and the current counter values at that point for the node: (etree.Element, {'name', 4})
+    self.moving = None # when something uses move-to: [(name, node, whether it is a pending(name) destination)] in document order (see move)
+    self.reprocess = [] # the _References (content that looks up a target: target-counter(), target-text()) in document order
+    self.waiting = {} # target id -> [(_Reference, index, args)] of the target-counter()s that come before their target
     self.args = args
     self.verbose = False
+    self.stats = None # a Stats to collect the timings and counts of transform() and transform_book() in
     if args is not None:
       self.verbose = args.verbose
+      if getattr(args, 'stats', None):
+        self.stats = Stats()
+    self.explain = None # an Explain to measure the cost of every rule in (see custom/explain.py)
+    if getattr(args, 'explain', None):
+      self.explain = Explain()
     self.pseudo_element_name = pseudo_element_name
+    (self.supported_properties, self.supported_content) = supported_features(args)
+    # Only used by transform_stream
+    self._scanning = False    # the first pass (nothing is written)
+    self._references = None   # id -> number of target-counter()/target-text() lookups still to come
+    self._text_targets = set() # ids looked up by target-text() (their subtree is kept)
+    self._dropped = set()     # hidden elements (and <style> elements) that are not written
+    self._opened = set()      # elements whose start tag was written before their children
 
+  def compile_stylesheet(self, css, cache_dir = None):
+    """ Parse the CSS (a string or list of strings) once for all the documents this will transform.
+        If cache_dir is given the compiled stylesheet is also saved there (keyed by a hash of the CSS and the --no-* flags)
+        so another process can load it instead of parsing the CSS again. """
+    kwargs = dict(supported_properties=self.supported_properties, supported_content=self.supported_content, verbose=self.verbose)
+    if cache_dir:
+      return CompiledStylesheet.cached(css, cache_dir, **kwargs)
+    return compile_stylesheet(css, **kwargs)
 
   def transform(self, html, explicit_styles = [], pretty_print = True):
-    xpath = etree.XPath('//*')
-    
-    supported_properties = {}
-    supported_content = {}
-
-    for (props, contents) in FEATURES.values():
-      for x in props:
-        supported_properties[x] = True
-      for x in contents:
-        supported_content[x] = True
-    
-    def del_features(feature):
-      (props, contents) = FEATURES[feature]
-      for x in props:
-        supported_properties[x] = False
-      for x in contents:
-        supported_content[x] = False
-
-    if self.args is not None:
-      if self.args.no_counter: del_features('counter')
-      if self.args.no_target:  del_features('target')
-      if self.args.no_string:  del_features('string')
-      if self.args.no_move:    del_features('move')
+    """ explicit_styles is a list of CSS strings and/or CompiledStylesheets (see compile_stylesheet) """
+    supported_properties = self.supported_properties
+    supported_content = self.supported_content
+    if isinstance(explicit_styles, (basestring, CompiledStylesheet)):
+      explicit_styles = [explicit_styles]
 
     if self.verbose: print >> sys.stderr, 'LOG: Supported properties: %s' % str(supported_properties)
     if self.verbose: print >> sys.stderr, 'LOG: Supported content values: %s' % str(supported_content)
     
-    p = premailer.Premailer(html, supported_properties=supported_properties, supported_content=supported_content, explicit_styles=explicit_styles, remove_classes=False, custom_style_attrib=STYLE_ATTRIBUTE, verbose=self.verbose)
-    html = p.transform(pretty_print=pretty_print)
-    html = etree.parse(StringIO(html))
-    nodes = xpath(html)
+    stats = self.stats
+    if stats is not None: stats.start()
+    p = self._premailer(html, explicit_styles)
+    html = p.transform_tree(pretty_print=pretty_print)
+    if stats is not None: self._count_rules(p)
     
     # Passes:
-    # - expand all pseudo nodes and remove all hidden ones
-    #   - find all the targets we'll need to look up
-    # - calculate all the counters and save counters that will need to be looked up (target-counter)
-    # - recalculate all the remaining content (that has target-counter) by looking up the nodes
+    # - find all the targets we'll need to look up (from the matched styles, without walking the tree)
+    # - in one walk: expand all pseudo nodes and remove all hidden ones,
+    #   calculate all the counters and save counters that will need to be looked up (target-counter),
+    #   generate the content that looks up a target as far as the targets were already seen
+    # - write the content that looks up a target (filling in the target-text)
+    # - move nodes (only if something uses move-to)
     # - remove the styling attribute
-    
-    if self.verbose: print >> sys.stderr, "-------- Finding target nodes ( CSS target-counter() or target-text() ) : %d" % len(nodes)
-    for node in nodes:
-      style = node.attrib.get(STYLE_ATTRIBUTE, '')
-      style = PropertyParser().parse(style)
-      if 'content' in style:
-        for (name, value) in style['content']:
-          attr = None
-          if 'target-text' == name: (attr, _) = value
-          if 'target-counter' == name: (attr, _, _) = value
-          if attr:
-            id = node.attrib.get(attr, None)
-            if id[0] == '#':
-              id = id[1:]
-            self.node_at[id] = None
-
-    if self.verbose: print >> sys.stderr, "-------- Creating pseudo elements ( CSS :before and :after ) : %d" % len(nodes)
-    for node in nodes:
-      style = node.attrib.get(STYLE_ATTRIBUTE, '')
-      self.expand_pseudo(node, style)
-    
-    if self.verbose: print >> sys.stderr, "-------- Running counters and generating simple content",
-    nodes = xpath(html) # we may have added pseudo nodes so re-self.update
-    if self.verbose: print >> sys.stderr, ": %d" % len(nodes)
-    # This has to be done in a separate pass so we can look up target-counter
-    for node in nodes:
-      self.mutate_node(node)
+    # A pass only runs if one of the rules that were applied needs it (see stylesheet.FEATURE_*)
+    features = p.feature_mask
+    if not features & _GENERATE_FEATURES and STYLE_ATTRIBUTE != 'style':
+      if self.verbose: print >> sys.stderr, "-------- Nothing to generate"
+      return html
+
+    moves = False
+    if features & (FEATURE_TARGETS | FEATURE_MOVE):
+      if self.verbose: print >> sys.stderr, "-------- Finding target nodes ( CSS target-counter() or target-text() ) : %d" % len(self.styles)
+      moves = self.find_targets()
+      if stats is not None: stats.lap('find_targets', len(self.styles))
+
+    if self.verbose: print >> sys.stderr, "-------- Creating pseudo elements ( CSS :before and :after ), running counters and generating simple content",
+    count = self.generate(html.getroot())
+    if self.verbose: print >> sys.stderr, ": %d" % count
+    if stats is not None: stats.lap('generate', count)
 
     if self.verbose: print >> sys.stderr, "-------- Resolving link counters ( CSS3 target-counter ) : %d" % len(self.reprocess)
-    for (node, self.evaluator.state.countersAt) in self.reprocess:
-      self.evaluator.state.counters = self.evaluator.state.countersAt
-      d = PropertyParser().parse(node.attrib.get(STYLE_ATTRIBUTE, ''))
-      if 'content' in d:
-        self._replace_content(node, d['content'])
-        # also remove non-pseudo elements
-        for child in node:
-          if not self.is_pseudo(child):
-            node.remove(child)
-    
-    if self.verbose: print >> sys.stderr, "-------- Moving nodes ( CSS3 http://www.w3.org/TR/css3-content/#moving ) : %d" % len(nodes)
-    nodes = xpath(html) # we may have removed nodes re-self.update
-    move_to_destinations = {} # name -> list of nodes waiting to be dumped
-    for node in nodes:
-      style = PropertyParser().parse(node.attrib.get(STYLE_ATTRIBUTE, ''))
-      if 'move-to' in style:
-        dest = style['move-to']
-        if dest != 'here': # Ignore if it's 'here'
-          if dest not in move_to_destinations: move_to_destinations[dest] = []
-          move_to_destinations[dest].append(node)
-          # Can't just remove the node. because of tails...
-          if node.tail is not None:
-            if node.getprevious() is not None:
-              if node.getprevious().tail is not None:
-                node.getprevious().tail += node.tail
-              else:
-                node.getprevious().tail = node.tail
-            else:
-              if node.getparent().text is not None:
-                node.getparent().text += node.tail
-              else:
-                node.getparent().text = node.tail
-            node.tail = None
-          node.getparent().remove(node)
-          
-      if 'content' in style:
-        for (name, pending_name) in style['content']:
-          if 'pending' == name:
-            #TODO remove all children and text
-            pending_name = str(pending_name)
-            if pending_name in move_to_destinations:
-              for n in move_to_destinations[pending_name]:
-                node.append(n)
-              move_to_destinations[pending_name] = []
+    self.resolve_targets()
+    if stats is not None: stats.lap('resolve_targets', len(self.reprocess))
+    self.finish(html, moves)
+    if stats is not None: self._count_targets()
+    return html
+
+  def transform_cached(self, html, explicit_styles, cache, pretty_print = True):
+    """ Same as etree.tostring(self.transform(html, explicit_styles, pretty_print), encoding='ascii') but the
+        output is kept in cache (a custom.cache.DiskCache) under result_key() so transforming the same
+        input again returns it without parsing anything """
+    if isinstance(explicit_styles, (basestring, CompiledStylesheet)):
+      explicit_styles = [explicit_styles]
+    key = self.result_key(html, explicit_styles, pretty_print)
+    output = None
+    if key is not None:
+      output = cache.get(key)
+    if self.stats is not None: self.stats.count(output is None and 'cache_misses' or 'cache_hits')
+    if output is None:
+      output = etree.tostring(self.transform(html, explicit_styles, pretty_print), encoding='ascii')
+      if key is not None:
+        cache.put(key, output)
+    return output
+
+  def result_key(self, html, explicit_styles, pretty_print = True):
+    """ A hash of everything the output of transform() depends on: the HTML, the CSS (as compiled by
+        compile_stylesheet, see stylesheet_key), the supported features (the --no-* flags), pseudo_element_name,
+        the counters and strings the document starts with, RESULT_VERSION, the lxml version and the code (see _code_version).
+        None if it can not be known (a CompiledStylesheet that is not the compile of some CSS) """
+    state = self.evaluator.state
+    h = hashlib.sha1()
+    h.update(repr((RESULT_VERSION, etree.LXML_VERSION, _code_version(), sorted(self.supported_properties.items()), sorted(self.supported_content.items()),
+                   self.pseudo_element_name, STYLE_ATTRIBUTE, pretty_print, sorted(state.counters.items()), sorted(state.strings.items()))))
+    for css in explicit_styles:
+      # The key of the compiled CSS (normalized: a change to the comments or whitespace is still a hit)
+      if isinstance(css, CompiledStylesheet):
+        if css.key is None:
+          return None
+        h.update(css.key)
+      else:
+        h.update(stylesheet_key([css], supported_properties=self.supported_properties, supported_content=self.supported_content))
+    if isinstance(html, unicode):
+      html = html.encode('utf-8')
+    h.update(html)
+    return h.hexdigest()
+
+  def transform_book(self, chapters, explicit_styles = [], pretty_print = True):
+    """ Transforms the chapters of a book as if they were one document, without merging them.
+        chapters is a list of (name, html) in reading order, the names being the paths links use
+        ('text/chapter3.xhtml'). Counters and strings carry over from one chapter to the next and
+        target-counter() and target-text() resolve links to other chapters ('chapter3.xhtml#fig12',
+        relative to the chapter the link is in) as well as '#fig12' within a chapter.
+        Returns [(name, tree)] in the same order """
+    if isinstance(explicit_styles, (basestring, CompiledStylesheet)):
+      explicit_styles = [explicit_styles]
+    # Parsed once for all the chapters
+    explicit_styles = [isinstance(css, CompiledStylesheet) and css or self.compile_stylesheet(css) for css in explicit_styles]
+
+    # Every chapter has its own StyleStore (and link targets) but the counters, strings and
+    # the id index (node_at) are shared: all the targets are found before any chapter is generated
+    # and the links are resolved once all of them are
+    stats = self.stats
+    if stats is not None: stats.start()
+    book = []
+    for (name, html) in chapters:
+      name = posixpath.normpath(name)
+      self.evaluator.document = name
+      self.styles = StyleStore()
+      if self.verbose: print >> sys.stderr, "-------- Matching styles of %s" % name
+      p = self._premailer(html, explicit_styles)
+      tree = p.transform_tree(pretty_print=pretty_print)
+      if stats is not None: self._count_rules(p)
+      moves = False
+      if p.feature_mask & (FEATURE_TARGETS | FEATURE_MOVE):
+        moves = self.find_targets()
+        if stats is not None: stats.lap('find_targets', len(self.styles))
+      book.append([name, tree, self.styles, moves, None])
+
+    for chapter in book:
+      (name, tree, self.styles, moves, _) = chapter
+      self.evaluator.document = name
+      if self.verbose: print >> sys.stderr, "-------- Generating content of %s" % name
+      self.reprocess = []
+      self.moving = [] if moves else None
+      count = self.generate(tree.getroot())
+      if stats is not None: stats.lap('generate', count)
+      chapter[3] = self.moving
+      chapter[4] = self.reprocess
+
+    for (name, tree, self.styles, self.moving, self.reprocess) in book:
+      self.evaluator.document = name
+      if self.verbose: print >> sys.stderr, "-------- Resolving link counters of %s : %d" % (name, len(self.reprocess))
+      self.resolve_targets()
+      if stats is not None: stats.lap('resolve_targets', len(self.reprocess))
+      self.finish(tree, self.moving is not None)
+    if stats is not None: self._count_targets()
+    self.reprocess = []
+    self.moving = None
+    self.evaluator.document = None
+    return [(name, tree) for (name, tree, _, _, _) in book]
+
+  def transform_book_parallel(self, chapters, explicit_styles = [], pretty_print = True, processes = None):
+    """ Same as transform_book but the chapters are transformed in a multiprocessing pool of processes workers
+        (one per CPU by default), one chapter per task, and come back serialized:
+        [(name, etree.tostring(tree, encoding='ascii'))].
+        A quick first pass that only runs the rules the counters depend on (see _prescan_rules) finds the
+        State every chapter starts with and the State (and, for target-text(), a copy of the element)
+        of the targets in other chapters each chapter links to """
+    if isinstance(explicit_styles, (basestring, CompiledStylesheet)):
+      explicit_styles = [explicit_styles]
+    explicit_styles = [isinstance(css, CompiledStylesheet) and css or self.compile_stylesheet(css) for css in explicit_styles]
+    chapters = [(posixpath.normpath(name), html) for (name, html) in chapters]
+
+    if self.verbose: print >> sys.stderr, "-------- Running the counters of %d chapters" % len(chapters)
+    tasks = []
+    for (name, html, state, targets) in self._prescan_book(chapters, explicit_styles, pretty_print):
+      tasks.append((name, html, state, targets, pretty_print))
+    if self.verbose: print >> sys.stderr, "-------- Transforming the chapters"
+    pool = multiprocessing.Pool(processes, _init_book_worker, (self.args, self.pseudo_element_name, explicit_styles))
+    try:
+      book = pool.map(_transform_book_chapter, tasks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+    return zip([name for (name, _) in chapters], book)
+
+  def _prescan_book(self, chapters, explicit_styles, pretty_print):
+    """ Runs the counters (and the strings) of the whole book.
+        Yields (name, html, State at the start of the chapter, {id: (serialized element or None, State)})
+        with the targets in other chapters the chapter links to """
+    scan = AddNumbering(self.args, self.pseudo_element_name)
+    scan.stats = scan.explain = None # the prescan is not what is measured
+    keep = _prescan_rules(sum([sheet.rules for sheet in explicit_styles], []))
+    styles = [sheet.subset(keep) for sheet in explicit_styles]
+    book = []
+    for (name, html) in chapters:
+      (tree, store, targets) = scan._scan_chapter(name, html, styles, pretty_print)
+      book.append((name, html, tree, store, targets))
+
+    starts = []
+    references = []
+    for (name, _, tree, scan.styles, _) in book:
+      scan.evaluator.document = name
+      starts.append(State(scan.evaluator.state))
+      scan.reprocess = []
+      scan.generate(tree.getroot())
+      references.append(scan.reprocess)
+
+    # The text of a target in a later chapter is read before its references are written, in an earlier one after
+    positions = dict((name, index) for (index, (name, _, _, _, _)) in enumerate(book))
+    texts = {} # chapter name -> the ids other chapters need the text of
+    for (_, _, _, _, targets) in book:
+      for (id, text) in targets.items():
+        if text and scan.node_at.get(id) is not None:
+          texts.setdefault(id.partition('#')[0], set()).add(id)
+    written = {}
+    unwritten = dict((id, etree.tostring(scan.node_at[id][0], with_tail=False)) for ids in texts.values() for id in ids)
+    for ((name, _, _, store, _), chapter_references) in zip(book, references):
+      if name in texts:
+        written.update(scan._resolve_chapter(name, store, chapter_references, {}, texts[name]))
+
+    for (index, ((name, html, _, _, targets), state)) in enumerate(zip(book, starts)):
+      saved = {}
+      for (id, text) in targets.items():
+        target = scan.node_at.get(id)
+        if target is not None:
+          node = None
+          if text:
+            node = (written if positions[id.partition('#')[0]] < index else unwritten)[id]
+          target = (node, target[1])
+        saved[id] = target
+      yield (name, html, state, saved)
+
+  def _resolve_chapter(self, name, styles, references, targets, ids):
+    """ Writes the references of one prescanned chapter (after the ones of the chapters before it, like
+        transform_book) with targets ({id: (element, State)}) for the ones in other chapters node_at does not have.
+        Returns {id: serialized element} for ids (the targets in it other chapters need the text of) """
+    self.evaluator.document = name
+    self.styles = styles
+    self.reprocess = references
+    self.node_at.update(targets)
+    self.resolve_targets()
+    self.reprocess = []
+    return dict((id, etree.tostring(self.node_at[id][0], with_tail=False)) for id in ids)
+
+  def _generate_chapter(self, name, scanned, start):
+    """ Runs the counters of one chapter of transform_book_incremental: scanned is (tree, StyleStore) from
+        _scan_chapter and start the State it starts with. Returns (StyleStore, _References) for _resolve_chapter """
+    (tree, self.styles) = scanned
+    self.evaluator.document = name
+    self.evaluator.state = _chapter_state(start)
+    self.reprocess = []
+    self.generate(tree.getroot())
+    references = self.reprocess
+    self.reprocess = []
+    return (self.styles, references)
+
+  def _unwritten_exports(self, needed):
+    """ ChapterRender.exports of the chapter just generated (its references are not written yet) """
+    exports = {}
+    for (id, text) in needed.items():
+      target = self.node_at.get(id)
+      if target is not None:
+        (node, target_state) = target
+        node = text and etree.tostring(node, with_tail=False) or None
+        target = (node, node) + _state_writes(target_state)
+      exports[id] = target
+    return exports
+
+  def _scan_chapter(self, name, html, styles, pretty_print):
+    """ Matches the (prescan) styles of one chapter and registers its targets.
+        Returns (tree, StyleStore, {id: whether target-text() needs its text}) with the targets in other chapters it links to """
+    self.evaluator.document = name
+    self.styles = StyleStore()
+    tree = self._premailer(html, styles).transform_tree(pretty_print=pretty_print)
+    targets = {}
+    for (element, _, style) in self.styles.iterparsed():
+      for (id, function) in self._register_targets(element, style):
+        if not id.startswith(name + '#'):
+          targets[id] = targets.get(id) or function == 'target-text'
+    return (tree, self.styles, targets)
+
+  def transform_book_incremental(self, chapters, explicit_styles = [], previous = None, pretty_print = True):
+    """ Same as transform_book_parallel (in this process) for a book that is transformed again and again as it is edited.
+        Every chapter records what it depends on (see ChapterRender): the incoming counters and strings it reads,
+        the targets in other chapters it links to and the ids other chapters link to in it. Given previous (the BookRender
+        an earlier call returned) a chapter is only prescanned again if its HTML or the incoming values it read changed
+        (or another chapter now needs a target it did not record) and only transformed again if it was prescanned or
+        the targets it links to changed; otherwise its previous output is reused.
+        Returns a BookRender """
+    if isinstance(explicit_styles, (basestring, CompiledStylesheet)):
+      explicit_styles = [explicit_styles]
+    explicit_styles = [isinstance(css, CompiledStylesheet) and css or self.compile_stylesheet(css) for css in explicit_styles]
+    chapters = [(posixpath.normpath(name), html) for (name, html) in chapters]
+    key = (tuple([sheet.key for sheet in explicit_styles]), pretty_print, self.pseudo_element_name, _code_version())
+    before = {}
+    if previous is not None and previous.key == key and None not in key[0]:
+      before = dict((chapter.name, chapter) for chapter in previous.chapters)
+
+    scan = AddNumbering(self.args, self.pseudo_element_name)
+    scan.stats = scan.explain = None
+    keep = _prescan_rules(sum([sheet.rules for sheet in explicit_styles], []))
+    styles = [sheet.subset(keep) for sheet in explicit_styles]
+
+    # What every chapter links to (only the chapters whose HTML changed are parsed)
+    records = []
+    scanned = {} # name -> (tree, StyleStore)
+    for (name, html) in chapters:
+      record = ChapterRender(name, hashlib.md5(html).hexdigest())
+      old = before.get(name)
+      if old is not None and old.digest == record.digest:
+        record.references = old.references
+      else:
+        before.pop(name, None)
+        (tree, store, record.references) = scan._scan_chapter(name, html, styles, pretty_print)
+        scanned[name] = (tree, store)
+      records.append(record)
+    wanted = {} # chapter name -> {id: whether target-text() needs its text}
+    for record in records:
+      for (id, text) in record.references.items():
+        ids = wanted.setdefault(id.partition('#')[0], {})
+        ids[id] = ids.get(id) or text
+        scan.node_at.setdefault(id, None)
+
+    if self.verbose: print >> sys.stderr, "-------- Running the counters of %d chapters" % len(chapters)
+    state = State()
+    starts = {}
+    generated = {} # name -> (StyleStore, _References) of the chapters prescanned again
+    for (record, (name, html)) in zip(records, chapters):
+      starts[name] = state
+      old = before.get(name)
+      needed = wanted.get(name, {})
+      if old is not None and _reads_match(old.reads, state) and _covers(old.exports, needed):
+        record.reads = old.reads
+        record.writes = old.writes
+        record.exports = dict((id, old.exports[id]) for id in needed)
+      else:
+        if name not in scanned:
+          scanned[name] = scan._scan_chapter(name, html, styles, pretty_print)[:2]
+        generated[name] = scan._generate_chapter(name, scanned.pop(name), state)
+        record.reads = _state_reads(scan.evaluator.state)
+        record.writes = _state_writes(scan.evaluator.state)
+        record.exports = scan._unwritten_exports(needed)
+      state = _apply_writes(state, record.writes)
+
+    # The references are written chapter after chapter (like transform_book does): a chapter reads the text
+    # of a target in an earlier chapter with its references written and in a later one without them
+    exports = dict((record.name, record) for record in records)
+    positions = dict((record.name, index) for (index, record) in enumerate(records))
+    for (index, (record, (name, html))) in enumerate(zip(records, chapters)):
+      record.inputs = {}
+      for id in record.references:
+        owner = exports.get(id.partition('#')[0])
+        target = owner and owner.exports.get(id)
+        if target is not None:
+          (unwritten, written, counters, strings) = target
+          node = written if positions[owner.name] < index else unwritten
+          target = (node,) + _state_items(_apply_writes(starts[owner.name], (counters, strings)))
+        record.inputs[id] = target
+      texts = [id for (id, target) in record.exports.items() if target is not None and target[0] is not None]
+      if not texts:
+        continue
+      old = before.get(name)
+      if name not in generated:
+        if old.inputs == record.inputs:
+          continue # the written texts did not change
+        generated[name] = scan._generate_chapter(name, scan._scan_chapter(name, html, styles, pretty_print)[:2], starts[name])
+      targets = {}
+      for (id, target) in record.inputs.items():
+        if id.partition('#')[0] not in generated:
+          if target is not None:
+            node = None
+            if target[0] is not None:
+              node = etree.fromstring(target[0])
+            target = (node, _apply_writes(State(), target[1:]))
+          targets[id] = target
+      (store, references) = generated[name]
+      written = scan._resolve_chapter(name, store, references, targets, texts)
+      for id in texts:
+        record.exports[id] = (record.exports[id][0], written[id]) + record.exports[id][2:]
+
+    if self.verbose: print >> sys.stderr, "-------- Transforming the chapters that changed"
+    rendered = []
+    for (record, (name, html)) in zip(records, chapters):
+      old = before.get(name)
+      if name not in generated and old is not None and old.inputs == record.inputs:
+        record.output = old.output
+        continue
+      targets = {}
+      for (id, target) in record.inputs.items():
+        if target is not None:
+          target = (target[0], _apply_writes(State(), target[1:]))
+        targets[id] = target
+      state = _chapter_state(starts[name])
+      record.output = AddNumbering(self.args, self.pseudo_element_name)._transform_chapter(name, html, explicit_styles, state, targets, pretty_print)
+      # The content reads more than the prescan
+      reads = _state_reads(state)
+      record.reads = (dict(record.reads[0], **reads[0]), dict(record.reads[1], **reads[1]))
+      rendered.append(name)
+    return BookRender(key, records, rendered)
+
+  def _transform_chapter(self, name, html, explicit_styles, state, targets, pretty_print):
+    """ Transforms one chapter of transform_book_parallel starting with the counters in state
+        and the targets in other chapters from _prescan_book """
+    self.evaluator.document = name
+    self.evaluator.state = state
+    for (id, target) in targets.items():
+      if target is not None and target[0] is not None:
+        target = (etree.fromstring(target[0]), target[1])
+      self.node_at[id] = target
+    tree = self._premailer(html, explicit_styles).transform_tree(pretty_print=pretty_print)
+    moves = self.find_targets()
+    self.generate(tree.getroot())
+    self.resolve_targets()
+    self.finish(tree, moves)
+    return etree.tostring(tree, encoding='ascii')
+
+  def resolve_targets(self):
+    """ Writes the content that looks up a target (target-counter(), target-text()) once all the targets are known """
+    for reference in self.reprocess:
+      node = reference.node
+      self._write_reference(reference)
+      # also remove non-pseudo elements
+      for child in node:
+        if not self.is_pseudo(child):
+          node.remove(child)
+      self.evaluator.changed(node)
+
+  def finish(self, html, moves):
+    """ Moves the nodes (move-to) and writes the styles back into STYLE_ATTRIBUTE if it is 'style' """
+    stats = self.stats
+    xpath = etree.XPath('//*')
+    if moves:
+      count = self.move(html.getroot())
+      if stats is not None: stats.lap('move', count)
     
-    # Clean up the HTML.
-    if STYLE_ATTRIBUTE != 'style':
+    if STYLE_ATTRIBUTE == 'style':
+      nodes = xpath(html)
       for node in nodes:
-        if STYLE_ATTRIBUTE in node.attrib:
-          del node.attrib[STYLE_ATTRIBUTE]
-    
-    return html
+        d = self.styles.get(node)
+        if d:
+          node.attrib[STYLE_ATTRIBUTE] = _style_to_string(d)
+      if stats is not None: stats.lap('cleanup', len(nodes))
+
+  def _count_rules(self, p):
+    """ Records the premailer pass (p is the Premailer that just ran) in self.stats """
+    stats = self.stats
+    stats.lap('premailer', len(self.styles))
+    stats.count('rules_applied', p.applied_rules)
+    stats.count('rules_skipped', p.skipped_rules)
+    stats.count('rule_matches', p.matches)
+
+  def _count_targets(self):
+    """ Records the ids target-counter() and target-text() looked up (and how many were found) in self.stats """
+    self.stats.count('targets_registered', len(self.node_at))
+    self.stats.count('targets_resolved', len([target for target in self.node_at.values() if target is not None]))
+
+  def _premailer(self, html, explicit_styles):
+    return premailer.Premailer(html, supported_properties=self.supported_properties, supported_content=self.supported_content, explicit_styles=explicit_styles, remove_classes=False, custom_style_attrib=STYLE_ATTRIBUTE, verbose=self.verbose, style_store=self.styles, explain=self.explain,
+                               skip_inert=STYLE_ATTRIBUTE != 'style')
+
+  def find_targets(self):
+    """ Registers every id that target-counter() or target-text() looks up (so mutate_node saves the state there).
+        The matched styles are all in self.styles so this does not walk the tree.
+        Returns whether any node is moved somewhere else (move-to): then generate records them in self.moving """
+    moves = False
+    for (element, class_, style) in self.styles.iterparsed():
+      if style.get('move-to', 'here') != 'here':
+        moves = True
+      self._register_targets(element, style)
+    self.moving = [] if moves else None
+    return moves
+
+  def _register_targets(self, element, style):
+    """ Registers the ids looked up by the target-counter() and target-text() in style
+        (the declarations of element or of one of its pseudo elements).
+        Returns them as [(id, function)] """
+    targets = []
+    for (function, args) in style.get('content') or ():
+      attr = None
+      if function == 'target-counter': (attr, _, _) = args
+      if function == 'target-text': (attr, _) = args
+      if attr:
+        # A pseudo element uses the attribute of the element it belongs to
+        id = element.attrib.get(attr, '')
+        if id:
+          id = self.evaluator.target_id(id)
+          self.node_at.setdefault(id, None)
+          targets.append((id, function))
+        else:
+          if self.verbose: print >> sys.stderr, "WARNING: Ignoring lookup to a non-internal id: '%s' on a %s" % (id, element.tag)
+    return targets
+
+  def generate(self, root):
+    """ One walk over the tree, in document order, that expands the pseudo elements (removing the hidden nodes),
+        runs the counters and generates the simple content.
+        Returns the number of nodes visited """
+    styles = self.styles
+    node_at = self.node_at
+    pseudos = set() # created by expand_pseudo (already expanded)
+    count = 0
+    stack = [root]
+    while stack:
+      node = stack.pop()
+      if not isinstance(node.tag, basestring):
+        continue # comments and processing instructions
+      if node in pseudos:
+        self.mutate_node(node)
+      elif node in styles:
+        if not self.expand_pseudo(node, created=pseudos):
+          continue # hidden
+        self.mutate_node(node)
+      elif node_at:
+        # Nothing matched the node but a target-counter may still point to it
+        id = node.attrib.get('id', None)
+        if id:
+          id = self.evaluator.element_id(id)
+          if id in node_at:
+            self._save_target(id, node)
+      count += 1
+      stack.extend(reversed(node))
+    if self.stats is not None: self.stats.count('pseudo_elements', len(pseudos))
+    return count
+
+  def move(self, root):
+    """ http://www.w3.org/TR/css3-content/#moving
+        Moves the nodes (move-to: name) generate found, in document order, to the first destination (content: pending(name))
+        with their name after them or, if there is none, to the last one before them (a node without any destination is removed).
+        Only the moved nodes and the destinations are visited. Returns the number of nodes moved """
+    sources = [] # (position, name, node) in document order
+    destinations = {} # name -> ([positions], [nodes]) in document order
+    for (position, (name, node, destination)) in enumerate(self.moving or ()):
+      if not _attached(node, root):
+        continue # removed since (see resolve_targets)
+      if destination:
+        (positions, nodes) = destinations.setdefault(name, ([], []))
+        positions.append(position)
+        nodes.append(node)
+      else:
+        sources.append((position, name, node))
+    if self.verbose: print >> sys.stderr, "-------- Moving nodes ( CSS3 http://www.w3.org/TR/css3-content/#moving ) : %d" % len(sources)
+
+    # The tail of a moved node stays where it was: it is added to the tail of the previous sibling (or the text of the parent).
+    # The earlier siblings have been moved already so the previous sibling is the one that stays.
+    # Every tail or text is only joined once, at the end
+    texts = {} # (node, 'tail' or 'text') -> [text]
+    changed = self.evaluator.changed
+    for (position, name, node) in sources:
+      parent = node.getparent()
+      if parent is None:
+        continue
+      changed(parent)
+      if node.tail:
+        previous = node.getprevious()
+        key = previous is not None and (previous, 'tail') or (parent, 'text')
+        texts.setdefault(key, []).append(node.tail)
+        node.tail = None
+      parent.remove(node)
+      if name in destinations:
+        (positions, nodes) = destinations[name]
+        i = bisect.bisect_right(positions, position)
+        nodes[min(i, len(nodes) - 1)].append(node)
+        changed(node)
+    for ((node, where), pieces) in texts.iteritems():
+      if where == 'tail':
+        node.tail = (node.tail or '') + ''.join(pieces)
+      else:
+        node.text = (node.text or '') + ''.join(pieces)
+    return len(sources)
+
+  def transform_stream(self, source, output, explicit_styles = []):
+    """ Same as transform() for documents too big to keep in memory.
+        source (a filename or a file) is parsed incrementally and every element is written to the output file
+        as soon as it is finished, so memory is bounded by the nesting depth and by the targets that
+        target-counter() and target-text() still have to look up.
+        If the CSS uses target-counter() or target-text() the document is read twice: a first pass that writes
+        nothing saves the counters (and text) of the targets that are referenced before they occur.
+
+        Unlike transform():
+        - the output is not pretty printed, has no DOCTYPE and the attributes may be in a different order
+        - the rules in a <style> element only apply to the elements after it
+        - move-to, pseudo-classes (:first-child, :not(), ...), the + and ~ combinators and selectors on the
+          attributes the CSS turns into HTML attributes (align, bgcolor, width, height) raise UnsupportedError
+        - target-text() of an element that contains the reference only has the text before the reference """
+    if isinstance(explicit_styles, (basestring, CompiledStylesheet)):
+      explicit_styles = [explicit_styles]
+    rules = self._premailer(None, explicit_styles).explicit_rules()
+    opened = None
+    if isinstance(source, basestring):
+      source = opened = open(source, 'rb')
+    try:
+      if _uses_targets(rules):
+        if self.verbose: print >> sys.stderr, "-------- Finding target nodes ( CSS target-counter() or target-text() )"
+        source = _rewindable(source)
+        start = source.tell()
+        scan = AddNumbering(self.args, self.pseudo_element_name)
+        scan._scanning = True
+        scan._references = {}
+        scan._stream(source, None, rules)
+        source.seek(start)
+        self.node_at.update(scan.node_at)
+        self._references = scan._references
+        self._text_targets = scan._text_targets
+        for id in self._references:
+          self.node_at.setdefault(id, None)
+      if self.verbose: print >> sys.stderr, "-------- Streaming"
+      self._stream(source, output, rules)
+    finally:
+      if opened is not None:
+        opened.close()
+
+  def _stream(self, source, output, rules):
+    """ One pass of transform_stream over the document (nothing is written when output is None) """
+    p = self._premailer(None, [])
+    index = RuleIndex()
+    self._index_rules(index, p.applying(rules), (1,))
+    style_elements = 0
+    stack = []
+    for (event, element) in _iterparse(source):
+      if event == 'start':
+        parent = None
+        if stack: parent = stack[-1]
+        frame = _Frame(element, parent, output is not None)
+        stack.append(frame)
+        if frame.skip:
+          continue
+        if parent is not None:
+          # The text of the parent is known now
+          if not parent.processed:
+            self._stream_process(parent, output)
+          self._stream_flush(parent, element, output)
+          frame.emit = parent.emit and not parent.replaced
+        if element.tag == 'style':
+          # Compiled once it ends (see below)
+          frame.skip = frame.style = True
+          continue
+        matched = index.match(element)
+        if matched:
+          first_time_styles = []
+          p.merge_matched(element, matched, first_time_styles)
+          p.merge_inline_styles(first_time_styles)
+        d = self.styles.get(element)
+        if 'display' in d and 'none' == d['display']:
+          frame.skip = True
+          self._dropped.add(element)
+          self.styles.discard(element)
+          continue
+        for class_ in self.styles.pseudos(element).keys():
+          for (id, function) in self._register_targets(element, self.styles.parsed(element, class_)):
+            if function == 'target-text':
+              self._text_targets.add(id)
+            if self._scanning:
+              self._references[id] = self._references.get(id, 0) + 1
+            frame.references.append(id)
+        id = element.get('id')
+        if id and id in self._text_targets:
+          frame.retain = True
+      else:
+        frame = stack.pop()
+        if frame.style:
+          sheet = p.style_element_sheet(element, as_tree=True)
+          style_elements += 1
+          style_rules = list(p.applying(sheet.rules))
+          if self._references is None and _uses_targets(style_rules):
+            raise UnsupportedError("target-counter() and target-text() in a <style> element can not be streamed, pass the CSS in instead")
+          self._index_rules(index, style_rules, (0, style_elements))
+          if not sheet.leftover and not p.keep_style_tags:
+            self._dropped.add(element)
+        elif frame.skip:
+          del element[:] # hidden so nothing inside is written
+        else:
+          self._stream_close(frame, output)
+
+  def _index_rules(self, index, rules, position):
+    """ Adds the rules to the RuleIndex, after checking they can be streamed """
+    rules = list(rules)
+    for (i, rule) in enumerate(rules):
+      if rule.match_plan is None:
+        raise UnsupportedError("The selector %r can not be streamed" % (rule.selector + rule.class_))
+      if [combinator for (_, combinator) in rule.match_plan if combinator in ('+', '~')]:
+        raise UnsupportedError("The selector %r can not be streamed (the previous siblings are already written)" % rule.selector)
+      if rule.parsed.get('move-to', 'here') != 'here':
+        raise UnsupportedError("move-to can not be streamed")
+      index.add(position + (i,), rule)
+    if premailer.changes_matched_attributes(rules):
+      raise UnsupportedError("Selectors on the attributes set by text-align, background-color, width or height can not be streamed")
+
+  def _stream_process(self, frame, output, leaf = False):
+    """ Adds the pseudo elements and generates the content of an element once its text is known:
+        when its first child starts or, for a leaf, when it ends.
+        The start tag (and :before) of an element with children is written right away """
+    node = frame.element
+    frame.processed = True
+    pseudos = self.styles.pseudos(node)
+    before = after = None
+    if ':before' in pseudos:
+      before = self._add_pseudo(node, ':before')
+    if leaf and ':after' in pseudos:
+      # Added before the content is generated, like expand_pseudo does
+      after = self._add_pseudo(node, ':after')
+    self._stream_mutate(frame, node)
+    for pseudo in (before, after):
+      if pseudo is not None:
+        self._stream_mutate(frame, pseudo)
+        self.styles.discard(pseudo)
+    if leaf:
+      if frame.replaced:
+        for child in list(node):
+          if not (isinstance(child.tag, basestring) and self.is_pseudo(child)):
+            node.remove(child)
+      return
+
+    if frame.emit:
+      shell = copy.copy(node)
+      shell.tail = None
+      del shell[before is not None and 1 or 0:]
+      etree.SubElement(shell, _STREAM_MARK)
+      start = self._serialize(shell, with_tail=False)
+      mark = start.rindex('<' + _STREAM_MARK)
+      output.write(start[:mark])
+      frame.close = start[mark + len(_STREAM_MARK) + 3:]
+      self._opened.add(node)
+    if frame.retain:
+      if before is not None:
+        frame.flushed = 1
+    else:
+      node.text = None
+      if before is not None:
+        node.remove(before)
+
+  def _stream_mutate(self, frame, node):
+    """ mutate_node, but content that looks up a target is generated right away:
+        the target was either already seen or saved by the first pass """
+    self.mutate_node(node)
+    reprocess = self.reprocess
+    self.reprocess = []
+    if self._scanning:
+      return # Not all the targets are known yet
+    for reference in reprocess:
+      self._write_reference(reference)
+      if reference.node is frame.element:
+        frame.replaced = True # the (non-pseudo) children are dropped
+
+  def _stream_flush(self, frame, upto, output):
+    """ Writes (and forgets) the children of an element that come before upto (all of them if upto is None) """
+    node = frame.element
+    i = frame.flushed
+    while i < len(node):
+      child = node[i]
+      if child is upto:
+        break
+      if child in self._dropped or (frame.replaced and not (isinstance(child.tag, basestring) and self.is_pseudo(child))):
+        self._dropped.discard(child)
+        self._opened.discard(child)
+        del node[i] # along with its tail
+        continue
+      if frame.emit:
+        if child in self._opened:
+          output.write(_escape_text(child.tail))
+        else:
+          output.write(self._serialize(child))
+      self._opened.discard(child)
+      if frame.retain:
+        i += 1
+      else:
+        del node[i]
+    frame.flushed = i
+
+  def _stream_close(self, frame, output):
+    node = frame.element
+    if not frame.processed:
+      self._stream_process(frame, output, leaf=True)
+      # Written (with its tail) by the parent
+      if frame.parent is None and frame.emit:
+        output.write(self._serialize(node, with_tail=False))
+    else:
+      self._stream_flush(frame, None, output)
+      if ':after' in self.styles.pseudos(node):
+        after = self._add_pseudo(node, ':after')
+        if after is not None:
+          self._stream_mutate(frame, after)
+          self.styles.discard(after)
+          if frame.emit:
+            output.write(self._serialize(after, with_tail=False))
+          if not frame.retain:
+            node.remove(after)
+      if frame.emit:
+        output.write(frame.close)
+    self.styles.discard(node)
+    if self._scanning:
+      # target-counter() only needs the counters
+      id = node.get('id')
+      if id and id not in self._text_targets and self.node_at.get(id):
+        self.node_at[id] = (None, self.node_at[id][1])
+    else:
+      # Forget the targets nothing will look up anymore
+      for id in frame.references:
+        count = self._references.get(id, 0) - 1
+        if count > 0:
+          self._references[id] = count
+        else:
+          self._references.pop(id, None)
+          self.node_at.pop(id, None)
+          self._text_targets.discard(id)
+
+  def _serialize(self, element, with_tail = True):
+    attributes = ('style', STYLE_ATTRIBUTE)
+    premailer.finish_tree(element, False, attributes)
+    return etree.tostring(element, encoding='ascii', with_tail=with_tail)
+
+  def _pseudo_tag(self, parent):
+    """ The HTML parser does not know about namespaces (xmlns is just an attribute)
+        so use the local name when the pseudo element is in the default namespace of its parent """
+    name = self.pseudo_element_name
+    if name.startswith('{'):
+      (namespace, local) = name[1:].split('}', 1)
+      while parent is not None:
+        default = parent.get('xmlns')
+        if default is not None:
+          if default == namespace:
+            return local
+          break
+        parent = parent.getparent()
+    return name
 
   def is_pseudo(self, node):
     return node.attrib.get('class', '') in ('pseudo-before', 'pseudo-after')
@@ -184,27 +940,30 @@ class AddNumbering(object):
     if 'counter-increment' in d:
       for (name, v) in d['counter-increment']:
         if self.verbose: print >> sys.stderr, "Incrementing %s by %s" % (name, str(v))
-        if name not in self.evaluator.state.counters:
-          self.evaluator.state.counters[name] = 0
-        self.evaluator.state.counters[name] += v
+        counters = self.evaluator.state.counters
+        counters[name] = counters.get(name, 0) + v
 
   def mutate_node(self, node):
-    d = PropertyParser().parse(node.attrib.get(STYLE_ATTRIBUTE, ''))
-    if d:
+    d = self.styles.parsed(node)
+    if self.moving is not None and d:
+      self._record_move(node, d)
+    if 'counter-reset' in d or 'counter-increment' in d:
       self.update_counters(node, d)
     # if there's a target-counter pointing to this node, squirrel the counter (TODO: Should this be done _before_ incrementing?)
     id = node.attrib.get('id', None)
-    if id and id in self.node_at:
-      self.node_at[id] = (node, State(self.evaluator.state))
+    if id:
+      id = self.evaluator.element_id(id)
+      if id in self.node_at:
+        self._save_target(id, node)
     if d:
-      # We'll have to look up the id later to find the counter
+      # The targets that come later (and the text of all of them) are filled in later
+      content_target = False
       if 'content' in d:
-        has_target = False
         for (key, _) in d['content']:
           if key in [ 'target-counter', 'target-text' ]:
-            has_target = True
-        if has_target:
-          self.reprocess.append((node, State(self.evaluator.state)))
+            content_target = True
+        if content_target:
+          self._reference(node, d['content'])
         else:
           self._replace_content(node, d['content'])
       # http://www.w3.org/TR/css3-gcpm/#setting-named-strings-the-string-set-pro
@@ -215,7 +974,9 @@ class AddNumbering(object):
             if operation in [ 'target-counter', 'target-text' ]:
               has_target = True
         if has_target:
-          self.reprocess.append((node, State(self.evaluator.state)))
+          # The string is not set but resolve_targets still replaces the content (and drops the children)
+          if 'content' in d and not content_target:
+            self._reference(node, d['content'])
         else:
           for (string_name, string_value) in d['string-set']:
             string_computed = self.evaluator.eval_content(node, string_value)
@@ -223,54 +984,350 @@ class AddNumbering(object):
             print "Setting string %s to [%s]" % (string_name, string_computed)
             self.evaluator.state.strings[string_name] = string_computed
 
-  def expand_pseudo(self, node, style, class_ = ''):
-    d = parse_style(style, class_)
-    
+  def _save_target(self, id, node):
+    """ Saves the counters at node (the target with that id) and fills in the target-counter()s that were waiting for it """
+    state = State(self.evaluator.state)
+    self.node_at[id] = (node, state)
+    for (reference, index, (_, name, numbering)) in self.waiting.pop(id, ()):
+      reference.pieces[index] = self.evaluator.format_counter(state.counters, name, numbering) or ''
+      del reference.missing[index]
+
+  def _reference(self, node, content):
+    """ Generates the content of node that looks up targets as far as it can now (a target-counter() of a target
+        that was already seen, everything that does not look up a target) and adds it to self.reprocess.
+        A target-counter() of a later target is filled in by _save_target, a target-text() by _write_reference """
+    evaluator = self.evaluator
+    n = node
+    if self.is_pseudo(node):
+      n = node.getparent()
+    reference = _Reference(node)
+    pieces = reference.pieces
+    for (function, args) in content:
+      if function in ('target-counter', 'target-text'):
+        href = n.attrib.get(args[0], None)
+        id = href and evaluator.target_id(href)
+        if function == 'target-counter' and self.node_at.get(id) is not None:
+          pieces.append(evaluator.eval_content(node, [(function, args)]))
+          continue
+        if function == 'target-counter' and id in self.node_at:
+          self.waiting.setdefault(id, []).append((reference, len(pieces), args))
+        reference.missing[len(pieces)] = (function, args)
+        pieces.append(None)
+      else:
+        pieces.append(evaluator.eval_content(node, [(function, args)]))
+    self.reprocess.append(reference)
+    return reference
+
+  def _write_reference(self, reference):
+    """ Fills in the rest of the content of a _Reference (the target-text()s) and writes it """
+    node = reference.node
+    pieces = reference.pieces
+    for (index, item) in reference.missing.items():
+      pieces[index] = self.evaluator.eval_content(node, [item])
+    reference.missing.clear()
+    text = ''.join(pieces)
+    if len(node) > 0 and self.is_pseudo(node[0]):
+      node[0].tail = text
+    else:
+      node.text = text
+
+  def _record_move(self, node, d):
+    """ Adds node to self.moving if it is moved (move-to) or is a destination (pending()) """
+    name = d.get('move-to')
+    if name is not None and name != 'here':
+      self.moving.append((name, node, False))
+    for (function, pending) in d.get('content') or ():
+      if function == 'pending':
+        #TODO remove all children and text
+        self.moving.append((str(pending), node, True))
+
+  def expand_pseudo(self, node, parent = None, class_ = '', created = None):
+    """ Removes the node if it is hidden (returns False) or adds its :before and :after pseudo elements.
+        The pseudo elements are added to created (if given) """
+    # A pseudo element takes its declarations from its parent
+    source = node
+    if class_: source = parent
+    pseudos = self.styles.pseudos(source)
+    d = pseudos.get(class_, {})
+
     if 'display' in d and 'none' == d['display']:
       node.getparent().remove(node)
-      return
-      
-    newStyle = _style_to_string(d)
-    node.attrib[STYLE_ATTRIBUTE] = newStyle
-    # Also, if there's a target-counter then add it to the list
-    if 'content' in d:
-      content = ContentPropertyParser().parse(d['content'])
-      if content is not None:
-        for (function, args) in content:
-          attr = None
-          if function == 'target-counter':
-            (attr, _, _) = args
-          if function == 'target-text':
-            (attr, _) = args
-          
-          if attr:
-            n = node
-            # If it's a pseudo element use the parent's attribute
-            if class_ != '': n = node.getparent()
-            id = n.attrib.get(attr, '')
-            if id and len(id) > 0:
-              # omit the hash tag
-              if id[0] == '#':
-                id = id[1:]
-              self.node_at[id] = None
-            else:
-              if self.verbose: print >> sys.stderr, "WARNING: Ignoring lookup to a non-internal id: '%s' on a %s" % (href, n.tag)
+      return False
+
+    # From here on the pseudo element has its own declarations
+    if class_:
+      self.styles.set(node, d, self.styles.parsed(source, class_))
+      if created is not None:
+        created.add(node)
+      return True
     
-    if not class_ and ':before' in style:
-      pseudo = etree.Element(self.pseudo_element_name)
+    if ':before' in pseudos:
+      self._add_pseudo(node, ':before', created)
+    if ':after' in pseudos:
+      self._add_pseudo(node, ':after', created)
+    return True
+
+  def _add_pseudo(self, node, class_, created = None):
+    """ Adds the :before or :after pseudo element to node. Returns it (None if it is hidden) """
+    pseudo = etree.Element(self._pseudo_tag(node))
+    if class_ == ':before':
       pseudo.attrib['class'] = 'pseudo-before'
       node.insert(0, pseudo)
       if node.text:
         pseudo.tail = node.text
         node.text = ''
-      self.expand_pseudo(pseudo, style, ':before')
-    
-    if not class_ and ':after' in style:
-      pseudo = etree.Element(self.pseudo_element_name)
+    else:
       pseudo.attrib['class'] = 'pseudo-after'
       node.append(pseudo)
-      self.expand_pseudo(pseudo, style, ':after')
+    if self.expand_pseudo(pseudo, node, class_, created):
+      return pseudo
+
+
+class ChapterRender(object):
+  """ One chapter of transform_book_incremental, with what it depends on (the edges of the book's dependency graph):
+      - digest:     md5 of its HTML
+      - references: {id: whether target-text() needs its text} for the targets in other chapters it links to
+      - reads:      ({counter: incoming value}, {string: incoming value}) for what it read before setting it
+      - writes:     ({counter: value}, {string: value}) for what it set, at its end
+      - exports:    {id: None (no such element) or (serialized element or None, the same once the chapter's references
+                    were written, counters, strings it set before it)} for the ids other chapters link to
+      - inputs:     {id: None or (serialized element or None as it reads it, all the counters, all the strings)}
+                    for the references it was transformed with
+      - output:     etree.tostring(tree, encoding='ascii') """
+  __slots__ = ('name', 'digest', 'references', 'reads', 'writes', 'exports', 'inputs', 'output')
+
+  def __init__(self, name, digest):
+    self.name = name
+    self.digest = digest
+    self.references = {}
+    self.reads = ({}, {})
+    self.writes = ({}, {})
+    self.exports = {}
+    self.inputs = {}
+    self.output = None
+
+  def __getstate__(self):
+    return tuple(getattr(self, name) for name in ChapterRender.__slots__)
+
+  def __setstate__(self, state):
+    for (name, value) in zip(ChapterRender.__slots__, state):
+      setattr(self, name, value)
+
+class BookRender(object):
+  """ What transform_book_incremental returns (and takes back as previous, it can be pickled in between):
+      the ChapterRenders in reading order and the names of the chapters that were transformed (not reused) """
+  def __init__(self, key, chapters, rendered):
+    self.key = key
+    self.chapters = chapters
+    self.rendered = rendered
+
+  def outputs(self):
+    """ [(name, etree.tostring(tree, encoding='ascii'))] like transform_book_parallel """
+    return [(chapter.name, chapter.output) for chapter in self.chapters]
+
+def _chapter_state(start):
+  """ A State that starts with start and records what is read and written (see ChapterMap) """
+  state = State()
+  state.counters = ChapterMap(start.counters)
+  state.strings = ChapterMap(start.strings)
+  return state
 
+def _state_reads(state):
+  return (state.counters.reads(), state.strings.reads())
+
+def _state_writes(state):
+  return (state.counters.written(), state.strings.written())
+
+def _state_items(state):
+  return (dict(state.counters.items()), dict(state.strings.items()))
+
+def _apply_writes(state, writes):
+  """ A new State: state with the (counters, strings) writes set """
+  (counters, strings) = writes
+  state = State(state)
+  for (name, value) in counters.items():
+    state.counters[name] = value
+  for (name, value) in strings.items():
+    state.strings[name] = value
+  return state
+
+def _reads_match(reads, state):
+  """ Whether state has the incoming values a chapter read """
+  (counters, strings) = reads
+  for (name, value) in counters.items():
+    if state.counters.get(name) != value:
+      return False
+  for (name, value) in strings.items():
+    if state.strings.get(name) != value:
+      return False
+  return True
+
+def _covers(exports, needed):
+  """ Whether a chapter's exports have all the targets (and texts) needed """
+  for (id, text) in needed.items():
+    if id not in exports:
+      return False
+    if text and exports[id] is not None and exports[id][0] is None:
+      return False
+  return True
+
+class _Reference(object):
+  """ A node that looks up targets: its pieces and {index: (function, args)} of the missing ones """
+  __slots__ = ('node', 'pieces', 'missing')
+
+  def __init__(self, node):
+    self.node = node
+    self.pieces = []
+    self.missing = {}
+
+# Marks where the children go when the start tag of an element is written (see _stream_process)
+_STREAM_MARK = 'epubcss-stream-mark'
+
+class _Frame(object):
+  """ An element transform_stream has seen the start of but not the end """
+  __slots__ = ('element', 'parent', 'skip', 'style', 'emit', 'retain', 'processed', 'replaced', 'flushed', 'close', 'references')
+
+  def __init__(self, element, parent, emit):
+    self.element = element
+    self.parent = parent
+    self.skip = parent is not None and parent.skip # inside a hidden element or a <style>
+    self.style = False
+    self.emit = emit
+    self.retain = parent is not None and parent.retain # inside a target of target-text() (the children are kept)
+    self.processed = False
+    self.replaced = False
+    self.flushed = 0 # children that were written but are kept
+    self.close = None
+    self.references = []
+
+class _StreamTarget(object):
+  """ Parser target that builds the tree (like iterparse) and remembers the start and end events """
+  def __init__(self):
+    self.builder = etree.TreeBuilder()
+    self.events = []
+
+  def start(self, tag, attrib):
+    element = self.builder.start(tag, attrib)
+    self.events.append(('start', element))
+    return element
+
+  def end(self, tag):
+    element = self.builder.end(tag)
+    self.events.append(('end', element))
+    return element
+
+  def data(self, data):
+    self.builder.data(data)
+
+  def comment(self, text):
+    self.builder.comment(text)
+
+  def close(self):
+    return self.builder.close()
+
+def _iterparse(source, chunk_size = 64 * 1024):
+  """ etree.iterparse(source, events=('start', 'end'), html=True) but it recovers from
+      the (unknown tag) errors the HTML parser reports, like etree.HTMLParser does """
+  target = _StreamTarget()
+  parser = etree.HTMLParser(target=target)
+  rest = ''
+  while True:
+    data = source.read(chunk_size)
+    if data:
+      # libxml2's HTML push parser stops making progress (until it is closed) when a chunk
+      # ends in the middle of a tag or of text, so chunks end right after a '>'
+      data = rest + data
+      end = data.rfind('>') + 1
+      rest = data[end:]
+      if end:
+        parser.feed(data[:end])
+    else:
+      if rest:
+        parser.feed(rest)
+      parser.close()
+    for event in target.events:
+      yield event
+    del target.events[:]
+    if not data:
+      break
+
+# The arguments of the workers of transform_book_parallel (see _init_book_worker)
+_BOOK_WORKER = None
+
+def _init_book_worker(args, pseudo_element_name, explicit_styles):
+  """ Runs once in every worker so the compiled stylesheet is only sent (or loaded) once per worker """
+  global _BOOK_WORKER
+  _BOOK_WORKER = (args, pseudo_element_name, explicit_styles)
+
+def _transform_book_chapter(task):
+  (args, pseudo_element_name, explicit_styles) = _BOOK_WORKER
+  (name, html, state, targets, pretty_print) = task
+  return AddNumbering(args, pseudo_element_name)._transform_chapter(name, html, explicit_styles, state, targets, pretty_print)
+
+def _prescan_rules(rules):
+  """ Which rules _prescan_book runs: the ones the counters and strings depend on
+      (and the content too when target-text() or string-set need the generated text) """
+  text = False
+  for rule in rules:
+    if rule.feature_mask & (FEATURE_STRING | FEATURE_TARGET_TEXT):
+      text = True
+  def keep(rule):
+    if rule.feature_mask & (FEATURE_COUNTER | FEATURE_STRING | FEATURE_HIDE):
+      return True
+    # Content is kept to register the targets of target-counter() too
+    return 'content' in rule.parsed and (text or _uses_targets([rule]))
+  return keep
+
+def _uses_targets(rules):
+  for rule in rules:
+    for (function, _) in rule.parsed.get('content') or ():
+      if function in ('target-counter', 'target-text'):
+        return True
+  return False
+
+def _rewindable(source):
+  """ source, or a copy of it that can be read again (for stdin) """
+  try:
+    source.seek(source.tell())
+    return source
+  except (AttributeError, IOError):
+    rewindable = tempfile.TemporaryFile()
+    shutil.copyfileobj(source, rewindable)
+    rewindable.seek(0)
+    return rewindable
+
+def _escape_text(text):
+  if not text:
+    return ''
+  element = etree.Element('t')
+  element.text = text
+  return etree.tostring(element, encoding='ascii')[3:-4]
+
+_CODE_VERSION = []
+
+def _code_version():
+  """ A hash of the source of this module and of custom/ (computed once) """
+  if not _CODE_VERSION:
+    directory = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    paths = [os.path.join(directory, 'epubcss.py')]
+    paths.extend(sorted(glob.glob(os.path.join(directory, 'custom', '*.py'))))
+    for path in paths:
+      f = open(path, 'rb')
+      try:
+        h.update(f.read())
+      finally:
+        f.close()
+    _CODE_VERSION.append(h.hexdigest())
+  return _CODE_VERSION[0]
+
+def _attached(node, root):
+  """ Whether node is (still) in the tree of root """
+  while node is not None:
+    if node is root:
+      return True
+    node = node.getparent()
+  return False
 
 def _style_to_string(style):
   s = []
@@ -280,6 +1337,28 @@ def _style_to_string(style):
 
 
 
+def _print_stats(stats, format):
+  if format == 'json':
+    import json
+    print >> sys.stderr, json.dumps(stats.as_dict(), indent=2, sort_keys=True)
+    return
+  for name in stats.passes:
+    print >> sys.stderr, '%-24s %9.4fs %8d elements' % (name, stats.seconds[name], stats.elements[name])
+  for (name, count) in sorted(stats.counts.items()):
+    print >> sys.stderr, '%-24s %8d' % (name, count)
+
+def _css_texts(args):
+  """ The CSS of the -c files with their @imports inlined (see custom/loader.py) """
+  mirrors = dict([mirror.split('=', 1) for mirror in args.mirror or ()])
+  loader = StylesheetLoader(mirrors, args.css_cache, args.offline)
+  return [loader.inline_imports(style.read(), style.name) for style in args.css or ()]
+
+def _read_css(numbering, args):
+  css = _css_texts(args)
+  if css:
+    css = [numbering.compile_stylesheet(css, cache_dir=args.css_cache)]
+  return css
+
 def main():
     try:
       import argparse
@@ -293,18 +1372,79 @@ def main():
       parser.add_argument('--no-string', dest='no_string', help='Do not Emulate string-set', action='store_true')
       parser.add_argument('--no-move', dest='no_move', help='Do not Emulate move-to', action='store_true')
       parser.add_argument('--no-default', dest='no_default', help='Emulate default styles', action='store_true')
+      parser.add_argument('--css-cache', dest='css_cache', help='Directory to save compiled CSS (and the CSS @imported from URLs) in (and load it from on the next run)')
+      parser.add_argument('--mirror', dest='mirror', help='Read the CSS @imported from URLs starting with PREFIX from DIR (PREFIX=DIR)', action='append')
+      parser.add_argument('--offline', dest='offline', help='Never fetch @imported CSS from the network (only --mirror and --css-cache)', action='store_true')
+      parser.add_argument('--cache', dest='cache', help='Directory to keep the transformed documents in (a document transformed again with the same CSS and flags is not parsed)')
+      parser.add_argument('--cache-size', dest='cache_size', help='Size of the --cache directory in MB (the least recently used documents are removed)', type=int, default=256)
+      parser.add_argument('--stream', dest='stream', help='Write the HTML while reading it (for documents too big to keep in memory)', action='store_true')
+      parser.add_argument('--book', dest='book', help='Chapter files of a book, in reading order (links between them are resolved)', nargs='+')
+      parser.add_argument('--output-dir', dest='output_dir', help='Directory to write the chapters of --book to (default: next to them)')
+      parser.add_argument('-j', '--jobs', dest='jobs', help='Number of processes to transform the chapters of --book with (0 for one per CPU)', type=int, default=1)
+      parser.add_argument('--incremental', dest='incremental', help='Only transform the --book chapters that changed since the last run (what they depend on is saved in this file)')
+      parser.add_argument('--stats', dest='stats', help='Print the time and number of elements of every pass to stderr', choices=['text', 'json'])
+      parser.add_argument('--explain', dest='explain', help='Print what matching every rule cost (over all the --book chapters), sorted by this column', choices=SORT_KEYS)
       parser.add_argument('html',              nargs='?', type=argparse.FileType('r'), default=sys.stdin)
       args = parser.parse_args()
   
       # if self.verbose: if self.verbose: print >> sys.stderr, "Transforming..."
-      if args.html:
-        css = []
-        if args.css:
-          for style in args.css:
-            css.append(style.read())
-        result = AddNumbering(args).transform(args.html.read(), css)
-        html = etree.tostring(result, encoding='ascii')
-        args.output.write(html)
+      if args.book:
+        numbering = AddNumbering(args)
+        css = _read_css(numbering, args)
+        # Chapters are named by their path relative to the directory they are all in
+        top = os.path.dirname(os.path.commonprefix([os.path.abspath(path) for path in args.book]))
+        chapters = []
+        for path in args.book:
+          name = os.path.relpath(os.path.abspath(path), top).replace(os.sep, '/')
+          chapters.append((name, open(path).read()))
+        if args.incremental:
+          previous = None
+          if os.path.exists(args.incremental):
+            previous = pickle.load(open(args.incremental, 'rb'))
+          render = numbering.transform_book_incremental(chapters, css, previous)
+          if numbering.verbose: print >> sys.stderr, "-------- Transformed %d of %d chapters" % (len(render.rendered), len(chapters))
+          pickle.dump(render, open(args.incremental, 'wb'), pickle.HIGHEST_PROTOCOL)
+          book = render.outputs()
+        elif args.jobs == 1:
+          book = numbering.transform_book(chapters, css)
+          if numbering.stats is not None: numbering.stats.start()
+          book = [(name, etree.tostring(result, encoding='ascii')) for (name, result) in book]
+          if numbering.stats is not None: numbering.stats.lap('serialize', len(book))
+        else:
+          # The chapters are transformed (and timed) in the worker processes
+          if numbering.stats is not None: numbering.stats.start()
+          book = numbering.transform_book_parallel(chapters, css, processes=args.jobs or None)
+          if numbering.stats is not None: numbering.stats.lap('transform_book_parallel', len(book))
+        for (name, html) in book:
+          path = os.path.join(args.output_dir or top, *name.split('/'))
+          if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+          f = open(path, 'w')
+          f.write(html)
+          f.close()
+      elif args.html and args.cache and not args.stream:
+        numbering = AddNumbering(args)
+        # The CSS is only compiled (by transform) on a miss
+        css = _css_texts(args)
+        cache = DiskCache(args.cache, args.cache_size * 1024 * 1024)
+        args.output.write(numbering.transform_cached(args.html.read(), css, cache))
+      elif args.html:
+        numbering = AddNumbering(args)
+        css = _read_css(numbering, args)
+        if args.stream:
+          if numbering.stats is not None: numbering.stats.start()
+          numbering.transform_stream(args.html, args.output, css)
+          if numbering.stats is not None: numbering.stats.lap('transform_stream')
+        else:
+          result = numbering.transform(args.html.read(), css)
+          if numbering.stats is not None: numbering.stats.start()
+          html = etree.tostring(result, encoding='ascii')
+          if numbering.stats is not None: numbering.stats.lap('serialize', 1)
+          args.output.write(html)
+      if args.stats:
+        _print_stats(numbering.stats, args.stats)
+      if args.explain:
+        print >> sys.stderr, numbering.explain.format(args.explain)
       
     except ImportError:
       print "argparse is needed for commandline"
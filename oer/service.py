@@ -0,0 +1,211 @@
+""" A long-running transform service, so converting many files does not start a process
+    (importing lxml and compiling the CSS again) for each one:
+
+      python oer/service.py serve -s book=book.css -s other=a.css,b.css -j 4
+      python oer/service.py transform chapter.html -s book=book.css --stylesheet book -o chapter.out.html
+
+    The server listens on localhost (HTTP) and transforms every document in a pool of worker processes
+    that keep the compiled stylesheets and the selector caches warm. A worker is replaced after --max-jobs
+    documents (to bound its memory) and recompiles a stylesheet when one of its files changes.
+    The client transforms the document in its own process when no server is running. """
+import os
+import sys
+import errno
+import socket
+import urllib
+import urllib2
+import urlparse
+import threading
+import multiprocessing
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from lxml import etree
+from epubcss import AddNumbering
+
+DEFAULT_ADDRESS = ('127.0.0.1', 8765)
+
+class ServiceError(Exception): pass
+
+class StylesheetRegistry(object):
+  """ Stylesheet ids -> the CSS files they are made of (in order).
+      get() compiles a stylesheet the first time and again whenever one of its files changed """
+
+  def __init__(self, stylesheets, numbering):
+    self.stylesheets = dict((id, list(paths)) for (id, paths) in stylesheets.items())
+    self.numbering = numbering # compiles the CSS (with its --no-* flags)
+    self._compiled = {} # id -> (mtimes, CompiledStylesheet)
+    self._lock = threading.Lock()
+
+  def __contains__(self, id):
+    return id in self.stylesheets
+
+  def get(self, id):
+    paths = self.stylesheets[id]
+    mtimes = [os.stat(path).st_mtime for path in paths]
+    with self._lock:
+      compiled = self._compiled.get(id)
+      if compiled is not None and compiled[0] == mtimes:
+        return compiled[1]
+      css = []
+      for path in paths:
+        f = open(path)
+        try:
+          css.append(f.read())
+        finally:
+          f.close()
+      sheet = self.numbering.compile_stylesheet(css)
+      self._compiled[id] = (mtimes, sheet)
+      return sheet
+
+def _transform(registry, args, id, html, pretty_print):
+  numbering = AddNumbering(args)
+  return etree.tostring(numbering.transform(html, registry.get(id), pretty_print), encoding='ascii')
+
+# The StylesheetRegistry (and the command line args) of a worker process
+_WORKER = None
+
+def _init_worker(stylesheets, args):
+  global _WORKER
+  _WORKER = (StylesheetRegistry(stylesheets, AddNumbering(args)), args)
+
+def _transform_task(task):
+  (registry, args) = _WORKER
+  (id, html, pretty_print) = task
+  return _transform(registry, args, id, html, pretty_print)
+
+class TransformService(object):
+  """ Transforms documents with the stylesheets ({id: [css paths]}) in a pool of processes workers
+      (one per CPU by default), each one replaced after max_jobs documents """
+
+  def __init__(self, stylesheets, processes = None, max_jobs = 100, args = None):
+    self.stylesheets = dict((id, list(paths)) for (id, paths) in stylesheets.items())
+    self.pool = multiprocessing.Pool(processes, _init_worker, (self.stylesheets, args), max_jobs)
+
+  def transform(self, html, stylesheet, pretty_print = True):
+    if stylesheet not in self.stylesheets:
+      raise KeyError(stylesheet)
+    return self.pool.apply(_transform_task, ((stylesheet, html, pretty_print),))
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+class _Server(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class _Handler(BaseHTTPRequestHandler):
+  """ POST /transform?stylesheet=ID[&pretty_print=0] with the HTML as the body """
+
+  def do_POST(self):
+    (path, _, query) = self.path.partition('?')
+    params = dict([(k, v[-1]) for (k, v) in urlparse.parse_qs(query).items()])
+    if path != '/transform' or 'stylesheet' not in params:
+      return self._reply(404, 'Unknown request: %s' % self.path)
+    html = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if params['stylesheet'] not in self.server.service.stylesheets:
+      return self._reply(404, 'Unknown stylesheet: %s' % params['stylesheet'])
+    try:
+      output = self.server.service.transform(html, params['stylesheet'], params.get('pretty_print', '1') != '0')
+    except Exception, e:
+      return self._reply(500, '%s: %s' % (e.__class__.__name__, e))
+    self._reply(200, output)
+
+  def _reply(self, code, body):
+    self.send_response(code)
+    self.send_header('Content-Type', code == 200 and 'text/html' or 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def make_server(service, address = DEFAULT_ADDRESS, verbose = False):
+  """ An HTTP server for the TransformService (call serve_forever() on it). Port 0 picks a free one (see server_address) """
+  server = _Server(address, _Handler)
+  server.service = service
+  server.verbose = verbose
+  return server
+
+class Client(object):
+  """ Sends documents to the service at address. When none is running they are transformed in this process
+      (with the same stylesheets: {id: [css paths]}) """
+
+  def __init__(self, stylesheets, address = DEFAULT_ADDRESS, args = None, timeout = 60):
+    self.address = address
+    self.args = args
+    self.timeout = timeout
+    self._registry = StylesheetRegistry(stylesheets, AddNumbering(args))
+    self.local = 0 # documents transformed in this process
+
+  def transform(self, html, stylesheet, pretty_print = True):
+    url = 'http://%s:%d/transform?%s' % (self.address[0], self.address[1],
+      urllib.urlencode({'stylesheet': stylesheet, 'pretty_print': pretty_print and '1' or '0'}))
+    try:
+      return urllib2.urlopen(urllib2.Request(url, html), timeout=self.timeout).read()
+    except urllib2.HTTPError, e:
+      raise ServiceError('%d %s' % (e.code, e.read()))
+    except (urllib2.URLError, socket.error), e:
+      # Only when nothing is listening: a server that timed out or reset the connection may still be transforming it
+      if not _not_running(e):
+        raise
+      if stylesheet not in self._registry:
+        raise KeyError(stylesheet)
+      self.local += 1
+      return _transform(self._registry, self.args, stylesheet, html, pretty_print)
+
+def _not_running(error):
+  """ Whether the error (from urlopen) is a connection that could not be made because no server is running """
+  if isinstance(error, urllib2.URLError):
+    error = error.reason
+  return isinstance(error, socket.error) and not isinstance(error, socket.timeout) and \
+    error.errno in (errno.ECONNREFUSED, errno.ENOENT)
+
+def _stylesheets(specs):
+  """ ['book=a.css,b.css'] -> {'book': ['a.css', 'b.css']} """
+  stylesheets = {}
+  for spec in specs or ():
+    (id, _, paths) = spec.partition('=')
+    stylesheets[id] = paths.split(',')
+  return stylesheets
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description='Transform documents in a long-running service')
+  parser.add_argument('command', choices=['serve', 'transform'])
+  parser.add_argument('-s', dest='stylesheets', help='A stylesheet id and its CSS files (id=a.css,b.css)', action='append')
+  parser.add_argument('--host', dest='host', default=DEFAULT_ADDRESS[0])
+  parser.add_argument('--port', dest='port', type=int, default=DEFAULT_ADDRESS[1])
+  parser.add_argument('-j', '--jobs', dest='jobs', help='Worker processes (0 for one per CPU)', type=int, default=0)
+  parser.add_argument('--max-jobs', dest='max_jobs', help='Documents a worker transforms before it is replaced', type=int, default=100)
+  parser.add_argument('--stylesheet', dest='stylesheet', help='The stylesheet id to transform with')
+  parser.add_argument('-v', dest='verbose', help='Verbose printing to stderr', action='store_true')
+  parser.add_argument('-o', dest='output', nargs='?', type=argparse.FileType('w'), default=sys.stdout)
+  parser.add_argument('html', nargs='?', type=argparse.FileType('r'), default=sys.stdin)
+  args = parser.parse_args()
+  # The transform flags (see epubcss.py)
+  flags = argparse.Namespace(verbose=False, no_counter=False, no_target=False, no_string=False, no_move=False)
+
+  stylesheets = _stylesheets(args.stylesheets)
+  address = (args.host, args.port)
+  if args.command == 'serve':
+    service = TransformService(stylesheets, args.jobs or None, args.max_jobs, flags)
+    server = make_server(service, address, args.verbose)
+    if args.verbose: print >> sys.stderr, 'Listening on http://%s:%d' % server.server_address
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      service.close()
+  else:
+    client = Client(stylesheets, address, flags)
+    args.output.write(client.transform(args.html.read(), args.stylesheet))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,6 +1,8 @@
 import sys
 from lxml import etree
 from epubcss import AddNumbering
+from custom import premailer
+from custom.util import StyleStore
 
 VERBOSE = False
 EXIT_CODE = [0]
@@ -12,13 +14,22 @@ except ImportError:
     if expect != actual:
       EXIT_CODE[0] = 1
       print >> sys.stderr, "ERROR!"
-      print >> sys.stderr, "expected=[" + expect + "]"
-      print >> sys.stderr, "actual  =[" + actual + "]"
+      print >> sys.stderr, "expected=[%s]" % (expect,)
+      print >> sys.stderr, "actual  =[%s]" % (actual,)
 
 def run(html, css):
   actual = AddNumbering(None, pseudo_element_name='span').transform(html, [css], pretty_print = False)
   return etree.tostring(actual)
 
+CHAINED_CSS = """h1 { counter-increment: c; } a::before { content: target-counter(attr(href), c); }
+                 em { content: target-text(attr(href), content(before)); }"""
+
+def chained_book(extra = ''):
+  """ A book in which the target-text()s read a target-counter() of another chapter """
+  return [('ch0.html', """<html><body><h1/><a id="t" href="ch1.html#u">x</a><em href="ch2.html#v"/></body></html>"""),
+          ('ch1.html', """<html><body><h1/>%s<h1 id="u"/><em href="ch0.html#t"/></body></html>""" % extra),
+          ('ch2.html', """<html><body><a id="v" href="ch1.html#u">y</a><em href="ch0.html#t"/></body></html>""")]
+
 def test_content_basic():
   css    = """body { content: "pass"; }"""
   html   = """<html><body>fail</body></html>"""
@@ -69,6 +80,16 @@ def test_content_replace_and_counter():
   expect = """<html><body href="#correct"><span class="pseudo-before">2</span>2</body></html>"""
   eq_(expect, run(html, css))
 
+def test_target_counter_backward():
+  """ The target comes before the link (and comments are skipped) """
+  css    = """em          { counter-increment: counter; }
+              test::after  { content: " (" target-counter(attr(href), counter) ")"; }
+              .hide       { display: none; }
+              """
+  html   = """<html><body><em/><!-- c --><em id="correct"/><em class="hide"/><test href="#correct">see</test></body></html>"""
+  expect = """<html><body><em/><!-- c --><em id="correct"/><test href="#correct">see<span class="pseudo-after"> (2)</span></test></body></html>"""
+  eq_(expect, run(html, css))
+
 def test_display_none():
   css    = """.hide       { display: none; }
               test        { counter-increment: counter; }
@@ -92,6 +113,24 @@ def test_target_text():
   expect = """<html><body><test href="#itsme"><span class="pseudo-before">BEFORE</span>ABCDE<span class="pseudo-after">AFTER</span></test><test2 id="itsme"><span class="pseudo-before">BEFORE</span>A<inner><span class="pseudo-before">B</span>C<span class="pseudo-after">D</span></inner>E<span class="pseudo-after">AFTER</span></test2>X</body></html>"""
   eq_(expect, run(html, css))
 
+def test_target_counter_forward_and_backward():
+  css    = """body   { counter-reset: fig; }
+              figure { counter-increment: fig; }
+              a      { content: "Fig " counter(fig) "/" target-counter(attr(href), fig, upper-roman); }
+              """
+  html   = """<html><body><a href="#f2"/><figure id="f1"/><a href="#f1"/><figure id="f2"/><a href="#f2"/></body></html>"""
+  expect = """<html><body><a href="#f2">Fig /II</a><figure id="f1"/><a href="#f1">Fig 1/I</a><figure id="f2"/><a href="#f2">Fig 2/II</a></body></html>"""
+  eq_(expect, run(html, css))
+
+def test_target_text_memoized():
+  # The text of a target is collected once but changes when content inside it is generated
+  css    = """test          { content: target-text(attr(href), content()); }
+              first         { content: target-text(attr(href), content(first-letter)); }
+              """
+  html   = """<html><body><test href="#title"/><div id="title">Intro <test href="#other"/></div><p id="other">Other</p><test href="#title"/><first href="#title"/></body></html>"""
+  expect = """<html><body><test href="#title">Intro </test><div id="title">Intro <test href="#other">Other</test></div><p id="other">Other</p><test href="#title">Intro Other</test><first href="#title">I</first></body></html>"""
+  eq_(expect, run(html, css))
+
 def test_target_text_and_counters():
   css    = """test          { content: target-text(attr(href), content()); }
               test:::before  { content: target-text(attr(href), content(before)); }
@@ -144,12 +183,555 @@ def test_move_to():
   expect = """<html><body>tail1<test2><span class="pseudo-before"><span class="pseudo-before">123</span><span class="pseudo-after">456</span></span>DEF<span class="pseudo-after"><test>ABC</test></span></test2>tail2</body></html>"""
   eq_(expect, run(html, css))
 
+def test_move_to_earlier_destination():
+  """ A node after the last destination goes to the one before it (it used to be dropped) """
+  css    = """note { move-to: notes; }
+              notes::before { content: pending(notes); }
+              """
+  html   = """<html><body><p>a<note>1</note>b</p><notes/><p>c<note>2</note>d<note>3</note>e</p></body></html>"""
+  expect = """<html><body><p>ab</p><notes><span class="pseudo-before"><note>1</note><note>2</note><note>3</note></span></notes><p>cde</p></body></html>"""
+  eq_(expect, run(html, css))
+
+def test_style_store():
+  """ Rules for the same pseudo element are merged whether they use 2 or 3 colons """
+  css    = """test:::before { content: "fail"; counter-increment: a; }
+              test::before  { content: "pass " counter(a); }
+              test          { counter-reset: a 1; }
+              """
+  html   = """<html><body><test>text</test></body></html>"""
+  expect = """<html><body><test><span class="pseudo-before">pass 2</span>text</test></body></html>"""
+  eq_(expect, run(html, css))
+
+def test_compiled_stylesheet():
+  import os, shutil, tempfile
+  css    = """body        { counter-reset: counter 20; }
+              em          { counter-increment: counter; }
+              test::before { content: target-counter(attr(href), counter, lower-roman); }
+              """
+  html   = """<html><body><test href="#correct"/><em id="correct"/></body></html>"""
+  expect = """<html><body><test href="#correct"><span class="pseudo-before">xxi</span></test><em id="correct"/></body></html>"""
+  def transform(style):
+    return etree.tostring(AddNumbering(None, pseudo_element_name='span').transform(html, [style], pretty_print = False))
+  compiled = AddNumbering(None).compile_stylesheet(css)
+  eq_(expect, transform(compiled))
+  eq_(expect, transform(compiled)) # reusable
+  cache_dir = tempfile.mkdtemp()
+  try:
+    saved = AddNumbering(None).compile_stylesheet(css, cache_dir=cache_dir)
+    eq_(1, len(os.listdir(cache_dir)))
+    loaded = AddNumbering(None).compile_stylesheet(css, cache_dir=cache_dir)
+    eq_(saved.key, loaded.key)
+    eq_(expect, transform(loaded))
+  finally:
+    shutil.rmtree(cache_dir)
+
+def test_selector_cache():
+  from lxml.cssselect import CSSSelector
+  css    = """cached-test:first-child { content: "pass"; }
+              cached-test:unknown-pseudo(1) { content: "fail"; }
+              """
+  html   = """<html><body><cached-test>fail</cached-test></body></html>"""
+  expect = """<html><body><cached-test>pass</cached-test></body></html>"""
+  premailer.SELECTOR_CACHE.clear()
+  eq_(expect, run(html, css))
+  misses = premailer.SELECTOR_CACHE.stats()['misses']
+  eq_(expect, run(html, css))
+  stats = premailer.SELECTOR_CACHE.stats()
+  # Both selectors (including the one that fails to compile) come from the cache the 2nd time
+  eq_(misses, stats['misses'])
+  eq_(True, stats['hits'] >= 2)
+  eq_(None, premailer.compile_selector('cached-test:unknown-pseudo(1)'))
+  # The same selector with (or without) its XPath is a different entry
+  eq_(False, isinstance(premailer.compile_selector('cached-test', 'descendant-or-self::cached-test'), CSSSelector))
+  eq_(True, isinstance(premailer.compile_selector('cached-test'), CSSSelector))
+  eq_(None, premailer.compile_selector('cached-test', 'descendant-or-self::cached-test['))
+
+def test_rule_matching():
+  from lxml.cssselect import CSSSelector
+  from custom.matching import analyze_selector, matches
+  html = etree.fromstring("""<html><body>
+    <div id="a" class="x y"><p class="x">1</p><!-- c --><p lang="en-us" title="a b">2</p><p/></div>
+    <div class=" y  z "><span data-k="v">3</span><p title="">4</p></div></body></html>""")
+  for selector in ['p', '*', 'div p', 'div > p', 'p + p', 'p ~ p', '#a p.x + p', '.y.z > *', 'body div.x p',
+                   '[lang|=en]', '[title~=b]', '[title^=a]', '[title$=b]', '[title*=" "]', '[title!=""]',
+                   '[title!="a b"]', '[data-k=v]', '[title]', 'div.y span[data-k]', 'p + p + p',
+                   # lxml keeps the case of a lone tag (and lowercases it anywhere else) and an empty value
+                   # matches a missing attribute for some operators
+                   'SPAN', 'P.x', 'DIV#a', 'DIV > p', 'Div p', 'SPAN[data-k]', 'p[title^=""]', 'p[title$=""]',
+                   'p[title*=""]', 'p[title~=""]', 'p[title|=""]', 'p[title=""]', 'p[title!=""]', '[TITLE]']:
+    (plan, key, requires) = analyze_selector(selector)
+    expected = CSSSelector(selector)(html)
+    actual = [el for el in html.iter() if isinstance(el.tag, basestring) and matches(plan, el)]
+    eq_(expected, actual)
+  # Pseudo-classes are matched with XPath instead
+  eq_(None, analyze_selector('p:first-child')[0])
+  eq_((('span',), (), ()), analyze_selector('SPAN:first-child')[2])
+  # The plans are sent to the worker processes with the rules
+  import pickle
+  analysis = analyze_selector('div > p[title^=a]')
+  eq_(analysis, pickle.loads(pickle.dumps(analysis, pickle.HIGHEST_PROTOCOL)))
+  eq_(('class', 'x'), analyze_selector('div p.x')[1])
+  eq_((('div', 'p'), ('x',), ('a',)), analyze_selector('div#a p.x:not(.q)')[2])
+
+def test_premailer_tree():
+  from StringIO import StringIO
+  css    = """p { counter-increment: a; }"""
+  html   = """<!DOCTYPE html><html lang="en" xmlns="http://www.w3.org/1999/xhtml"><head><title>t</title></head>
+              <body><div><p style="color: red !important">x</p><!-- c --><p>y <b>z</b></p></div></body></html>"""
+  for pretty_print in (True, False):
+    def transform():
+      return premailer.Premailer(html, explicit_styles=[css], style_store=StyleStore())
+    expected = etree.tostring(etree.parse(StringIO(transform().transform(pretty_print=pretty_print))))
+    eq_(expected, etree.tostring(transform().transform_tree(pretty_print=pretty_print)))
+
+def test_lru_cache_eviction():
+  from custom.cache import LRUCache
+  cache = LRUCache(maxsize=2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  eq_(1, cache.get('a'))
+  cache.put('c', 3) # evicts 'b' since 'a' was just used
+  eq_(None, cache.get('b'))
+  eq_(3, cache.get_or_compute('c', lambda key: 'fail'))
+  stats = cache.stats()
+  eq_((2, 1, 1, 2), (stats['hits'], stats['misses'], stats['evictions'], stats['size']))
+
+def test_transform_stream():
+  from StringIO import StringIO
+  from custom.util import UnsupportedError
+  def stream(html, css):
+    output = StringIO()
+    AddNumbering(None, pseudo_element_name='span').transform_stream(StringIO(html), output, [css])
+    return output.getvalue()
+  css    = """body        { counter-reset: counter 20; }
+              em          { counter-increment: counter; }
+              em::before  { content: counter(counter) ". "; }
+              test::after { content: " (" target-counter(attr(href), counter) ")"; }
+              test2       { content: target-text(attr(href), content()); }
+              .hide       { display: none; }
+              """
+  html   = """<html><body><p><test href="#last">a<b>b</b></test>c<em id="first"/></p><!-- c -->
+              <em class="hide">x<em/></em><div id="last">A<em>B</em><i class="hide"/>C</div><test href="#first"/><test2 href="#last"/></body></html>"""
+  eq_(run(html, css), stream(html, css))
+  html   = """<html><body><test href="#correct"/><em id="some-other-test"/><div><em id="correct"/>x</div>
+              <test href="#correct">y</test></body></html>"""
+  eq_(run(html, css), stream(html, css))
+  try:
+    stream("""<html><body/></html>""", """p { move-to: here; } em { move-to: footnotes; }""")
+    eq_('UnsupportedError', 'no error')
+  except UnsupportedError:
+    pass
+
+def test_transform_book():
+  css    = """figure       { counter-increment: figure; }
+              figure::before { content: counter(figure) ". "; }
+              a            { content: target-counter(attr(href), figure); }
+              a.text       { content: target-text(attr(href), content()); }
+              """
+  chapters = [('text/ch1.html', """<html><body><figure id="f">A</figure><a href="ch2.html#f"/><a href="#f"/></body></html>"""),
+              ('text/ch2.html', """<html><body><figure id="f">B</figure><a href="./ch1.html#f"/><a class="text" href="../text/ch1.html#f"/></body></html>""")]
+  expect = [('text/ch1.html', """<html><body><figure id="f"><span class="pseudo-before">1. </span>A</figure><a href="ch2.html#f">2</a><a href="#f">1</a></body></html>"""),
+            ('text/ch2.html', """<html><body><figure id="f"><span class="pseudo-before">2. </span>B</figure><a href="./ch1.html#f">1</a><a class="text" href="../text/ch1.html#f">A</a></body></html>""")]
+  book = AddNumbering(None, pseudo_element_name='span').transform_book(chapters, [css], pretty_print = False)
+  eq_(expect, [(name, etree.tostring(tree)) for (name, tree) in book])
+
+def test_transform_book_parallel():
+  css    = """body         { counter-reset: section; }
+              h1           { counter-increment: chapter; string-set: title content(); }
+              h2           { counter-increment: section; }
+              h2::before   { content: counter(chapter) "." counter(section) " "; }
+              a            { content: target-counter(attr(href), chapter) "." target-counter(attr(href), section); }
+              a.text       { content: target-text(attr(href), content()); }
+              .hide        { display: none; }
+              """
+  chapters = []
+  for c in range(4):
+    chapters.append(('ch%d.html' % c, """<html><body><h1>C%d</h1><h2 id="a">A</h2><h2 class="hide"/><h2 id="b">B</h2>
+                      <a href="ch%d.html#b"/><a class="text" href="ch%d.html#a"/><a href="#a"/></body></html>""" % (c, (c + 1) % 4, (c + 3) % 4)))
+  expect = [(name, etree.tostring(tree, encoding='ascii')) for (name, tree) in AddNumbering(None).transform_book(chapters, [css])]
+  eq_(expect, AddNumbering(None).transform_book_parallel(chapters, [css], processes=2))
+  # The text of a target with content that looks up a target itself: written in an earlier chapter, not yet in a later one
+  chapters = chained_book()
+  expect = [(name, etree.tostring(tree, encoding='ascii')) for (name, tree) in AddNumbering(None).transform_book(chapters, [CHAINED_CSS])]
+  eq_((True, True), ('<em href="ch2.html#v"></em>' in expect[0][1], '<em href="ch0.html#t">3</em>' in expect[1][1]))
+  eq_(expect, AddNumbering(None).transform_book_parallel(chapters, [CHAINED_CSS], processes=2))
+
+def test_state_snapshot():
+  import pickle
+  from custom.util import State
+  state = State()
+  for i in range(20):
+    state.counters['c%d' % i] = i
+  snapshot = State(state)
+  state.counters['c1'] += 10
+  state.strings['title'] = 'x'
+  eq_((1, 11), (snapshot.counters['c1'], state.counters['c1']))
+  eq_((False, True), ('title' in snapshot.strings, 'title' in state.strings))
+  eq_(20, len(snapshot.counters))
+  eq_(dict(state.counters.items()), pickle.loads(pickle.dumps(state, 2)).counters)
+
+def test_declaration_cache():
+  from custom.util import PropertyParser, DECLARATION_CACHE
+  DECLARATION_CACHE.clear()
+  parsed = PropertyParser().parse_value('content', '"Figure " counter(figure)')
+  eq_(((None, 'Figure '), ('counter', ('figure', 'decimal'))), parsed)
+  style = PropertyParser().parse('{counter-increment: a 2; content: "Figure " counter(figure)}')
+  eq_(True, parsed is style['content']) # same text, same (shared) parse
+  eq_((('a', 2),), style['counter-increment'])
+  stats = DECLARATION_CACHE.stats()
+  eq_((1, 2), (stats['hits'], stats['misses']))
+
+def test_scan_matches_tokenize():
+  from lxml.cssselect import String, Symbol
+  from custom import cssselect
+  def tokenize(value):
+    tokens = []
+    for token in cssselect.tokenize(value):
+      kind = cssselect.TOKEN
+      if isinstance(token, String): kind = cssselect.STRING
+      elif isinstance(token, Symbol): kind = cssselect.SYMBOL
+      tokens.append((kind, token, token.pos))
+    return tokens
+  for value in ['"Figure " counter(chapter) "." counter(figure, upper-roman)', 'a b 2 c -1', ' n+1 2n -n n',
+                'target-text(attr(href), content(before))', "'it''s' \"a\\\"b\"", 'a /* comment */ b', 'div :first-child ::before . # [',
+                'a~=b|=c^=d$=e*=f!=g>h+i~j', u'caf\xe9 \\31 x', '']:
+    eq_(tokenize(value), cssselect.scan(value))
+  cursor = cssselect.Cursor(cssselect.scan('counter(x)'))
+  eq_((cssselect.SYMBOL, 'counter', '('), (cursor.kind(), cursor.next(), cursor.peek()))
+
+def test_counter_styles():
+  from custom import numbers
+  eq_(['z', 'aa', 'zz', 'aaa'], [numbers.toString(n, 'lower-alpha') for n in (26, 27, 702, 703)])
+  eq_(['MCMXCIV', '4000'], [numbers.toString(n, 'upper-roman') for n in (1994, 4000)]) # out of range: decimal
+  eq_(['07', '-7', '123'], [numbers.toString(n, 'decimal-leading-zero') for n in (7, -7, 123)])
+  eq_([u'\u03c9', u'\u03b1\u03b1'], [numbers.toString(n, 'lower-greek') for n in (24, 25)])
+  eq_(u'\u4e00\u3007\u4e8c', numbers.toString(102, 'cjk-decimal'))
+  eq_('12', numbers.toString(12, 'no-such-style'))
+  stars = numbers.CounterStyle('stars', 'symbolic', '*+')
+  eq_(['*', '+', '**'], [stars.format(n) for n in (1, 2, 3)])
+  fixed = numbers.CounterStyle('fixed', 'fixed', 'abc', first=5)
+  eq_(['a', 'c', '8'], [fixed.format(n) for n in (5, 7, 8)])
+  css    = """body { counter-reset: a 29; } test { counter-increment: a; content: counter(a, upper-alpha); }"""
+  eq_("""<html><body><test>AD</test></body></html>""", run("""<html><body><test/></body></html>""", css))
+
+def test_benchmark():
+  from benchmark.generate import generate_book
+  from benchmark.run import time_transform, compare, PASSES
+  (html, css) = generate_book(chapters=1, sections=2, figures=1, xrefs=2, pseudo_rules=1, stylesheet_rules=2)
+  timings = time_transform(html, AddNumbering(None).compile_stylesheet(css))
+  eq_(sorted(PASSES), sorted(timings))
+  eq_(True, timings['premailer'] > 0 and timings['generate'] > 0)
+  baseline = {'scenarios': {'a': {'total': 1.0}, 'b': {'total': 1.0}}}
+  eq_([('b', 1.0, 1.2)], compare({'scenarios': {'a': {'total': 1.05}, 'b': {'total': 1.2}}}, baseline, 0.1))
+
+def test_stats():
+  from custom.util import Stats
+  numbering = AddNumbering(None)
+  numbering.stats = Stats()
+  css = """body { counter-reset: c; } h1 { counter-increment: c; } h1::before { content: counter(c) ". "; }
+           a { content: target-counter(attr(href), c); } p.never { content: "x"; }"""
+  numbering.transform("""<html><body><h1 id="one">A</h1><h1>B</h1><a href="#one">x</a></body></html>""", css, pretty_print = False)
+  eq_(['premailer', 'find_targets', 'generate', 'resolve_targets'], numbering.stats.passes)
+  eq_(4, numbering.stats.elements['premailer'])
+  eq_(2, numbering.stats.counts['pseudo_elements'])
+  eq_(1, numbering.stats.counts['targets_resolved'])
+  eq_(6, numbering.stats.counts['rule_matches'])
+
+def test_feature_mask():
+  from custom.util import Stats
+  from custom.stylesheet import FEATURE_PSEUDO, FEATURE_COUNTER, FEATURE_CONTENT, FEATURE_TARGET_COUNTER, FEATURE_MOVE, FEATURE_ATTRIBUTES
+  sheet = AddNumbering(None).compile_stylesheet("""p { color: red; } h1 { counter-increment: c; } a::before { content: target-counter(attr(href), c); }
+                                                   note { move-to: notes; } td { text-align: left; }""")
+  eq_([0, FEATURE_COUNTER, FEATURE_PSEUDO | FEATURE_CONTENT | FEATURE_TARGET_COUNTER, FEATURE_MOVE, FEATURE_ATTRIBUTES],
+      [rule.feature_mask for rule in sheet.rules])
+  eq_(FEATURE_PSEUDO | FEATURE_COUNTER | FEATURE_CONTENT | FEATURE_TARGET_COUNTER | FEATURE_MOVE | FEATURE_ATTRIBUTES, sheet.feature_mask)
+  # Only counters: no targets to find
+  numbering = AddNumbering(None)
+  numbering.stats = Stats()
+  html = """<html><body><h1>A</h1><p>B</p></body></html>"""
+  eq_(html, etree.tostring(numbering.transform(html, sheet.subset(lambda rule: rule.feature_mask in (0, FEATURE_COUNTER)), pretty_print = False)))
+  eq_(['premailer', 'generate', 'resolve_targets'], numbering.stats.passes)
+  eq_(1, numbering.stats.counts['rules_applied'])
+  # Nothing to do after matching (p is not even matched)
+  numbering = AddNumbering(None)
+  numbering.stats = Stats()
+  eq_(html, etree.tostring(numbering.transform(html, sheet.subset(lambda rule: rule.selector == 'p'), pretty_print = False)))
+  eq_(['premailer'], numbering.stats.passes)
+  eq_(0, numbering.stats.counts['rule_matches'])
+  # The rules matched one after the other (td[align] tests what td sets) skip the inert ones too
+  numbering = AddNumbering(None)
+  numbering.stats = Stats()
+  sheet = numbering.compile_stylesheet("""p { color: red; } td { text-align: left; } td[align] { counter-increment: c; }""")
+  html = """<html><body><p>B</p><table><tr><td>x</td></tr></table></body></html>"""
+  numbering.transform(html, sheet)
+  eq_((2, 1, 2), (numbering.stats.counts['rules_applied'], numbering.stats.counts['rules_skipped'], numbering.stats.counts['rule_matches']))
+
+def test_explain():
+  from custom.explain import Explain
+  numbering = AddNumbering(None)
+  numbering.explain = Explain()
+  sheet = numbering.compile_stylesheet("""h1 { counter-increment: c; } div > h1::before { content: counter(c); } p:first-child { content: "x"; } .never { content: "y"; }""")
+  for html in ("""<html><body><div><h1>A</h1><h1>B</h1></div></body></html>""", """<html><body><p>D</p><h1>C</h1></body></html>"""):
+    numbering.transform(html, sheet, pretty_print = False)
+  costs = dict((cost.selector + cost.class_, cost) for cost in numbering.explain.report())
+  eq_((2, 3), (costs['h1'].documents, costs['h1'].matched))
+  eq_(2, costs['div > h1:before'].matched)
+  eq_(False, costs['p:first-child'].native)
+  eq_(['.never'], [cost.selector for cost in numbering.explain.never_matched()])
+  eq_('.never', numbering.explain.report('selector')[0].selector)
+
+def test_transform_book_incremental():
+  import cPickle as pickle
+  css = """h1 { counter-increment: chapter; counter-reset: figure; } figure { counter-increment: figure; }
+           figure::before { content: counter(chapter) "." counter(figure); }
+           a { content: target-counter(attr(href), chapter) "." target-counter(attr(href), figure); }"""
+  def book(first, third):
+    return [('ch1.html', """<html><body><h1>A</h1>%s</body></html>""" % first),
+            ('ch2.html', """<html><body><h1>B</h1><figure/><a href="ch3.html#x">l</a></body></html>"""),
+            ('ch3.html', """<html><body><h1>C</h1>%s<figure id="x"/></body></html>""" % third)]
+  sheet = AddNumbering(None).compile_stylesheet(css)
+  previous = None
+  for (first, third, rendered) in [('<figure/>', '', ['ch1.html', 'ch2.html', 'ch3.html']),
+                                   ('<figure/>', '', []),
+                                   ('<figure/><figure/>', '', ['ch1.html']), # the figures restart in every chapter
+                                   ('<figure/><figure/>', '<figure/>', ['ch2.html', 'ch3.html']), # ch2 links to ch3
+                                   ('<h1>D</h1>', '<figure/>', ['ch1.html', 'ch2.html', 'ch3.html'])]:
+    chapters = book(first, third)
+    render = AddNumbering(None).transform_book_incremental(chapters, sheet, previous, pretty_print = False)
+    eq_(rendered, render.rendered)
+    expected = [(name, etree.tostring(tree, encoding='ascii')) for (name, tree) in AddNumbering(None).transform_book(chapters, sheet, pretty_print = False)]
+    eq_(expected, render.outputs())
+    previous = pickle.loads(pickle.dumps(render, pickle.HIGHEST_PROTOCOL))
+  # Editing the chapter of the target-counter() changes the text ch1 and ch2 read in ch0
+  previous = None
+  for (extra, rendered) in [('', ['ch0.html', 'ch1.html', 'ch2.html']), ('<h1/>', ['ch0.html', 'ch1.html', 'ch2.html']), ('<h1/>', [])]:
+    chapters = chained_book(extra)
+    render = AddNumbering(None).transform_book_incremental(chapters, [CHAINED_CSS], previous, pretty_print = False)
+    eq_(rendered, render.rendered)
+    expected = [(name, etree.tostring(tree, encoding='ascii')) for (name, tree) in AddNumbering(None).transform_book(chapters, [CHAINED_CSS], pretty_print = False)]
+    eq_(expected, render.outputs())
+    previous = pickle.loads(pickle.dumps(render, pickle.HIGHEST_PROTOCOL))
+
+def test_result_cache():
+  import os, shutil, tempfile
+  from custom.cache import DiskCache
+  directory = tempfile.mkdtemp()
+  try:
+    cache = DiskCache(os.path.join(directory, 'results'))
+    css = """h1 { counter-increment: c; } h1::before { content: counter(c) ". "; }"""
+    html = """<html><body><h1>A</h1></body></html>"""
+    expected = etree.tostring(AddNumbering(None).transform(html, css, pretty_print = False), encoding='ascii')
+    eq_(expected, AddNumbering(None).transform_cached(html, css, cache, pretty_print = False))
+    eq_(expected, AddNumbering(None).transform_cached(html, css, cache, pretty_print = False))
+    eq_((1, 1), (cache.hits, cache.misses))
+    # Only the comments and whitespace of the CSS changed
+    reformatted = '/* numbered */\n' + css.replace('; ', ';\n  ')
+    eq_(expected, AddNumbering(None).transform_cached(html, reformatted, cache, pretty_print = False))
+    eq_((2, 1), (cache.hits, cache.misses))
+    # The counters the document starts with are part of the key
+    numbering = AddNumbering(None)
+    numbering.evaluator.state.counters['c'] = 4
+    eq_(expected.replace('1. ', '5. '), numbering.transform_cached(html, css, cache, pretty_print = False))
+    eq_(2, cache.misses)
+
+    small = DiskCache(os.path.join(directory, 'small'), max_bytes=25)
+    for (key, mtime) in (('a', 100), ('b', 200), ('c', 300)):
+      small.put(key, '0123456789')
+      os.utime(small._path(key), (mtime, mtime))
+    eq_(1, small.evictions)
+    eq_((None, '0123456789'), (small.get('a'), small.get('c')))
+    # Writing a value again replaces its size
+    for _ in range(3):
+      small.put('c', '0123456789')
+    eq_((1, 20), (small.evictions, small._size))
+  finally:
+    shutil.rmtree(directory)
+
+def test_service():
+  import os, shutil, tempfile, threading
+  import service
+  directory = tempfile.mkdtemp()
+  try:
+    path = os.path.join(directory, 'book.css')
+    open(path, 'w').write("""h1 { counter-increment: c; } h1::before { content: counter(c) ". "; }""")
+    html = """<html><body><h1>A</h1></body></html>"""
+    expected = etree.tostring(AddNumbering(None).transform(html, open(path).read(), pretty_print = False), encoding='ascii')
+    stylesheets = {'book': [path]}
+    transform_service = service.TransformService(stylesheets, processes=1, max_jobs=2)
+    server = service.make_server(transform_service, ('127.0.0.1', 0))
+    address = server.server_address
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+      client = service.Client(stylesheets, address)
+      for _ in range(3): # the worker is replaced after 2
+        eq_(expected, client.transform(html, 'book', pretty_print = False))
+      # The stylesheet is compiled again when its file changes
+      open(path, 'w').write("""h1 { counter-increment: c; } h1::before { content: "#" counter(c); }""")
+      os.utime(path, (0, 0))
+      eq_(True, '#1' in client.transform(html, 'book', pretty_print = False))
+      try:
+        client.transform(html, 'other')
+        eq_('ServiceError', None)
+      except service.ServiceError:
+        pass
+      eq_(0, client.local)
+    finally:
+      server.shutdown()
+      server.server_close()
+      thread.join()
+      transform_service.close()
+    # Nothing is listening any more
+    eq_(True, '#1' in client.transform(html, 'book', pretty_print = False))
+    eq_(1, client.local)
+    # A server that does not answer in time may still be transforming the document: it is not transformed again
+    import socket, urllib2
+    listening = socket.socket()
+    listening.bind(('127.0.0.1', 0))
+    listening.listen(1)
+    try:
+      slow = service.Client(stylesheets, listening.getsockname(), timeout=0.5)
+      try:
+        slow.transform(html, 'book')
+        eq_('timeout', None)
+      except (urllib2.URLError, socket.error):
+        pass
+      eq_(0, slow.local)
+    finally:
+      listening.close()
+  finally:
+    shutil.rmtree(directory)
+
+def test_stylesheet_loader():
+  import os, shutil, tempfile, threading
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from custom.loader import StylesheetLoader, LoaderError
+  files = {
+    '/css/book.css': """@import url("parts/numbers.css") print;\nh2 { counter-increment: s; }""",
+    '/css/parts/numbers.css': """h1 { counter-increment: c; } h1::before { content: counter(c) ". "; }""",
+  }
+  requests = []
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      requests.append(self.path)
+      body = files.get(self.path)
+      self.send_response(body is None and 404 or 200)
+      self.end_headers()
+      self.wfile.write(body or '')
+    def log_message(self, format, *args):
+      pass
+  server = HTTPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.start()
+  directory = tempfile.mkdtemp()
+  try:
+    url = 'http://%s:%d' % server.server_address
+    cache_dir = os.path.join(directory, 'cache')
+    loader = StylesheetLoader(cache_dir=cache_dir)
+    css = loader.load(url + '/css/book.css')
+    eq_(False, '@import' in css)
+    eq_(True, 'h1::before' in css and 'h2' in css)
+    eq_(['/css/book.css', '/css/parts/numbers.css'], requests)
+    eq_(css, loader.load(url + '/css/book.css'))
+    eq_(2, len(requests))
+    # Another process finds them on disk
+    eq_(css, StylesheetLoader(cache_dir=cache_dir, offline=True).load(url + '/css/book.css'))
+    eq_(2, len(requests))
+    try:
+      loader.load(url + '/css/missing.css')
+      eq_('LoaderError', None)
+    except LoaderError:
+      pass
+
+    # A mirror (and a local file, read again when it changes)
+    mirror = os.path.join(directory, 'mirror')
+    os.makedirs(mirror)
+    open(os.path.join(mirror, 'book.css'), 'w').write("""@import "local.css"; @import 'book.css';""")
+    local = os.path.join(mirror, 'local.css')
+    open(local, 'w').write("""p { content: "one"; }""")
+    loader = StylesheetLoader(mirrors={url + '/mirrored/': mirror}, offline=True)
+    eq_(""" p { content: "one"; } """.strip(), loader.load(url + '/mirrored/book.css').strip())
+    open(local, 'w').write("""p { content: "two"; }""")
+    os.utime(local, (0, 0))
+    eq_(['p { content: "two"; }', 'p { content: "two"; }'], [c.strip() for c in loader.load_many([url + '/mirrored/book.css', local])])
+    eq_(3, len(requests))
+    try:
+      loader.load(url + '/css/book.css')
+      eq_('LoaderError', None)
+    except LoaderError:
+      pass
+    # Nothing next to the mirror is read
+    open(os.path.join(directory, 'secret.css'), 'w').write("""p { content: "secret"; }""")
+    for location in (url + '/mirrored/../secret.css', url + '/mirrored/a/../../secret.css'):
+      try:
+        loader.load(location)
+        eq_('LoaderError', location)
+      except LoaderError:
+        pass
+    eq_('p { content: "two"; }', loader.load(url + '/mirrored/a/../local.css').strip())
+  finally:
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    shutil.rmtree(directory)
+
+def test_transform_batch():
+  import os, shutil, tempfile
+  import batch
+  css = """h1 { counter-increment: c; } h1::before { content: counter(c) ". "; }"""
+  documents = [('doc%d' % i, """<html><body>%s</body></html>""" % ('<h1>A</h1>' * i)) for i in range(1, 6)]
+  expected = dict((name, etree.tostring(AddNumbering(None).transform(html, css, pretty_print = False), encoding='ascii')) for (name, html) in documents)
+  # A broken document does not stop the others
+  documents.insert(2, ('broken', ''))
+  for executor in ('threads', 'processes'):
+    results = list(batch.transform_batch(iter(documents), css, executor=executor, workers=2, max_in_flight=2, pretty_print = False))
+    eq_(sorted(name for (name, _) in documents), sorted(result.name for result in results))
+    for result in results:
+      if result.name == 'broken':
+        eq_(True, result.error is not None)
+      else:
+        eq_((expected[result.name], None), (result.output, result.error))
+  # Stopping early cancels the rest
+  results = batch.transform_batch(iter(documents), css, workers=1, max_in_flight=1)
+  results.next()
+  results.close()
+  # Two batches at the same time keep their own CSS
+  other = """h1::before { content: "#"; }"""
+  firsts = batch.transform_batch(documents[:2], css, pretty_print = False)
+  others = batch.transform_batch(documents[:2], other, pretty_print = False)
+  results = [firsts.next(), others.next(), firsts.next(), others.next()]
+  eq_([False, True, False, True], ['#' in result.output for result in results])
+  # An error outside of a document reaches the caller
+  import threading
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool(1)
+  try:
+    batch._next([pool.apply_async(int, ('x',))], threading.Event())
+    eq_('ValueError', None)
+  except ValueError:
+    pass
+  finally:
+    pool.terminate()
+
+  directory = tempfile.mkdtemp()
+  try:
+    os.mkdir(os.path.join(directory, 'out'))
+    path = os.path.join(directory, 'doc1.html')
+    open(path, 'w').write(dict(documents)['doc1'])
+    results = list(batch.transform_files([path], os.path.join(directory, 'out'), css, pretty_print = False))
+    eq_([(path, None, None)], results)
+    eq_(expected['doc1'], open(os.path.join(directory, 'out', 'doc1.html')).read())
+  finally:
+    shutil.rmtree(directory)
 
 def main():
+  test_target_counter_forward_and_backward()
   test_target_text()
+  test_target_text_memoized()
   test_display_none()
   test_content_replace_and_counter()
   test_target_counter()
+  test_target_counter_backward()
   test_content_basic()
   test_pseudo_simple()
   test_attr()
@@ -157,6 +739,29 @@ def main():
   test_string_set_multiple()
 #  test_string_set_advanced()
   test_move_to()
+  test_move_to_earlier_destination()
+  test_style_store()
+  test_compiled_stylesheet()
+  test_selector_cache()
+  test_rule_matching()
+  test_premailer_tree()
+  test_lru_cache_eviction()
+  test_transform_stream()
+  test_transform_book()
+  test_transform_book_parallel()
+  test_state_snapshot()
+  test_declaration_cache()
+  test_scan_matches_tokenize()
+  test_counter_styles()
+  test_benchmark()
+  test_stats()
+  test_feature_mask()
+  test_explain()
+  test_transform_book_incremental()
+  test_result_cache()
+  test_service()
+  test_stylesheet_loader()
+  test_transform_batch()
   return EXIT_CODE[0]
 
 if __name__ == '__main__':